@@ -0,0 +1,429 @@
+"""Load test and microbenchmarks for the Versz API
+
+Boots main:app in-process, seeds users, pages with custom CSS, templates
+and analytics, then drives concurrent requests through an ASGI transport
+and reports latency percentiles and throughput per endpoint. Message and
+drawing reads run after the write scenarios have filled those collections.
+
+    # Against a local mongod (uses and then drops the versz_bench database)
+    python bench.py --requests 500 --concurrency 20
+
+    # Against mongomock_motor, when no mongod is available
+    python bench.py --backend memory
+
+    # Compare with an earlier run
+    python bench.py --output after.json --compare before.json
+
+The memory backend has no indexes, $text search or GridFS, so
+/search-templates and drawing uploads fail there and timings only show
+Python-side cost. Use mongod for numbers worth comparing.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+from datetime import datetime, timedelta
+
+os.environ.setdefault("MONGODB_DATABASE", "versz_bench")
+os.environ.setdefault("CACHE_BUS_ENABLED", "false")
+os.environ.setdefault("METRICS_ENABLED", "false")
+
+import httpx
+from starlette.requests import Request
+
+import main
+
+WORDS = [
+    "neon", "retro", "minimal", "dark", "pastel", "gamer", "anime", "space", "vapor", "glass",
+    "ocean", "forest", "sunset", "pixel", "cyber", "lofi", "gothic", "cozy", "mono", "aurora"
+]
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36 Edg/124.0",
+]
+PASSWORD = "BenchPassw0rd!"
+# 1x1 transparent PNG
+DRAWING_DATA_URL = (
+    "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+# Setup
+
+async def start_app(backend: str) -> None:
+    main.limiter.enabled = False
+    main.settings.MAX_MESSAGES_PER_PAGE = 10 ** 9
+    main.settings.MAX_DRAWINGS_PER_PAGE = 10 ** 9
+    if backend == "memory":
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            sys.exit("The memory backend needs mongomock_motor: pip install mongomock-motor")
+        main.db_client = AsyncMongoMockClient()
+        main.db = main.db_client[main.settings.MONGODB_DATABASE]
+        main.http_clients.start()
+        main.view_buffer.start()
+    else:
+        await main.startup_event()
+
+async def stop_app(backend: str) -> None:
+    if backend == "memory":
+        await main.view_buffer.stop()
+        await main.http_clients.close()
+    else:
+        await main.db_client.drop_database(main.settings.MONGODB_DATABASE)
+        await main.shutdown_event()
+
+def make_page(index: int, user_id: str) -> dict:
+    page = main.ProfilePage(
+        url=f"bench{index}",
+        title=f"Bench page {index}",
+        name=f"Bench User {index}",
+        bio=" ".join(random.choices(WORDS, k=30)),
+        background={"type": "gradient", "value": "linear-gradient(45deg, #12c2e9, #c471ed, #f64f59)"},
+        social_links=[{"platform": "github", "url": f"https://github.com/bench{index}"}],
+        custom_css="\n".join(
+            f".block-{n} {{ color: #{n:06x}; margin: {n % 16}px; transition: all 0.{n % 9}s ease; }}" for n in range(60)
+        ),
+        messages_config={"enabled": True, "require_approval": False},
+        drawings_config={"enabled": True, "require_approval": False},
+    ).dict()
+    page.update({"page_id": f"page{index}", "user_id": user_id, "created_at": datetime.utcnow()})
+    return page
+
+async def seed(db, users: int, templates: int, analytics_rows: int) -> dict:
+    """Insert a realistic dataset and return what the scenarios need to address it"""
+    hashed_password = main.pwd_context.hash(PASSWORD)
+    now = datetime.utcnow()
+    user_docs, page_docs = [], []
+    for n in range(1, users + 1):
+        user_id = str(n)
+        user_docs.append({
+            "id": user_id,
+            "user_number": n,
+            "email": f"bench{n}@example.com",
+            "username": f"bench{n}",
+            "name": f"Bench User {n}",
+            "hashed_password": hashed_password,
+            "is_verified": True,
+            "joined_at": now - timedelta(days=n),
+            "tags": [],
+            "display_preferences": main.DisplayPreferences().dict(),
+        })
+        page_docs.append(make_page(n, user_id))
+    await db.users.insert_many(user_docs)
+    await db.profile_pages.insert_many(page_docs)
+
+    template_docs = []
+    for n in range(templates):
+        tags = random.sample(WORDS, 3)
+        page_config = make_page(users + n + 1, "1")
+        template_docs.append({
+            "id": f"template{n}",
+            "name": f"{tags[0].title()} {tags[1].title()} {n}",
+            "description": " ".join(random.choices(WORDS, k=15)),
+            "preview_image": "https://example.com/preview.png",
+            "created_by": str(random.randint(1, users)),
+            "created_at": now - timedelta(minutes=n),
+            "use_count": random.randint(0, 5000),
+            "page_config": page_config,
+            "tags": tags,
+        })
+    if template_docs:
+        await db.templates.insert_many(template_docs)
+
+    # Analytics rows for the first pages, rolled up the way ingest does it
+    analytics_pages = page_docs[:min(len(page_docs), 20)]
+    rows = []
+    for page in analytics_pages:
+        for n in range(analytics_rows):
+            user_agent = random.choice(USER_AGENTS)
+            rows.append({
+                "page_id": page["page_id"],
+                "url": page["url"],
+                "timestamp": now - timedelta(minutes=random.randint(0, 60 * 24 * 60)),
+                "country_code": random.choice(["US", "DE", "BR", "IN", "JP"]),
+                "country_name": "Bench",
+                "device_type": main.detect_device_type(user_agent),
+                "browser": main.detect_browser(user_agent),
+                "referrer": random.choice([None, "https://twitter.com/x", "https://discord.com/channels/1"]),
+                "rolled_up": True,
+            })
+        await db.views.update_one({"url": page["url"]}, {"$set": {"views": analytics_rows}}, upsert=True)
+    if rows:
+        await db.analytics.insert_many(rows)
+        await db.analytics_daily.bulk_write(main.analytics_rollup_updates(rows))
+
+    return {
+        "users": [(doc["email"], doc["id"]) for doc in user_docs],
+        "pages": [(doc["page_id"], doc["url"], doc["user_id"]) for doc in page_docs],
+        "analytics_pages": [(doc["page_id"], doc["user_id"]) for doc in analytics_pages],
+    }
+
+# Scenarios
+#
+# Each scenario returns the keyword arguments for one httpx request.
+
+def build_scenarios(data: dict) -> dict:
+    tokens = {user_id: main.create_access_token({"sub": email}) for email, user_id in data["users"]}
+    counter = iter(range(10 ** 9))
+
+    def auth(user_id: str) -> dict:
+        return {"Authorization": f"Bearer {tokens[user_id]}"}
+
+    def public_page():
+        _, url, _ = random.choice(data["pages"])
+        return {"method": "GET", "url": f"/p/{url}", "headers": {"user-agent": random.choice(USER_AGENTS)}}
+
+    def login():
+        email, _ = random.choice(data["users"])
+        return {"method": "POST", "url": "/token", "data": {"username": email, "password": PASSWORD}}
+
+    def templates():
+        params = {"sort_by": random.choice(["use_count", "created_at"]), "limit": 20}
+        if random.random() < 0.3:
+            params["tag"] = random.choice(WORDS)
+        return {"method": "GET", "url": "/templates", "params": params}
+
+    def search_templates():
+        return {"method": "GET", "url": "/search-templates", "params": {"q": " ".join(random.sample(WORDS, 2))}}
+
+    def analytics():
+        page_id, user_id = random.choice(data["analytics_pages"])
+        return {"method": "GET", "url": f"/analytics/{page_id}", "headers": auth(user_id)}
+
+    def post_message():
+        page_id, _, _ = random.choice(data["pages"])
+        # A distinct user agent per request stays clear of the per-device cooldown
+        return {
+            "method": "POST",
+            "url": f"/pages/{page_id}/messages",
+            "json": {"content": " ".join(random.choices(WORDS, k=20)), "sender_name": "bench"},
+            "headers": {"user-agent": f"bench/{next(counter)}"},
+        }
+
+    def page_messages():
+        page_id, _, _ = random.choice(data["pages"])
+        return {"method": "GET", "url": f"/pages/{page_id}/messages"}
+
+    def user_messages():
+        _, _, user_id = random.choice(data["pages"])
+        return {"method": "GET", "url": "/user/messages", "headers": auth(user_id)}
+
+    def post_drawing():
+        page_id, _, _ = random.choice(data["pages"])
+        return {
+            "method": "POST",
+            "url": f"/pages/{page_id}/drawings",
+            "json": {"data_url": DRAWING_DATA_URL, "sender_name": "bench"},
+            "headers": {"user-agent": f"bench/{next(counter)}"},
+        }
+
+    def page_drawings():
+        page_id, _, _ = random.choice(data["pages"])
+        return {"method": "GET", "url": f"/pages/{page_id}/drawings"}
+
+    return {
+        "GET /p/{url}": public_page,
+        "POST /token": login,
+        "GET /templates": templates,
+        "GET /search-templates": search_templates,
+        "GET /analytics/{page_id}": analytics,
+        "POST /pages/{page_id}/messages": post_message,
+        "GET /pages/{page_id}/messages": page_messages,
+        "GET /user/messages": user_messages,
+        "POST /pages/{page_id}/drawings": post_drawing,
+        "GET /pages/{page_id}/drawings": page_drawings,
+    }
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Nearest-rank percentile"""
+    if not sorted_values:
+        return 0.0
+    index = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+async def run_scenario(client: httpx.AsyncClient, make_request, requests: int, concurrency: int) -> dict:
+    latencies, statuses = [], {}
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            kwargs = make_request()
+            started = time.perf_counter()
+            try:
+                response = await client.request(**kwargs)
+                code = str(response.status_code)
+            except Exception as e:
+                code = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[code] = statuses.get(code, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "statuses": statuses,
+        "errors": sum(count for code, count in statuses.items() if not code.startswith(("2", "3"))),
+        "throughput_rps": round(requests / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+# Microbenchmarks
+
+def time_call(fn, iterations: int) -> float:
+    """Best of five runs, in microseconds per call"""
+    best = float("inf")
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        best = min(best, time.perf_counter() - started)
+    return round(best / iterations * 1_000_000, 3)
+
+async def time_async_call(fn, iterations: int) -> float:
+    best = float("inf")
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            await fn()
+        best = min(best, time.perf_counter() - started)
+    return round(best / iterations * 1_000_000, 3)
+
+async def run_microbenchmarks(iterations: int) -> dict:
+    document = {
+        "_id": main.ObjectId(),
+        **make_page(0, "1"),
+        "analytics": [
+            {"_id": main.ObjectId(), "timestamp": datetime.utcnow(), "country_code": "US", "views": n}
+            for n in range(50)
+        ],
+    }
+    payload = main.json_serialize(document)
+    response = main.ORJSONResponse(content=payload)
+    request = Request({
+        "type": "http",
+        "method": "GET",
+        "path": "/p/bench0",
+        "headers": [(b"user-agent", USER_AGENTS[0].encode()), (b"accept-language", b"en-US,en;q=0.9")],
+        "client": ("203.0.113.7", 51234),
+    })
+    user_agents = USER_AGENTS + ["curl/8.5.0", ""]
+
+    return {
+        "json_serialize_us": time_call(lambda: main.json_serialize(document), iterations),
+        "orjson_response_render_us": time_call(lambda: response.render(payload), iterations),
+        "detect_browser_us": round(time_call(lambda: [main.detect_browser(ua) for ua in user_agents], iterations) / len(user_agents), 3),
+        "generate_device_identifier_us": await time_async_call(lambda: main.generate_device_identifier(request), iterations),
+    }
+
+# Reporting
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def print_report(results: dict, baseline: dict = None) -> None:
+    print(f"{'endpoint':34} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for name, result in results["endpoints"].items():
+        line = f"{name:34} {result['throughput_rps']:>9} {result['p50_ms']:>9} {result['p95_ms']:>9} {result['p99_ms']:>9} {result['errors']:>7}"
+        before = (baseline or {}).get("endpoints", {}).get(name)
+        if before and before["p50_ms"]:
+            line += f"   p50 {(result['p50_ms'] / before['p50_ms'] - 1) * 100:+.1f}%"
+        print(line)
+    print()
+    for name, value in results["micro"].items():
+        line = f"{name:34} {value:>9}"
+        before = (baseline or {}).get("micro", {}).get(name)
+        if before:
+            line += f"   {(value / before - 1) * 100:+.1f}%"
+        print(line)
+
+async def run(args) -> dict:
+    random.seed(args.seed)
+    await start_app(args.backend)
+    try:
+        data = await seed(main.db, args.users, args.templates, args.analytics_rows)
+        scenarios = build_scenarios(data)
+        selected = {name: make for name, make in scenarios.items() if not args.only or any(key in name for key in args.only)}
+
+        endpoints = {}
+        transport = httpx.ASGITransport(app=main.app, client=("203.0.113.7", 51234))
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for name, make_request in selected.items():
+                # Warm caches and connection pools before measuring
+                await run_scenario(client, make_request, min(args.warmup, args.requests), args.concurrency)
+                requests = args.token_requests if name == "POST /token" else args.requests
+                endpoints[name] = await run_scenario(client, make_request, requests, args.concurrency)
+                print(f"{name}: done", file=sys.stderr)
+
+        return {
+            "meta": {
+                "timestamp": datetime.utcnow().isoformat(),
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "backend": args.backend,
+                "orjson": main.USE_ORJSON,
+                "environment": main.settings.ENVIRONMENT,
+                "concurrency": args.concurrency,
+                "seed": args.seed,
+                "dataset": {"users": args.users, "templates": args.templates, "analytics_rows": args.analytics_rows},
+            },
+            "endpoints": endpoints,
+            "micro": await run_microbenchmarks(args.iterations),
+        }
+    finally:
+        await stop_app(args.backend)
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=["mongod", "memory"], default="mongod",
+                        help="mongod uses MONGODB_URL; memory uses mongomock_motor")
+    parser.add_argument("--requests", type=int, default=300, help="Measured requests per endpoint")
+    parser.add_argument("--token-requests", type=int, default=50, help="Measured /token requests (bcrypt bound)")
+    parser.add_argument("--warmup", type=int, default=30)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--templates", type=int, default=300)
+    parser.add_argument("--analytics-rows", type=int, default=500, help="Analytics rows for each of the first 20 pages")
+    parser.add_argument("--iterations", type=int, default=2000, help="Calls per microbenchmark run")
+    parser.add_argument("--only", nargs="*", help="Run endpoints whose name contains any of these strings")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="bench-results.json")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    args = parser.parse_args()
+
+    if args.backend == "mongod" and not main.settings.MONGODB_DATABASE.startswith("versz_bench"):
+        sys.exit("Refusing to seed and drop a database whose name does not start with versz_bench")
+
+    results = asyncio.run(run(args))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main_cli()
@@ -3,39 +3,55 @@ import random
 import string
 import time
 import asyncio
-import threading
 import logging
 import secrets
 import hashlib
+import hmac
 import json, urllib
+import urllib.parse
+import sys
+import csv
+import mmap
+import struct
+import ipaddress
+import io
+import shutil
+import re
+import bisect
+import threading
+import tempfile
 from functools import lru_cache
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime, timedelta, date
-from typing import Optional, List, Dict, Any, Union, Set
+from typing import Optional, List, Dict, Any, Union, Set, Callable
 from contextlib import asynccontextmanager
-from fastapi import File
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
 
-from fastapi import FastAPI, UploadFile, HTTPException, status, Request, Depends, Form, Body, BackgroundTasks, Query
+from fastapi import FastAPI, HTTPException, status, Request, Depends, Form, Body, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, Response, StreamingResponse, FileResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, EmailStr, Field, validator, SecretStr, constr, ValidationError, AnyHttpUrl, HttpUrl
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from pymongo.errors import ConnectionFailure, OperationFailure
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
+from gridfs.errors import NoFile
+from pymongo import UpdateOne, IndexModel, CursorType, monitoring
+from pymongo.errors import ConnectionFailure, OperationFailure, DuplicateKeyError, CollectionInvalid, BulkWriteError
 from bson.binary import Binary
 from bson.objectid import ObjectId
+from bson import json_util
+from multipart.multipart import MultipartParser, parse_options_header
 import httpx
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
-import schedule
 import smtplib
 from email.message import EmailMessage
-from cachetools import TTLCache
+from cachetools import TTLCache, TLRUCache
 import pytz
 from dateutil.relativedelta import relativedelta
 
@@ -45,9 +61,25 @@ try:
     USE_ORJSON = True
 except ImportError:
     USE_ORJSON = False
+try:
+    import h2  # noqa: F401  # Enables HTTP/2 in httpx
+    USE_HTTP2 = True
+except ImportError:
+    USE_HTTP2 = False
+try:
+    from PIL import Image
+    USE_PILLOW = True
+except ImportError:
+    USE_PILLOW = False
+try:
+    import maxminddb
+    USE_MAXMINDDB = True
+except ImportError:
+    USE_MAXMINDDB = False
 
 class Settings:
     MONGODB_URL: str = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
+    MONGODB_DATABASE: str = os.getenv("MONGODB_DATABASE", "Versz_db")
     API_URL: str = os.getenv("API_URL", "http://localhost:8000")
     PING_INTERVAL: int = int(os.getenv("PING_INTERVAL", "900"))  # Changed from 300 to 900 seconds (15 minutes)
     ALLOWED_ORIGINS: List[str] = os.getenv("ALLOWED_ORIGINS", "*").split(",")
@@ -62,8 +94,20 @@ class Settings:
     EMAIL_USERNAME: str = os.getenv("EMAIL_USERNAME", "")
     EMAIL_PASSWORD: str = os.getenv("EMAIL_PASSWORD", "")
     EMAIL_FROM: str = os.getenv("EMAIL_FROM", EMAIL_USERNAME)
+    EMAIL_USE_TLS: bool = os.getenv("EMAIL_USE_TLS", "true").lower() == "true"  # Disable for a local SMTP sink
+    EMAIL_BATCH_SIZE: int = int(os.getenv("EMAIL_BATCH_SIZE", "20"))
+    EMAIL_MAX_ATTEMPTS: int = int(os.getenv("EMAIL_MAX_ATTEMPTS", "6"))
+    EMAIL_POLL_INTERVAL: int = int(os.getenv("EMAIL_POLL_INTERVAL", "30"))  # Seconds between outbox scans
+    EMAIL_IDLE_TIMEOUT: int = int(os.getenv("EMAIL_IDLE_TIMEOUT", "60"))  # Close the SMTP connection after this idle time
     BCRYPT_ROUNDS: int = 12 if ENVIRONMENT == "production" else 4
+    PASSWORD_HASH_WORKERS: int = int(os.getenv("PASSWORD_HASH_WORKERS", "4"))
+    PASSWORD_HASH_MAX_QUEUE: int = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "32"))  # Waiting jobs before 503
+    USER_NUMBER_BLOCK_SIZE: int = int(os.getenv("USER_NUMBER_BLOCK_SIZE", "10"))  # user_numbers each worker reserves per round-trip
     MAX_FILE_SIZE: int = 20 * 1024 * 1024  # 20MB
+    MAX_UPLOAD_SIZE: int = int(os.getenv("MAX_UPLOAD_SIZE", str(32 * 1024 * 1024)))  # ImgBB accepts up to 32MB
+    UPLOAD_BACKEND: str = os.getenv("UPLOAD_BACKEND", "imgbb")  # "imgbb" or "local"
+    UPLOAD_DIR: str = os.getenv("UPLOAD_DIR", "uploads")
+    IMGBB_API_KEY: str = os.getenv("IMGBB_API_KEY", "")
     MAX_PROFILE_PAGES: int = 5
     MAX_SOCIAL_LINKS: int = 10
     MAX_SONGS: int = 5
@@ -71,11 +115,37 @@ class Settings:
     MONGODB_MAX_POOL_SIZE: int = 100
     MONGODB_MIN_POOL_SIZE: int = 10
     VIEW_COOLDOWN_MINUTES: int = 30
-    DEVICE_IDENTIFIER_TTL_DAYS: int = 30
+    MEDIA_VALIDATION_TTL: int = int(os.getenv("MEDIA_VALIDATION_TTL", "3600"))
+    MEDIA_VALIDATION_NEGATIVE_TTL: int = int(os.getenv("MEDIA_VALIDATION_NEGATIVE_TTL", "300"))  # Failed probes, including unreachable hosts
+    MEDIA_VALIDATION_PER_HOST: int = int(os.getenv("MEDIA_VALIDATION_PER_HOST", "4"))  # Concurrent HEAD requests per host
+    CACHE_BUS_ENABLED: bool = os.getenv("CACHE_BUS_ENABLED", "true").lower() == "true"  # Share cache evictions across workers
+    CACHE_BUS_COLLECTION_SIZE: int = int(os.getenv("CACHE_BUS_COLLECTION_SIZE", str(1024 * 1024)))
+    # Evictions reach every worker through the bus, so entries can live longer than a single worker's cache could
+    USER_CACHE_TTL: int = int(os.getenv("USER_CACHE_TTL", "3600" if CACHE_BUS_ENABLED else "300"))
+    PAGE_CACHE_TTL: int = int(os.getenv("PAGE_CACHE_TTL", "3600" if CACHE_BUS_ENABLED else "300"))
+    PUBLIC_PAGE_CACHE_TTL: int = int(os.getenv("PUBLIC_PAGE_CACHE_TTL", "3600" if CACHE_BUS_ENABLED else "300"))
+    CACHE_STALE_SECONDS: int = int(os.getenv("CACHE_STALE_SECONDS", "60"))  # Serve expired entries this long while one refresh runs
+    TEMPLATE_CACHE_TTL: int = int(os.getenv("TEMPLATE_CACHE_TTL", "1800" if CACHE_BUS_ENABLED else "600"))
+    GEOIP_DATABASE_PATH: str = os.getenv("GEOIP_DATABASE_PATH", "")  # .mmdb or compiled range table
+    GEOIP_HTTP_FALLBACK: bool = os.getenv("GEOIP_HTTP_FALLBACK", "true").lower() == "true"
+    HTTP2_ENABLED: bool = os.getenv("HTTP2_ENABLED", "true").lower() == "true"  # Used when the h2 package is installed
+    HTTP_KEEPALIVE_EXPIRY: float = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+    METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+    METRICS_TOKEN: str = os.getenv("METRICS_TOKEN", "")  # /metrics requires "Authorization: Bearer <token>" and is not served without one
+    VIEW_FLUSH_INTERVAL_MS: int = int(os.getenv("VIEW_FLUSH_INTERVAL_MS", "1000"))
+    VIEW_FLUSH_MAX_EVENTS: int = int(os.getenv("VIEW_FLUSH_MAX_EVENTS", "500"))
+    DEVICE_IDENTIFIER_TTL_DAYS: int = int(os.getenv("DEVICE_IDENTIFIER_TTL_DAYS", "30"))
     MAX_AVATAR_SIZE: int = 1024 * 1024 * 32  # 1MB
     PREVIEW_EXPIRATION_MINUTES: int = 30  # How long preview pages are valid
     
-    ANALYTICS_RETENTION_DAYS: int = 90  # How long to keep analytics data
+    ANALYTICS_RETENTION_DAYS: int = int(os.getenv("ANALYTICS_RETENTION_DAYS", "90"))  # How long to keep analytics data
+    EMAIL_OUTBOX_RETENTION_DAYS: int = int(os.getenv("EMAIL_OUTBOX_RETENTION_DAYS", "7"))  # How long sent and failed emails stay in the outbox
+    PURGE_BATCH_SIZE: int = int(os.getenv("PURGE_BATCH_SIZE", "500"))  # Documents removed per delete
+    PURGE_BATCH_DELAY_MS: int = int(os.getenv("PURGE_BATCH_DELAY_MS", "100"))  # Pause between deletes to spare replication
+    PURGE_POLL_INTERVAL: int = int(os.getenv("PURGE_POLL_INTERVAL", "30"))
+    INDEX_WAIT_TIMEOUT: int = int(os.getenv("INDEX_WAIT_TIMEOUT", "300"))  # Seconds a worker waits for another to finish reconciling indexes
+    INDEX_RETRY_INTERVAL: int = int(os.getenv("INDEX_RETRY_INTERVAL", "3600"))  # Seconds before booting workers retry a failed index reconciliation
+    RETENTION_SAMPLE_INTERVAL: int = int(os.getenv("RETENTION_SAMPLE_INTERVAL", "600"))  # Seconds between retention metric samples
     MAX_MESSAGE_LENGTH: int = 1000  # Maximum length for anonymous messages
     MAX_DRAWING_SIZE: int = 1024 * 1024 * 5  # 5MB max for drawings
     MAX_MESSAGES_PER_PAGE: int = 100  # Maximum number of messages to store per page
@@ -85,7 +155,10 @@ class Settings:
     DISCORD_CLIENT_ID: str = os.getenv("DISCORD_CLIENT_ID", "")
     DISCORD_CLIENT_SECRET: str = os.getenv("DISCORD_CLIENT_SECRET", "")
     DISCORD_REDIRECT_URI: str = os.getenv("DISCORD_REDIRECT_URI", "https://versz.fun/discord/callback")
-    DISCORD_API_ENDPOINT: str = "https://discord.com/api/v10"
+    DISCORD_API_ENDPOINT: str = os.getenv("DISCORD_API_ENDPOINT", "https://discord.com/api/v10")
+    DISCORD_REFRESH_CONCURRENCY: int = int(os.getenv("DISCORD_REFRESH_CONCURRENCY", "5"))  # Token refreshes in flight at once
+    DISCORD_REFRESH_BATCH_SIZE: int = int(os.getenv("DISCORD_REFRESH_BATCH_SIZE", "100"))  # Users read and written back per bulk_write
+    DISCORD_REFRESH_INTERVAL: int = int(os.getenv("DISCORD_REFRESH_INTERVAL", str(6 * 60 * 60)))
     
     DEFAULT_TAGS = {
         "early_supporter": {
@@ -164,6 +237,7 @@ class RateLimits:
     # New rate limits for messages and drawings
     MESSAGE_LIMIT = "10/minute"
     DRAWING_LIMIT = "5/minute"
+    BLOB_LIMIT = "300/minute"  # Pages embed many drawing images at once
 
 # Logging configuration
 
@@ -189,40 +263,706 @@ pwd_context = CryptContext(
 )
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+class PasswordHashPool:
+    """Runs bcrypt on worker threads so hashing never blocks the event loop"""
+
+    def __init__(self, max_workers: int = 4, max_queue: int = 32):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hash")
+        self.max_workers = max_workers
+        self.max_pending = max_workers + max_queue
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            logger.warning(f"Password hashing queue full ({self.pending} pending), shedding request")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please try again shortly",
+                headers={"Retry-After": "1"}
+            )
+
+        self.pending += 1
+        queued_at = time.perf_counter()
+
+        def job():
+            return time.perf_counter() - queued_at, func(*args)
+
+        try:
+            wait, result = await asyncio.get_running_loop().run_in_executor(self.executor, job)
+        finally:
+            self.pending -= 1
+
+        self.completed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self.run(pwd_context.hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self.run(pwd_context.verify, password, hashed_password)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.max_workers,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait / self.completed * 1000, 2) if self.completed else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 2)
+        }
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+password_hasher = PasswordHashPool(
+    max_workers=settings.PASSWORD_HASH_WORKERS,
+    max_queue=settings.PASSWORD_HASH_MAX_QUEUE
+)
+
+# Metrics
+#
+# Latency histograms and counters for routes, MongoDB commands, outbound HTTP
+# calls and caches, served in the Prometheus text format on /metrics. Each
+# worker keeps its own registry, so scrape every worker. pymongo publishes
+# command events from Motor's executor threads, hence the lock.
+
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def escape_metric_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_metric_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_metric_label(value)}"' for name, value in labels) + "}"
+
+class MetricsRegistry:
+    """Thread-safe counters and histograms rendered in the Prometheus text format"""
+
+    def __init__(self, buckets: tuple = METRICS_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.descriptions: Dict[str, tuple] = {}
+        self.counters: Dict[str, Dict[tuple, float]] = {}
+        self.histograms: Dict[str, Dict[tuple, List[float]]] = {}
+        self.collectors: List[Callable] = []
+
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        self.descriptions[name] = (kind, help_text)
+
+    def add_collector(self, collector: Callable) -> None:
+        """Register a callable returning (name, labels, value) samples read at scrape time"""
+        self.collectors.append(collector)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts is None:
+                # One slot per bucket plus +Inf, then sum and count
+                counts = series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def header(self, name: str, default_kind: str) -> List[str]:
+        kind, help_text = self.descriptions.get(name, (default_kind, ""))
+        return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+
+    def render(self) -> str:
+        samples: Dict[str, List[tuple]] = {}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    samples.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {str(e)}")
+        with self.lock:
+            for name, series in self.counters.items():
+                samples.setdefault(name, []).extend(series.items())
+            histograms = {name: [(key, list(counts)) for key, counts in series.items()] for name, series in self.histograms.items()}
+        
+        lines = []
+        for name, series in samples.items():
+            lines.extend(self.header(name, "counter"))
+            lines.extend(f"{name}{format_metric_labels(key)} {value!r}" for key, value in series)
+        for name, series in histograms.items():
+            lines.extend(self.header(name, "histogram"))
+            for key, counts in series:
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_metric_labels(key + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{format_metric_labels(key)} {counts[-2]!r}")
+                lines.append(f"{name}_count{format_metric_labels(key)} {counts[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.describe("http_requests_total", "counter", "Requests handled, by route template and status")
+metrics.describe("http_request_duration_seconds", "histogram", "Request latency by route template")
+metrics.describe("http_request_db_seconds", "histogram", "Time spent in MongoDB commands per request, by route template")
+metrics.describe("mongodb_command_duration_seconds", "histogram", "MongoDB command latency by collection and command")
+metrics.describe("mongodb_command_errors_total", "counter", "Failed MongoDB commands by collection and command")
+metrics.describe("http_client_request_duration_seconds", "histogram", "Outbound request latency to response headers, by upstream")
+metrics.describe("http_client_requests_total", "counter", "Outbound requests by upstream")
+metrics.describe("http_client_connections_total", "counter", "Outbound TCP connections opened by upstream")
+metrics.describe("http_client_errors_total", "counter", "Outbound transport errors and 5xx responses by upstream")
+metrics.describe("cache_lookups_total", "counter", "In-process cache lookups by cache and result")
+metrics.describe("cache_entries", "gauge", "Entries held by each in-process cache")
+metrics.describe("retention_period_seconds", "gauge", "Configured TTL for each expiring collection")
+metrics.describe("retention_oldest_age_seconds", "gauge", "Age of the oldest document by its TTL field")
+metrics.describe("retention_overdue_documents", "gauge", "Documents past their expiry that the TTL monitor has not removed yet, capped at 1000")
+metrics.describe("retention_documents", "gauge", "Estimated document count of each expiring collection")
+metrics.describe("view_buffer_pending", "gauge", "Queued view writes waiting for the next flush, by kind")
+metrics.describe("view_buffer_dropped_total", "counter", "Queued view writes dropped after failed flushes overflowed the backlog, by kind")
+metrics.describe("mongodb_ttl_passes_total", "counter", "TTL monitor passes reported by serverStatus")
+metrics.describe("mongodb_ttl_deleted_documents_total", "counter", "Documents removed by the TTL monitor, server-wide")
+
+# MongoDB time spent by the current request, accumulated by the command listener
+request_db_seconds: ContextVar[Optional[List[float]]] = ContextVar("request_db_seconds", default=None)
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Per-collection, per-command durations from pymongo command monitoring"""
+
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+        self.collections: Dict[tuple, str] = {}
+
+    def started(self, event) -> None:
+        target = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+        self.collections[(event.connection_id, event.request_id)] = target if isinstance(target, str) else ""
+
+    def record(self, event) -> str:
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        seconds = event.duration_micros / 1_000_000
+        self.registry.observe("mongodb_command_duration_seconds", seconds, collection=collection, command=event.command_name)
+        spent = request_db_seconds.get()
+        if spent is not None:
+            spent[0] += seconds
+        return collection
+
+    def succeeded(self, event) -> None:
+        self.record(event)
+
+    def failed(self, event) -> None:
+        collection = self.record(event)
+        self.registry.inc("mongodb_command_errors_total", collection=collection, command=event.command_name)
+
+class MetricsMiddleware:
+    """ASGI middleware timing each request under its route template, not the raw path"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        started = time.perf_counter()
+        status_code = 500
+        spent = [0.0]
+        token = request_db_seconds.set(spent)
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            request_db_seconds.reset(token)
+            # Unmatched paths share one label so scanners cannot blow up the series count
+            route = scope.get("route")
+            labels = {"method": scope["method"], "route": getattr(route, "path", "unmatched")}
+            metrics.observe("http_request_duration_seconds", time.perf_counter() - started, **labels)
+            metrics.observe("http_request_db_seconds", spent[0], **labels)
+            metrics.inc("http_requests_total", status=str(status_code), **labels)
+
+# Shared outbound HTTP clients
+#
+# One long-lived httpx client per upstream keeps connections alive between
+# calls, so only the first request to a host pays for the TCP and TLS
+# handshakes. Clients are created in startup_event and closed in
+# shutdown_event.
+
+class HTTPClientRegistry:
+    """Named httpx clients with per-upstream limits, timeouts and reuse metrics"""
+
+    PROFILES: Dict[str, Dict[str, Any]] = {
+        "geoip": {"timeout": 5.0, "max_connections": 20, "max_keepalive": 10},
+        "discord": {"timeout": 10.0, "max_connections": 20, "max_keepalive": 10},
+        "media": {"timeout": httpx.Timeout(5.0, connect=3.0), "max_connections": 50, "max_keepalive": 20},
+        "imgbb": {"timeout": httpx.Timeout(30.0, connect=5.0), "max_connections": 10, "max_keepalive": 5},
+        "self": {"timeout": 5.0, "max_connections": 2, "max_keepalive": 1},
+    }
+
+    def __init__(self, http2: bool = False, keepalive_expiry: float = 30.0):
+        self.http2 = http2
+        self.keepalive_expiry = keepalive_expiry
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+        self.metrics: Dict[str, Dict[str, int]] = {}
+
+    def create_client(self, name: str) -> httpx.AsyncClient:
+        profile = self.PROFILES[name]
+        counters = self.metrics.setdefault(name, {"requests": 0, "connections": 0, "errors": 0})
+
+        async def trace(event_name: str, info: Dict[str, Any]) -> None:
+            if event_name == "connection.connect_tcp.complete":
+                counters["connections"] += 1
+
+        async def on_request(request: httpx.Request) -> None:
+            counters["requests"] += 1
+            request.extensions["trace"] = trace
+            request.extensions["started_at"] = time.perf_counter()
+
+        async def on_response(response: httpx.Response) -> None:
+            if response.status_code >= 500:
+                counters["errors"] += 1
+            started_at = response.request.extensions.get("started_at")
+            if started_at is not None:
+                metrics.observe("http_client_request_duration_seconds", time.perf_counter() - started_at, upstream=name)
+
+        return httpx.AsyncClient(
+            timeout=profile["timeout"],
+            limits=httpx.Limits(
+                max_connections=profile["max_connections"],
+                max_keepalive_connections=profile["max_keepalive"],
+                keepalive_expiry=self.keepalive_expiry
+            ),
+            http2=self.http2,
+            event_hooks={"request": [on_request], "response": [on_response]}
+        )
+
+    def start(self) -> None:
+        for name in self.PROFILES:
+            self.get(name)
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        client = self.clients.get(name)
+        if client is None or client.is_closed:
+            client = self.clients[name] = self.create_client(name)
+        return client
+
+    @asynccontextmanager
+    async def session(self, name: str):
+        """Borrow a shared client; unlike httpx.AsyncClient it is not closed on exit"""
+        client = self.get(name)
+        try:
+            yield client
+        except httpx.TransportError:
+            self.metrics[name]["errors"] += 1
+            raise
+
+    async def close(self) -> None:
+        clients, self.clients = self.clients, {}
+        await asyncio.gather(*(client.aclose() for client in clients.values()), return_exceptions=True)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            name: {**counters, "reused": max(counters["requests"] - counters["connections"], 0)}
+            for name, counters in self.metrics.items()
+        }
+
+http_clients = HTTPClientRegistry(
+    http2=settings.HTTP2_ENABLED and USE_HTTP2,
+    keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY
+)
+
 # Global database client and database
 
 db_client = None
 db = None
 
+# Identifies this worker process in leases and cross-worker messages
+WORKER_ID = secrets.token_hex(8)
+
+# Cross-worker cache invalidation
+#
+# Each uvicorn worker keeps its own in-memory caches. Evictions are applied
+# locally and appended to the capped cache_invalidations collection, which
+# every worker tails so the same keys are dropped everywhere. With the bus
+# disabled (single worker, tests) publish only evicts locally.
+
+class CacheInvalidationBus:
+    """Broadcasts cache evictions to every worker through a tailed capped collection"""
+
+    def __init__(self, enabled: bool = True, collection_size: int = 1024 * 1024):
+        self.enabled = enabled
+        self.collection_size = collection_size
+        self.handlers: Dict[str, Callable[[str], None]] = {}
+        self.resets: List[Callable[[], None]] = []
+        self.task: Optional[asyncio.Task] = None
+        self.published = 0
+        self.received = 0
+        self.resyncs = 0
+
+    def register(self, topic: str, handler: Callable[[str], None], reset: Optional[Callable[[], None]] = None) -> None:
+        self.handlers[topic] = handler
+        if reset is not None:
+            self.resets.append(reset)
+
+    def apply(self, topic: str, key: str) -> None:
+        handler = self.handlers.get(topic)
+        if handler is not None:
+            handler(key)
+
+    async def publish(self, topic: str, key: str) -> None:
+        self.apply(topic, key)
+        if not self.enabled or db is None:
+            return
+        try:
+            await db.cache_invalidations.insert_one({
+                "topic": topic,
+                "key": key,
+                "origin": WORKER_ID,
+                "at": datetime.utcnow()
+            })
+            self.published += 1
+        except Exception as e:
+            logger.error(f"Error publishing {topic} invalidation: {str(e)}")
+
+    def reset_all(self) -> None:
+        """Drop every registered cache after events may have been missed"""
+        self.resyncs += 1
+        for reset in self.resets:
+            reset()
+
+    async def ensure_collection(self) -> None:
+        try:
+            await db.create_collection("cache_invalidations", capped=True, size=self.collection_size)
+        except CollectionInvalid:
+            pass
+
+    async def run(self) -> None:
+        # Evictions are idempotent, so replaying a few seconds of events is cheaper than missing one
+        since = datetime.utcnow() - timedelta(seconds=5)
+        while True:
+            try:
+                cursor = db.cache_invalidations.find(
+                    {"_id": {"$gte": ObjectId.from_datetime(since)}},
+                    cursor_type=CursorType.TAILABLE_AWAIT
+                )
+                while cursor.alive:
+                    async for event in cursor:
+                        since = event["_id"].generation_time.replace(tzinfo=None) - timedelta(seconds=5)
+                        if event.get("origin") != WORKER_ID:
+                            self.received += 1
+                            self.apply(event["topic"], event["key"])
+                # A tailable cursor dies when nothing matched yet, so poll until something does
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Cache invalidation tail failed, clearing local caches: {str(e)}")
+                self.reset_all()
+                since = datetime.utcnow() - timedelta(seconds=5)
+                await asyncio.sleep(5)
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        await self.ensure_collection()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "published": self.published,
+            "received": self.received,
+            "resyncs": self.resyncs
+        }
+
+cache_bus = CacheInvalidationBus(
+    enabled=settings.CACHE_BUS_ENABLED,
+    collection_size=settings.CACHE_BUS_COLLECTION_SIZE
+)
+
+class MeteredTTLCache(TTLCache):
+    """TTLCache counting lookups, which all go through `in` or get()"""
+
+    def __init__(self, maxsize: int, ttl: float, name: str):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        metered_caches.append(self)
+
+    def __contains__(self, key) -> bool:
+        found = super().__contains__(key)
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    def pop(self, key, default=None):
+        # Evictions are not lookups, so skip the counting __contains__
+        try:
+            value = TTLCache.__getitem__(self, key)
+        except KeyError:
+            return default
+        del self[key]
+        return value
+
+metered_caches: List[MeteredTTLCache] = []
+
 # Custom Async Cache Implementation with improved efficiency
 
 class AsyncTTLCache:
-    def __init__(self, ttl_seconds: int = 300, maxsize: int = 1000):
-        self.cache = TTLCache(maxsize=maxsize, ttl=ttl_seconds)
+    """TTL cache with single-flight loading and optional stale-while-revalidate
+
+    Entries stay in the underlying TTLCache for stale_seconds past their TTL.
+    get() only returns fresh values; get_or_load() serves a stale value while
+    a single background load refreshes it.
+    """
+
+    def __init__(self, ttl_seconds: int = 300, maxsize: int = 1000, name: Optional[str] = None, stale_seconds: int = 0):
+        self.ttl = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl_seconds + stale_seconds)
         self.lock = asyncio.Lock()
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.coalesced = 0
+        self.stale_hits = 0
+        if name:
+            cache_bus.register(name, self.evict, self.clear)
 
     async def get(self, key: str) -> Optional[Dict[str, Any]]:
-        return self.cache.get(key)
+        entry = self.cache.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
 
     async def set(self, key: str, value: Dict[str, Any]) -> None:
         async with self.lock:
-            self.cache[key] = value
+            self.cache[key] = (value, time.monotonic() + self.ttl)
+
+    async def load(self, key: str, loader: Callable[[], Any]) -> Any:
+        task = asyncio.current_task()
+        try:
+            self.loads += 1
+            value = await loader()
+            # An eviction during the load drops this task, so its result must not be stored
+            if value is not None and self.inflight.get(key) is task:
+                await self.set(key, value)
+            return value
+        finally:
+            if self.inflight.get(key) is task:
+                del self.inflight[key]
+
+    def start_load(self, key: str, loader: Callable[[], Any]) -> asyncio.Task:
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.create_task(self.load(key, loader))
+        else:
+            self.coalesced += 1
+        return task
+
+    async def get_or_load(self, key: str, loader: Callable[[], Any]) -> Any:
+        """Return the cached value or run loader once for all concurrent misses
+
+        Loaders returning None are not cached. Exceptions reach every waiter.
+        """
+        entry = self.cache.get(key)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+            if self.stale_seconds:
+                self.stale_hits += 1
+                if key not in self.inflight:
+                    self.start_load(key, loader).add_done_callback(self.log_refresh_error)
+                return entry[0]
+        self.misses += 1
+        # shield keeps one cancelled request from cancelling the load for everyone else
+        return await asyncio.shield(self.start_load(key, loader))
+
+    @staticmethod
+    def log_refresh_error(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Background cache refresh failed: {str(task.exception())}")
 
     async def delete(self, key: str) -> None:
-        async with self.lock:
-            if key in self.cache:
-                del self.cache[key]
+        """Evict a key in this worker and, for named caches, in every other worker"""
+        if self.name:
+            await cache_bus.publish(self.name, key)
+        else:
+            self.evict(key)
+
+    def evict(self, key: str) -> None:
+        self.cache.pop(key, None)
+        self.inflight.pop(key, None)
+
+    def keys(self) -> List[str]:
+        return list(self.cache.keys())
+
+    def clear(self) -> None:
+        self.cache.clear()
+        self.inflight.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "coalesced": self.coalesced,
+            "stale_hits": self.stale_hits
+        }
 
 # Initialize caches with larger sizes
 
-user_cache = AsyncTTLCache(ttl_seconds=300, maxsize=5000)
-page_cache = TTLCache(maxsize=5000, ttl=300)
-views_cache = TTLCache(maxsize=10000, ttl=300)
-template_cache = TTLCache(maxsize=1000, ttl=600)
-preview_cache = TTLCache(maxsize=1000, ttl=300)
-url_validation_cache = TTLCache(maxsize=500, ttl=300)  # 5 minutes
-view_tracking_cache = TTLCache(maxsize=10000, ttl=settings.VIEW_COOLDOWN_MINUTES * 60)
-message_cooldown_cache = TTLCache(maxsize=5000, ttl=settings.MESSAGE_COOLDOWN_MINUTES * 60)  # For message rate limiting
+user_cache = AsyncTTLCache(ttl_seconds=settings.USER_CACHE_TTL, maxsize=5000, name="user", stale_seconds=settings.CACHE_STALE_SECONDS)
+page_cache = MeteredTTLCache(maxsize=5000, ttl=settings.PAGE_CACHE_TTL, name="page")
+page_cache_owners: Dict[str, str] = {}  # user_id -> page_cache key of their public page list
+views_cache = MeteredTTLCache(maxsize=10000, ttl=300, name="views")
+template_cache = AsyncTTLCache(ttl_seconds=settings.TEMPLATE_CACHE_TTL, maxsize=1000, stale_seconds=settings.CACHE_STALE_SECONDS)
+preview_cache = MeteredTTLCache(maxsize=1000, ttl=300, name="preview")
+view_tracking_cache = MeteredTTLCache(maxsize=10000, ttl=settings.VIEW_COOLDOWN_MINUTES * 60, name="view_tracking")
+message_cooldown_cache = MeteredTTLCache(maxsize=5000, ttl=settings.MESSAGE_COOLDOWN_MINUTES * 60, name="message_cooldown")  # For message rate limiting
+geoip_cache = MeteredTTLCache(maxsize=10000, ttl=3600, name="geoip")  # HTTP fallback lookups only
+public_page_cache = MeteredTTLCache(maxsize=5000, ttl=settings.PUBLIC_PAGE_CACHE_TTL, name="public_page")  # url -> serialized /p/{url} payload
+public_page_owners: Dict[str, Set[str]] = {}  # user_id -> urls held in public_page_cache
+username_cache = MeteredTTLCache(maxsize=10000, ttl=settings.USER_CACHE_TTL, name="username")  # user_id -> username, for template creators
+
+def prune_page_cache_owners() -> None:
+    """Forget owner entries whose pages the caches expired or evicted on their own"""
+    # TTLCache iteration skips expired entries and, unlike `in`, is not counted as a lookup
+    public_urls = set(public_page_cache)
+    for user_id in list(public_page_owners):
+        public_page_owners[user_id] &= public_urls
+        if not public_page_owners[user_id]:
+            del public_page_owners[user_id]
+    page_list_keys = set(page_cache)
+    for user_id, page_list_key in list(page_cache_owners.items()):
+        if page_list_key not in page_list_keys:
+            del page_cache_owners[user_id]
+
+def evict_public_page(url: str) -> None:
+    public_page_cache.pop(url, None)
+
+def evict_user_page_list(user_id: str) -> None:
+    page_list_key = page_cache_owners.pop(user_id, None)
+    if page_list_key:
+        page_cache.pop(page_list_key, None)
+
+def evict_user_pages(user_id: str) -> None:
+    for url in public_page_owners.pop(user_id, set()):
+        public_page_cache.pop(url, None)
+    evict_user_page_list(user_id)
+    username_cache.pop(user_id, None)
+
+def evict_page_views(url: str) -> None:
+    views_cache.pop(f"views:{url}", None)
+
+def drop_page_views(url: str) -> None:
+    # The page and its counter are gone, so increments queued for it must not be written
+    view_buffer.discard(url)
+    views_cache.pop(f"views:{url}", None)
+
+def rekey_page_views(urls: str) -> None:
+    old_url, new_url = json.loads(urls)
+    view_buffer.rename(old_url, new_url)
+    views_cache.pop(f"views:{old_url}", None)
+    views_cache.pop(f"views:{new_url}", None)
+
+def evict_template(template_id: str) -> None:
+    template_cache.evict(f"template:{template_id}")
+    template_cache.evict(f"template_preview:{template_id}")
+
+def evict_template_lists(_: str) -> None:
+    for key in template_cache.keys():
+        if key.startswith(("templates:list:", "trending_templates:")):
+            template_cache.evict(key)
+
+def reset_page_caches() -> None:
+    public_page_cache.clear()
+    public_page_owners.clear()
+    username_cache.clear()
+    page_cache.clear()
+    page_cache_owners.clear()
+
+cache_bus.register("public_page", evict_public_page, reset_page_caches)
+cache_bus.register("user_pages", evict_user_pages)
+cache_bus.register("user_page_list", evict_user_page_list)
+cache_bus.register("page_views", evict_page_views, views_cache.clear)
+cache_bus.register("dropped_page_views", drop_page_views)
+cache_bus.register("renamed_page_views", rekey_page_views)
+cache_bus.register("template", evict_template, template_cache.clear)
+cache_bus.register("template_lists", evict_template_lists)
+
+async def invalidate_public_page(url: str) -> None:
+    await cache_bus.publish("public_page", url)
+
+async def invalidate_user_public_pages(user_id: str) -> None:
+    """Evict every cached public page of a user, their public page list and resolved username"""
+    await cache_bus.publish("user_pages", user_id)
+
+async def invalidate_user_page_list(user_id: str) -> None:
+    """Evict the cached /user/{username}/pages listing after pages are added, renamed or removed"""
+    await cache_bus.publish("user_page_list", user_id)
+
+async def invalidate_page_views(url: str) -> None:
+    """Evict the cached view count of a URL; views queued for it are still written"""
+    await cache_bus.publish("page_views", url)
+
+async def discard_page_views(url: str) -> None:
+    """Drop cached and queued view counts in every worker for a URL that is being deleted"""
+    await cache_bus.publish("dropped_page_views", url)
+
+async def rename_page_views(old_url: str, new_url: str) -> None:
+    """Re-key queued view counts in every worker from a page's old URL to its new one"""
+    await cache_bus.publish("renamed_page_views", json.dumps([old_url, new_url]))
+    # A worker can flush under the old URL before the message reaches it, so fold
+    # whatever lands there back into the page once every worker has flushed
+    asyncio.create_task(fold_renamed_views(old_url, new_url))
+
+async def fold_renamed_views(old_url: str, new_url: str) -> None:
+    await asyncio.sleep(view_buffer.flush_interval * 2 + 1)
+    try:
+        stray = await db.views.find_one_and_delete({"url": old_url})
+        if stray and stray.get("views"):
+            await db.views.update_one({"url": new_url}, {"$inc": {"views": stray["views"]}}, upsert=True)
+            await invalidate_page_views(new_url)
+    except Exception as e:
+        logger.error(f"Error folding views of {old_url} into {new_url}: {str(e)}")
+
+async def invalidate_template(template_id: str) -> None:
+    await cache_bus.publish("template", template_id)
+
+async def invalidate_template_lists() -> None:
+    await cache_bus.publish("template_lists", "*")
 
 # Pydantic models
 
@@ -589,6 +1329,7 @@ class DrawingStatus(BaseModel):
     id: str
     page_id: str
     data_url: str
+    thumbnail_url: Optional[str] = None
     sender_name: Optional[str] = None
     timestamp: datetime
     approved: bool = False
@@ -610,21 +1351,76 @@ def json_serialize(obj):
 
 # Custom JSON Response with faster serialization
 
+def dump_json(content) -> bytes:
+    if USE_ORJSON:
+        return orjson.dumps(content, default=json_serialize)
+    else:
+        return json.dumps(
+            content,
+            ensure_ascii=False,
+            allow_nan=False,
+            indent=None,
+            separators=(",", ":"),
+            default=json_serialize,
+        ).encode("utf-8")
+
 class ORJSONResponse(JSONResponse):
     media_type = "application/json"
 
     def render(self, content) -> bytes:
-        if USE_ORJSON:
-            return orjson.dumps(content, default=json_serialize)
-        else:
-            return json.dumps(
-                content,
-                ensure_ascii=False,
-                allow_nan=False,
-                indent=None,
-                separators=(",", ":"),
-                default=json_serialize,
-            ).encode("utf-8")
+        return dump_json(content)
+
+# Conditional GET support
+
+def make_etag(body: bytes) -> str:
+    """Strong ETag for a serialized response body"""
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+# Keyset pagination
+#
+# Continuation tokens carry the sort key values of the last row returned, so
+# the next page is a range query on an index instead of a skip.
+
+def encode_cursor(values: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(token: str, size: int) -> List[Any]:
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except Exception:
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+    return values
+
+def keyset_filter(sort: List[tuple], values: List[Any]) -> Dict[str, Any]:
+    """Match rows strictly after values in the given compound sort order"""
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        clause = {prev_field: values[j] for j, (prev_field, _) in enumerate(sort[:i])}
+        clause[field] = {"$lt" if direction == -1 else "$gt": values[i]}
+        clauses.append(clause)
+    return {"$or": clauses}
+
+def next_cursor(rows: List[Dict[str, Any]], sort: List[tuple], limit: int) -> Optional[str]:
+    if len(rows) < limit:
+        return None
+    return encode_cursor([rows[-1].get(field) for field, _ in sort])
 
 # FastAPI initialization
 
@@ -642,8 +1438,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
+# Added last so it wraps the other middleware and times the whole request
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 # Utility functions
 
 def create_access_token(data: Dict[str, Any], expires_delta: Optional[timedelta] = None) -> str:
@@ -653,11 +1454,13 @@ def create_access_token(data: Dict[str, Any], expires_delta: Optional[timedelta]
     return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
 
 async def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return await password_hasher.verify(plain_password, hashed_password)
 
-def get_password_hash(password: str) -> str:
+async def get_password_hash(password: str) -> str:
     try:
-        return pwd_context.hash(password)
+        return await password_hasher.hash(password)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Password hashing error: {str(e)}")
         raise ValueError("Error creating password hash")
@@ -675,66 +1478,346 @@ def calculate_age(birth_date_str: str) -> int:
         logger.error(f"Age calculation error: {str(e)}")
         return None
 
-async def send_email_async(to_email: str, subject: str, html_content: str) -> bool:
-    try:
+# Background workers
+#
+# Each worker runs one step in a task owned by this process, then sleeps for
+# its poll interval or until something sets its wakeup event. A step may
+# return a delay to use instead of the poll interval. Errors are logged and
+# the loop carries on with the next step.
+
+class BackgroundWorker:
+    """Base for the periodic tasks started with the app and stopped on shutdown"""
+
+    name = "background worker"
+
+    def __init__(self, poll_interval: float):
+        self.poll_interval = poll_interval
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    async def step(self) -> Optional[float]:
+        raise NotImplementedError
+
+    async def run(self) -> None:
+        while True:
+            delay = None
+            try:
+                delay = await self.step()
+            except Exception as e:
+                logger.error(f"Error in {self.name}: {str(e)}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval if delay is None else delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+# Outbound email
+#
+# Emails are written to the email_outbox collection and delivered by a
+# background worker, so request handlers only pay for one insert. The worker
+# keeps a single authenticated SMTP connection open across messages and
+# retries transient failures with exponential backoff.
+
+class EmailOutbox(BackgroundWorker):
+    """MongoDB-backed mail queue delivered over a reused SMTP connection"""
+
+    name = "email outbox worker"
+
+    def __init__(
+        self,
+        batch_size: int = 20,
+        max_attempts: int = 6,
+        poll_interval: int = 30,
+        idle_timeout: int = 60,
+        lease_seconds: int = 120
+    ):
+        super().__init__(poll_interval)
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.idle_timeout = idle_timeout
+        self.lease_seconds = lease_seconds
+        # smtplib connections are not thread-safe, so every SMTP call goes through one thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="smtp")
+        self.smtp: Optional[smtplib.SMTP] = None
+        self.last_used = 0.0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.connections = 0
+
+    async def enqueue(self, to_email: str, subject: str, html_content: str) -> None:
+        now = datetime.utcnow()
+        await db.email_outbox.insert_one({
+            "to": to_email,
+            "subject": subject,
+            "html": html_content,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now
+        })
+        self.wakeup.set()
+
+    # SMTP calls below run on the smtp thread
+
+    def _connect(self) -> smtplib.SMTP:
+        server = smtplib.SMTP(settings.EMAIL_HOST, settings.EMAIL_PORT, timeout=10)
+        try:
+            if settings.EMAIL_USE_TLS:
+                server.starttls()
+            if settings.EMAIL_USERNAME:
+                server.login(settings.EMAIL_USERNAME, settings.EMAIL_PASSWORD)
+        except Exception:
+            server.close()
+            raise
+        self.connections += 1
+        return server
+
+    def _close(self) -> None:
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except Exception:
+                self.smtp.close()
+            self.smtp = None
+
+    def _send(self, message: Dict[str, Any]) -> None:
         msg = MIMEMultipart()
         msg['From'] = settings.EMAIL_FROM
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(html_content, 'html'))
-
-        # Only try once, but with a longer timeout
-        with smtplib.SMTP(settings.EMAIL_HOST, settings.EMAIL_PORT, timeout=10) as server:
-            server.starttls()
-            server.login(settings.EMAIL_USERNAME, settings.EMAIL_PASSWORD)
-            server.send_message(msg)
-        logger.info(f"Email sent successfully to {to_email}")
+        msg['To'] = message["to"]
+        msg['Subject'] = message["subject"]
+        msg.attach(MIMEText(message["html"], 'html'))
+
+        if self.smtp is None:
+            self.smtp = self._connect()
+        try:
+            self.smtp.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped the idle connection, so reconnect once
+            self.smtp = self._connect()
+            self.smtp.send_message(msg)
+        self.last_used = time.monotonic()
+
+    def _close_if_idle(self) -> None:
+        if self.smtp is not None and time.monotonic() - self.last_used > self.idle_timeout:
+            self._close()
+
+    async def in_smtp_thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def claim_batch(self) -> List[Dict[str, Any]]:
+        """Lease due messages, including ones left behind by a crashed worker"""
+        batch = []
+        while len(batch) < self.batch_size:
+            now = datetime.utcnow()
+            message = await db.email_outbox.find_one_and_update(
+                {
+                    "$or": [
+                        {"status": "pending", "next_attempt_at": {"$lte": now}},
+                        {"status": "sending", "lease_until": {"$lt": now}}
+                    ]
+                },
+                {"$set": {
+                    "status": "sending",
+                    "lease_until": now + timedelta(seconds=self.lease_seconds),
+                    "owner": WORKER_ID
+                }},
+                sort=[("next_attempt_at", 1)],
+                return_document=True
+            )
+            if message is None:
+                break
+            batch.append(message)
+        return batch
+
+    async def renew_lease(self, message: Dict[str, Any]) -> bool:
+        """Extend the lease before sending; False if another worker took the message over"""
+        # A slow SMTP server can hold later messages of a batch past the claim's lease
+        result = await db.email_outbox.update_one(
+            {"_id": message["_id"], "status": "sending", "owner": WORKER_ID},
+            {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=self.lease_seconds)}}
+        )
+        return result.matched_count > 0
+
+    async def deliver(self, message: Dict[str, Any]) -> None:
+        try:
+            await self.in_smtp_thread(self._send, message)
+        except Exception as e:
+            attempts = message.get("attempts", 0) + 1
+            # 5xx replies are permanent, so retrying would only repeat them
+            permanent = isinstance(e, smtplib.SMTPResponseException) and 500 <= e.smtp_code < 600
+            if isinstance(e, smtplib.SMTPRecipientsRefused):
+                permanent = True
+            if not isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError)):
+                # Connection-level errors leave the session unusable
+                await self.in_smtp_thread(self._close)
+
+            if permanent or attempts >= self.max_attempts:
+                self.failed += 1
+                logger.error(f"Giving up on email to {message['to']} after {attempts} attempts: {str(e)}")
+                update = {"status": "failed", "attempts": attempts, "last_error": str(e), "failed_at": datetime.utcnow()}
+            else:
+                self.retried += 1
+                delay = min(30 * 2 ** (attempts - 1), 3600) * random.uniform(0.8, 1.2)
+                logger.warning(f"Email to {message['to']} failed (attempt {attempts}), retrying in {int(delay)}s: {str(e)}")
+                update = {
+                    "status": "pending",
+                    "attempts": attempts,
+                    "last_error": str(e),
+                    "next_attempt_at": datetime.utcnow() + timedelta(seconds=delay)
+                }
+            await db.email_outbox.update_one(
+                {"_id": message["_id"], "owner": WORKER_ID},
+                {"$set": update, "$unset": {"lease_until": "", "owner": ""}}
+            )
+            return
+
+        self.sent += 1
+        logger.info(f"Email sent successfully to {message['to']}")
+        await db.email_outbox.update_one(
+            {"_id": message["_id"], "owner": WORKER_ID},
+            {
+                "$set": {"status": "sent", "sent_at": datetime.utcnow(), "attempts": message.get("attempts", 0) + 1},
+                "$unset": {"lease_until": "", "owner": "", "html": ""}
+            }
+        )
+
+    async def process(self) -> int:
+        delivered = 0
+        while True:
+            batch = await self.claim_batch()
+            if not batch:
+                return delivered
+            for message in batch:
+                if await self.renew_lease(message):
+                    await self.deliver(message)
+                    delivered += 1
+
+    async def step(self) -> None:
+        await self.process()
+        await self.in_smtp_thread(self._close_if_idle)
+
+    async def stop(self) -> None:
+        await super().stop()
+        await self.in_smtp_thread(self._close)
+        self.executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "connections": self.connections,
+            "connected": self.smtp is not None
+        }
+
+email_outbox = EmailOutbox(
+    batch_size=settings.EMAIL_BATCH_SIZE,
+    max_attempts=settings.EMAIL_MAX_ATTEMPTS,
+    poll_interval=settings.EMAIL_POLL_INTERVAL,
+    idle_timeout=settings.EMAIL_IDLE_TIMEOUT
+)
+
+async def send_email_async(to_email: str, subject: str, html_content: str) -> bool:
+    """Queue an email for delivery by the outbox worker"""
+    try:
+        await email_outbox.enqueue(to_email, subject, html_content)
         return True
     except Exception as e:
-        logger.error(f"Error sending email to {to_email}: {str(e)}")
+        logger.error(f"Error queueing email to {to_email}: {str(e)}")
         return False
 
 async def get_user(email: str) -> Optional[Dict[str, Any]]:
-    cache_key = f"user:{email}"
-    cached_user = await user_cache.get(cache_key)
-    if cached_user is not None:
-        return cached_user
-    
     # Specify only the fields you need with projection
-    user = await db.users.find_one(
-        {"email": email},
+    return await user_cache.get_or_load(f"user:{email}", lambda: db.users.find_one(
+        {"email": email, "deleted_at": {"$exists": False}},
         projection={
             "id": 1, "email": 1, "username": 1, "name": 1, "hashed_password": 1,
             "is_verified": 1, "avatar_url": 1, "avatar_decoration": 1,
             "user_number": 1, "joined_at": 1, "tags": 1, "display_preferences": 1,
             "location": 1, "date_of_birth": 1, "timezone": 1, "gender": 1, "pronouns": 1,
-            "bio": 1, "discord": 1
+            "bio": 1, "discord": 1, "token_version": 1
         }
-    )
-    if user:
-        await user_cache.set(cache_key, user)
-    return user
+    ))
 
 async def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
-    cache_key = f"username:{username}"
-    cached_user = await user_cache.get(cache_key)
-    if cached_user is not None:
-        return cached_user
-    
     # Specify only the fields you need with projection
-    user = await db.users.find_one(
-        {"username": username},
+    return await user_cache.get_or_load(f"username:{username}", lambda: db.users.find_one(
+        {"username": username, "deleted_at": {"$exists": False}},
         projection={
             "id": 1, "email": 1, "username": 1, "name": 1, "hashed_password": 1,
             "is_verified": 1, "avatar_url": 1, "avatar_decoration": 1,
             "user_number": 1, "joined_at": 1, "tags": 1, "display_preferences": 1,
             "location": 1, "date_of_birth": 1, "timezone": 1, "gender": 1, "pronouns": 1,
-            "bio": 1, "discord": 1
+            "bio": 1, "discord": 1, "token_version": 1
         }
-    )
-    if user:
-        await user_cache.set(cache_key, user)
-    return user
+    ))
+
+async def invalidate_user_cache(email: str, username: Optional[str] = None) -> None:
+    """Evict a user's cached principal and documents in every worker"""
+    await user_cache.delete(f"principal:{email}")
+    await user_cache.delete(f"user:{email}")
+    if username:
+        await user_cache.delete(f"username:{username}")
+
+async def resolve_usernames(user_ids) -> Dict[str, Optional[str]]:
+    """Map user ids to usernames with one $in query for the ids not already cached"""
+    usernames = {}
+    missing = set()
+    for user_id in user_ids:
+        if user_id in username_cache:
+            usernames[user_id] = username_cache[user_id]
+        else:
+            missing.add(user_id)
+    
+    if missing:
+        async for user in db.users.find({"id": {"$in": list(missing)}}, projection={"id": 1, "username": 1}):
+            usernames[user["id"]] = user.get("username")
+        for user_id in missing:
+            # Unknown ids are cached too so deleted creators don't cost a query per listing
+            username_cache[user_id] = usernames.setdefault(user_id, None)
+    return usernames
+
+async def with_creator_usernames(templates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Format template documents for listings and attach created_by_username"""
+    usernames = await resolve_usernames({template["created_by"] for template in templates})
+    results = []
+    for template in templates:
+        # Format template
+        template["id"] = str(template["id"])
+        if "_id" in template:
+            template["_id"] = str(template["_id"])
+        
+        results.append({
+            **template,
+            "created_by_username": usernames.get(template["created_by"])
+        })
+    return results
+
+async def get_page_summaries(page_ids) -> Dict[str, Dict[str, Any]]:
+    """Fetch title and url for a set of pages in one query"""
+    return {
+        page["page_id"]: page
+        async for page in db.profile_pages.find(
+            {"page_id": {"$in": list(set(page_ids))}},
+            projection={"page_id": 1, "title": 1, "url": 1}
+        )
+    }
 
 async def authenticate_user(email: str, password: str) -> Optional[Dict[str, Any]]:
     try:
@@ -744,7 +1827,7 @@ async def authenticate_user(email: str, password: str) -> Optional[Dict[str, Any
             return None
         
         try:
-            if not pwd_context.verify(password, user["hashed_password"]):
+            if not await password_hasher.verify(password, user["hashed_password"]):
                 logger.info(f"Authentication failed: Invalid password for user {email}")
                 return None
         except ValueError as e:
@@ -752,17 +1835,84 @@ async def authenticate_user(email: str, password: str) -> Optional[Dict[str, Any
             return None
             
         return user
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Authentication error: {str(e)}")
         return None
 
-async def get_next_user_number(db_instance) -> int:
-    result = await db_instance.users.find_one(
-        filter={},
-        sort=[("user_number", -1)],
-        projection={"user_number": 1}
-    )
-    return (result["user_number"] + 1) if result else 1
+# User number allocation
+#
+# user_number comes from a document in the counters collection. Each worker
+# reserves a block of numbers with one $inc and hands them out locally, so
+# most registrations need no round-trip for numbering. Numbers are unique
+# across workers; a block a worker never finishes leaves a gap.
+
+class SequenceAllocator:
+    """Unique, increasing numbers from a counters document, reserved in blocks per worker"""
+
+    def __init__(self, name: str, block_size: int = 10, seed: Optional[Callable] = None):
+        self.name = name
+        self.block_size = max(block_size, 1)
+        self.seed = seed
+        self.next_value = 1
+        self.last_value = 0
+        self.lock = asyncio.Lock()
+        self.reservations = 0
+        self.allocated = 0
+
+    async def seed_counter(self) -> None:
+        """Start the counter above the highest number already handed out"""
+        start = await self.seed() if self.seed else 0
+        try:
+            await db.counters.update_one({"_id": self.name}, {"$max": {"value": start}}, upsert=True)
+        except DuplicateKeyError:
+            # Another worker created the counter at the same moment
+            await db.counters.update_one({"_id": self.name}, {"$max": {"value": start}})
+
+    async def reserve(self) -> None:
+        counter = await db.counters.find_one_and_update(
+            {"_id": self.name},
+            {"$inc": {"value": self.block_size}},
+            return_document=True
+        )
+        if counter is None:
+            await self.seed_counter()
+            return await self.reserve()
+        self.reservations += 1
+        self.last_value = counter["value"]
+        self.next_value = self.last_value - self.block_size + 1
+
+    async def allocate(self) -> int:
+        async with self.lock:
+            if self.next_value > self.last_value:
+                await self.reserve()
+            value = self.next_value
+            self.next_value += 1
+            self.allocated += 1
+            return value
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "allocated": self.allocated,
+            "reservations": self.reservations,
+            "remaining": self.last_value - self.next_value + 1
+        }
+
+async def max_user_number() -> int:
+    """Highest user_number held by a user or pending registration"""
+    highest = 0
+    for collection in (db.users, db.pending_users):
+        result = await collection.find_one(
+            {"user_number": {"$exists": True}},
+            sort=[("user_number", -1)],
+            projection={"user_number": 1}
+        )
+        if result:
+            highest = max(highest, result["user_number"])
+    return highest
+
+user_numbers = SequenceAllocator("user_number", block_size=settings.USER_NUMBER_BLOCK_SIZE, seed=max_user_number)
 
 async def is_url_available(db_instance, url: str) -> bool:
     # Check if URL is taken by a page or a user
@@ -772,27 +1922,74 @@ async def is_url_available(db_instance, url: str) -> bool:
         return False
     return True
 
+# Auth context
+#
+# Verified token claims are cached by token hash until the token's exp, so a
+# client reusing its token skips the JWT decode. Requests carry a slim
+# principal rather than the user document; handlers that need the password
+# hash or profile fields load the full user with load_full_user. Tokens embed
+# the user's token_version, which password changes bump to revoke them.
+
+verified_tokens = TLRUCache(
+    maxsize=10000,
+    ttu=lambda token_hash, claims, now: claims["exp"],
+    timer=time.time
+)
+
+async def get_principal(email: str) -> Optional[Dict[str, Any]]:
+    return await user_cache.get_or_load(f"principal:{email}", lambda: db.users.find_one(
+        {"email": email, "deleted_at": {"$exists": False}},
+        projection={"_id": 0, "id": 1, "email": 1, "username": 1, "is_verified": 1, "token_version": 1,
+                    "timezone": 1}
+    ))
+
+def create_user_token(user: Dict[str, Any], expires_delta: Optional[timedelta] = None) -> str:
+    return create_access_token({"sub": user["email"], "ver": user.get("token_version", 0)}, expires_delta)
+
+def verify_token(token: str) -> Optional[Dict[str, Any]]:
+    """Claims of a valid token, from the cache when this token was seen before"""
+    token_hash = hashlib.sha256(token.encode()).digest()
+    claims = verified_tokens.get(token_hash)
+    if claims is not None:
+        return claims
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+    except JWTError:
+        return None
+    if payload.get("sub") is None or payload.get("exp") is None:
+        return None
+    claims = {"sub": payload["sub"], "ver": payload.get("ver", 0), "exp": payload["exp"]}
+    verified_tokens[token_hash] = claims
+    return claims
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Invalid credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
+    claims = verify_token(token)
+    if claims is None:
         raise credentials_exception
-        
-    user = await get_user(token_data.username)
-    if user is None:
+    
+    user = await get_principal(claims["sub"])
+    # A password change bumps token_version, revoking every token issued before it
+    if user is None or user.get("token_version", 0) != claims["ver"]:
         raise credentials_exception
     
     return user
 
+async def load_full_user(current_user: Dict[str, Any]) -> Dict[str, Any]:
+    """Full user document, including the password hash, for the principal of this request"""
+    user = await get_user(current_user["email"])
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user
+
 async def get_current_verified_user(current_user: dict = Depends(get_current_user)):
     if not current_user.get("is_verified", False):
         raise HTTPException(
@@ -808,18 +2005,135 @@ async def generate_device_identifier(request: Request) -> str:
     identifier = f"{ip}:{user_agent}:{accept_language}"
     return hashlib.sha256(identifier.encode()).hexdigest()
 
-async def get_country_info(ip_address: str) -> Dict[str, str]:
+# Local GeoIP lookups
+#
+# A compiled range table is a sorted array of fixed-size records
+# (start address, end address, country code) followed by a JSON map of
+# country names. All addresses are stored as 16-byte IPv6 (IPv4 is mapped to
+# ::ffff:a.b.c.d) so one byte-wise binary search covers both families.
+
+class GeoIPRangeTable:
+    """Country lookup over a compiled IP range table mapped into memory"""
+
+    MAGIC = b"VGEOIP01"
+    HEADER = struct.Struct(">8sII")  # magic, record count, names length
+    RECORD_SIZE = 34  # 16-byte start, 16-byte end, 2-byte country code
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, names_length = self.HEADER.unpack_from(self.data, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a compiled GeoIP range table")
+        self.records_offset = self.HEADER.size
+        names_offset = self.records_offset + self.count * self.RECORD_SIZE
+        self.names = json.loads(self.data[names_offset:names_offset + names_length].decode("utf-8"))
+
+    @staticmethod
+    def ip_key(ip_address: str) -> bytes:
+        address = ipaddress.ip_address(ip_address)
+        if address.version == 4:
+            return b"\x00" * 10 + b"\xff\xff" + address.packed
+        return address.packed
+
+    def lookup(self, ip_address: str) -> Optional[Dict[str, str]]:
+        key = self.ip_key(ip_address)
+
+        # Find the last range starting at or before the address
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            offset = self.records_offset + mid * self.RECORD_SIZE
+            if self.data[offset:offset + 16] <= key:
+                low = mid + 1
+            else:
+                high = mid
+        if low == 0:
+            return None
+
+        offset = self.records_offset + (low - 1) * self.RECORD_SIZE
+        if self.data[offset + 16:offset + 32] < key:
+            return None
+
+        country_code = self.data[offset + 32:offset + 34].decode("ascii")
+        return {
+            "country_code": country_code,
+            "country_name": self.names.get(country_code, country_code)
+        }
+
+    def close(self) -> None:
+        self.data.close()
+        self.file.close()
+
+    @classmethod
+    def compile(cls, csv_path: str, output_path: str) -> int:
+        """Compile a start_ip,end_ip,country_code[,country_name] CSV into a range table"""
+        records = []
+        names: Dict[str, str] = {}
+        with open(csv_path, newline="", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                if len(row) < 3 or row[0].startswith("#"):
+                    continue
+                try:
+                    start, end = cls.ip_key(row[0].strip()), cls.ip_key(row[1].strip())
+                except ValueError:
+                    continue  # Header row or malformed address
+                country_code = row[2].strip().upper()
+                if len(country_code) != 2:
+                    continue
+                records.append((start, end, country_code.encode("ascii")))
+                if len(row) > 3 and row[3].strip():
+                    names[country_code] = row[3].strip()
+
+        records.sort()
+        names_data = json.dumps(names, ensure_ascii=False).encode("utf-8")
+        with open(output_path, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(records), len(names_data)))
+            for start, end, country_code in records:
+                f.write(start + end + country_code)
+            f.write(names_data)
+        return len(records)
+
+class MaxMindGeoIPReader:
+    """Country lookup over a MaxMind .mmdb database opened with mmap"""
+
+    def __init__(self, path: str):
+        self.reader = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+
+    def lookup(self, ip_address: str) -> Optional[Dict[str, str]]:
+        record = self.reader.get(ip_address)
+        if not record:
+            return None
+        country = record.get("country") or record.get("registered_country")
+        if not country or not country.get("iso_code"):
+            return None
+        return {
+            "country_code": country["iso_code"],
+            "country_name": country.get("names", {}).get("en", country["iso_code"])
+        }
+
+    def close(self) -> None:
+        self.reader.close()
+
+geoip_db = None
+
+def open_geoip_database(path: str):
+    if path.endswith(".mmdb"):
+        if not USE_MAXMINDDB:
+            raise RuntimeError("The maxminddb package is required to read .mmdb files")
+        return MaxMindGeoIPReader(path)
+    return GeoIPRangeTable(path)
+
+async def lookup_country_http(ip_address: str) -> Dict[str, str]:
     """Get country information from IP address using MaxMind API"""
-    if ip_address in ["127.0.0.1", "localhost", "::1"]:
-        return {"country_code": "Unknown", "country_name": "Unknown"}
-    
     try:
         maxmind_api_key = os.getenv("MAXMIND_API_KEY")
         maxmind_account_id = os.getenv("MAXMIND_ACCOUNT_ID")
         
         if not maxmind_api_key or not maxmind_account_id:
             # Use a free IP geolocation API as fallback
-            async with httpx.AsyncClient(timeout=5.0) as client:
+            async with http_clients.session("geoip") as client:
                 response = await client.get(f"https://ipapi.co/{ip_address}/json/")
                 if response.status_code == 200:
                     data = response.json()
@@ -832,7 +2146,7 @@ async def get_country_info(ip_address: str) -> Dict[str, str]:
             
         url = f"https://geolite.info/geoip/v2.1/country/{ip_address}"
         
-        async with httpx.AsyncClient(timeout=5.0) as client:
+        async with http_clients.session("geoip") as client:
             response = await client.get(
                 url,
                 auth=(maxmind_account_id, maxmind_api_key)
@@ -846,7 +2160,7 @@ async def get_country_info(ip_address: str) -> Dict[str, str]:
                 }
             else:
                 # Try the fallback API if MaxMind fails
-                async with httpx.AsyncClient(timeout=5.0) as client:
+                async with http_clients.session("geoip") as client:
                     response = await client.get(f"https://ipapi.co/{ip_address}/json/")
                     if response.status_code == 200:
                         data = response.json()
@@ -861,6 +2175,39 @@ async def get_country_info(ip_address: str) -> Dict[str, str]:
         logger.error(f"Error getting country info: {str(e)}")
         return {"country_code": "Error", "country_name": "Error"}
 
+async def get_country_info(ip_address: str) -> Dict[str, str]:
+    """Get country information from the local GeoIP database, falling back to HTTP providers"""
+    unknown = {"country_code": "Unknown", "country_name": "Unknown"}
+    if ip_address in ["127.0.0.1", "localhost", "::1"]:
+        return unknown
+    
+    try:
+        if ipaddress.ip_address(ip_address).is_private:
+            return unknown
+    except ValueError:
+        return unknown
+    
+    if geoip_db is not None:
+        try:
+            country_info = geoip_db.lookup(ip_address)
+        except Exception as e:
+            logger.error(f"Local GeoIP lookup failed for {ip_address}: {str(e)}")
+            country_info = None
+        if country_info:
+            return country_info
+    
+    if not settings.GEOIP_HTTP_FALLBACK:
+        return unknown
+    
+    cached_info = geoip_cache.get(ip_address)
+    if cached_info is not None:
+        return cached_info
+    
+    country_info = await lookup_country_http(ip_address)
+    if country_info["country_code"] != "Error":
+        geoip_cache[ip_address] = country_info
+    return country_info
+
 def detect_device_type(user_agent: str) -> str:
     """Detect device type from user agent string"""
     user_agent = user_agent.lower()
@@ -887,227 +2234,1230 @@ def detect_browser(user_agent: str) -> str:
     else:
         return "Other"
 
-# Optimized view tracking with cache and analytics
-
-async def increment_page_views(db_instance, url: str, device_hash: str, request: Request) -> int:
-    """Increment the view count for a page and record analytics data"""
-    cache_key = f"{url}:{device_hash}"
-    
-    if cache_key not in view_tracking_cache:
-        # This is a new view or one that has expired from the cache
-        view_tracking_cache[cache_key] = True
+# Analytics rollups
+#
+# analytics_daily holds one document per page per UTC day with counters for
+# countries, hours, device types, browsers and referrer domains, so the
+# analytics endpoint reads a bounded number of small documents instead of
+# aggregating raw analytics rows. Counter keys are escaped because country
+# names and referrer domains can contain "." and "$".
+
+ROLLUP_COUNTER_FIELDS = ["countries", "hours", "devices", "browsers", "referrers"]
+
+def encode_rollup_key(value: str) -> str:
+    return value.replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+def decode_rollup_key(key: str) -> str:
+    return urllib.parse.unquote(key)
+
+def analytics_rollup_updates(entries: List[Dict[str, Any]]) -> List[UpdateOne]:
+    """Fold raw analytics entries into $inc upserts on analytics_daily"""
+    increments: Dict[tuple, Dict[str, int]] = {}
+    for entry in entries:
+        timestamp = entry["timestamp"]
+        day = datetime(timestamp.year, timestamp.month, timestamp.day)
+        counters = increments.setdefault((entry["page_id"], day), {})
         
-        # Increment the view count
-        result = await db_instance.views.find_one_and_update(
-            {"url": url},
-            {"$inc": {"views": 1}},
-            upsert=True,
-            return_document=True
+        fields = ["total", f"hours.{timestamp.hour:02d}"]
+        if entry.get("country_code") and entry.get("country_name"):
+            fields.append("countries." + encode_rollup_key(f"{entry['country_code']}:{entry['country_name']}"))
+        if entry.get("device_type"):
+            fields.append("devices." + encode_rollup_key(entry["device_type"]))
+        if entry.get("browser"):
+            fields.append("browsers." + encode_rollup_key(entry["browser"]))
+        referrer_domain = urllib.parse.urlparse(entry["referrer"]).netloc.lower() if entry.get("referrer") else ""
+        fields.append("referrers." + encode_rollup_key(referrer_domain or "direct"))
+        
+        for field in fields:
+            counters[field] = counters.get(field, 0) + 1
+    
+    return [
+        UpdateOne({"page_id": page_id, "day": day}, {"$inc": counters}, upsert=True)
+        for (page_id, day), counters in increments.items()
+    ]
+
+MIGRATION_LOCK_MINUTES = 10
+
+async def acquire_migration_lock(name: str) -> bool:
+    """Take or extend the lease that stops several workers running one migration"""
+    now = datetime.utcnow()
+    try:
+        await db.schema_migrations.update_one(
+            {
+                "_id": f"{name}:lock",
+                "$or": [{"locked_until": {"$lt": now}}, {"owner": WORKER_ID}]
+            },
+            {"$set": {"locked_until": now + timedelta(minutes=MIGRATION_LOCK_MINUTES), "owner": WORKER_ID}},
+            upsert=True
         )
+        return True
+    except DuplicateKeyError:
+        # Another worker holds an unexpired lease
+        return False
+
+async def run_migration_once(name: str, migration) -> None:
+    """Run a data migration unless schema_migrations says it already ran"""
+    try:
+        if await db.schema_migrations.find_one({"_id": name}, projection={"_id": 1}):
+            return
+        if not await acquire_migration_lock(name):
+            return
+        logger.info(f"Running migration {name}...")
+        await migration()
+        await db.schema_migrations.update_one(
+            {"_id": name},
+            {"$set": {"applied_at": datetime.utcnow()}},
+            upsert=True
+        )
+        await db.schema_migrations.delete_one({"_id": f"{name}:lock"})
+        logger.info(f"Migration {name} complete")
+    except Exception as e:
+        logger.error(f"Migration {name} failed: {str(e)}")
+
+async def backfill_analytics_rollups(batch_size: int = 1000) -> None:
+    """Build analytics_daily from analytics rows written before rollups existed"""
+    # Rows rolled up at ingest carry rolled_up, so only older rows are counted here
+    state = await db.schema_migrations.find_one({"_id": "analytics_daily_backfill:progress"}) or {}
+    last_id = state.get("last_id")
+    processed = 0
+    while True:
+        query = {"rolled_up": {"$exists": False}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = await db.analytics.find(query).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
         
-        # Get page_id for analytics
+        await db.analytics_daily.bulk_write(analytics_rollup_updates(batch), ordered=False)
+        last_id = batch[-1]["_id"]
+        processed += len(batch)
+        await db.schema_migrations.update_one(
+            {"_id": "analytics_daily_backfill:progress"},
+            {"$set": {"last_id": last_id}},
+            upsert=True
+        )
+        if not await acquire_migration_lock("analytics_daily_backfill"):
+            raise RuntimeError("Lost the migration lease")
+    
+    logger.info(f"Backfilled analytics rollups from {processed} analytics rows")
+
+# Write-behind view tracking
+#
+# Views are counted in-process and written to MongoDB in batches so a visit
+# costs no database round-trips on the request path. The in-process count is
+# kept in views_cache so readers see their own writes before the next flush.
+#
+# Writes that fail go back into the buffer for the next flush, up to
+# max_backlog entries of each kind; anything beyond that is dropped and
+# counted in stats(). Analytics rows whose rollup failed are inserted
+# without rolled_up and rolled up again on the next flush.
+
+class ViewWriteBuffer(BackgroundWorker):
+    """Queues page views and flushes them as batched MongoDB writes"""
+
+    name = "view flush task"
+
+    def __init__(self, flush_interval_ms: int = 1000, max_events: int = 500, max_backlog: int = 10000):
+        super().__init__(flush_interval_ms / 1000)
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_events = max_events
+        self.max_backlog = max_backlog
+        self.view_increments: Dict[str, int] = {}
+        self.analytics: List[Dict[str, Any]] = []
+        self.view_records: List[Dict[str, Any]] = []
+        # Analytics entries still to be counted in analytics_daily
+        self.unrolled: List[Dict[str, Any]] = []
+        self.event_count = 0
+        self.dropped = {"analytics": 0, "view_records": 0, "rollups": 0}
+        self.flush_lock = asyncio.Lock()
+
+    def record(
+        self,
+        url: str,
+        view_record: Dict[str, Any],
+        analytics_entry: Optional[Dict[str, Any]] = None
+    ) -> None:
+        self.view_increments[url] = self.view_increments.get(url, 0) + 1
+        self.view_records.append(view_record)
+        if analytics_entry is not None:
+            self.analytics.append(analytics_entry)
+        self.event_count += 1
+        if self.event_count >= self.max_events:
+            self.wakeup.set()
+
+    def pending_views(self, url: str) -> int:
+        return self.view_increments.get(url, 0)
+
+    def discard(self, url: str) -> None:
+        """Drop queued increments for a URL that is being deleted"""
+        self.view_increments.pop(url, None)
+
+    def rename(self, old_url: str, new_url: str) -> None:
+        """Move queued increments to a page's new URL, where its counter now lives"""
+        count = self.view_increments.pop(old_url, 0)
+        if count:
+            self.view_increments[new_url] = self.view_increments.get(new_url, 0) + count
+
+    async def flush(self) -> None:
+        async with self.flush_lock:
+            if not self.event_count:
+                return
+
+            # Swap the buffers before awaiting so new views go into a fresh batch
+            increments, self.view_increments = self.view_increments, {}
+            analytics, self.analytics = self.analytics, []
+            view_records, self.view_records = self.view_records, []
+            self.event_count = 0
+
+            try:
+                if increments:
+                    await db.views.bulk_write(
+                        [
+                            UpdateOne({"url": url}, {"$inc": {"views": count}}, upsert=True)
+                            for url, count in increments.items()
+                        ],
+                        ordered=False
+                    )
+            except Exception as e:
+                logger.error(f"Error flushing {len(increments)} view counters: {str(e)}")
+                # Counters are cheap to keep, so put them back for the next flush
+                for url, count in increments.items():
+                    self.view_increments[url] = self.view_increments.get(url, 0) + count
+                    self.event_count += count
+
+            # Roll up this batch with any entries whose rollup failed before
+            unrolled, self.unrolled = self.unrolled + analytics, []
+            try:
+                if unrolled:
+                    await db.analytics_daily.bulk_write(analytics_rollup_updates(unrolled), ordered=False)
+                    # Keeps the rollup backfill from counting these rows again
+                    for entry in unrolled:
+                        entry["rolled_up"] = True
+                    # Entries from earlier flushes were inserted without the flag
+                    inserted_ids = [entry["_id"] for entry in unrolled if "_id" in entry]
+                    if inserted_ids:
+                        await db.analytics.update_many({"_id": {"$in": inserted_ids}}, {"$set": {"rolled_up": True}})
+            except Exception as e:
+                logger.error(f"Error flushing analytics rollups for {len(unrolled)} views: {str(e)}")
+                self.unrolled = self.requeue("rollups", unrolled, self.unrolled)
+
+            self.analytics = self.requeue("analytics", await self.insert("analytics", analytics), self.analytics)
+            self.view_records = self.requeue("view_records", await self.insert("view_records", view_records), self.view_records)
+
+    async def insert(self, collection: str, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Insert documents and return the ones that were not written"""
+        if not documents:
+            return []
+        try:
+            await db[collection].insert_many(documents, ordered=False)
+            return []
+        except BulkWriteError as e:
+            # insert_many assigned every _id up front, so a retried document that
+            # did land the first time fails as a duplicate and is done
+            failed = [documents[error["index"]] for error in e.details.get("writeErrors", []) if error.get("code") != 11000]
+        except Exception:
+            failed = documents
+        if failed:
+            logger.error(f"Error flushing {len(failed)} of {len(documents)} {collection} documents, retrying next flush")
+        return failed
+
+    def requeue(self, kind: str, failed: List[Dict[str, Any]], queued: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Put failed entries ahead of those queued since, dropping the oldest beyond max_backlog"""
+        if not failed:
+            return queued
+        combined = failed + queued
+        overflow = len(combined) - self.max_backlog
+        if overflow > 0:
+            self.dropped[kind] += overflow
+            logger.error(f"View buffer backlog full, dropped {overflow} {kind}")
+            combined = combined[overflow:]
+        self.event_count += len(failed)
+        return combined
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending_views": sum(self.view_increments.values()),
+            "pending_analytics": len(self.analytics),
+            "pending_view_records": len(self.view_records),
+            "pending_rollups": len(self.unrolled),
+            "dropped": dict(self.dropped)
+        }
+
+    async def step(self) -> None:
+        await self.flush()
+
+    async def stop(self) -> None:
+        await super().stop()
+        await self.flush()
+
+view_buffer = ViewWriteBuffer(
+    flush_interval_ms=settings.VIEW_FLUSH_INTERVAL_MS,
+    max_events=settings.VIEW_FLUSH_MAX_EVENTS
+)
+
+async def get_page_views(db_instance, url: str) -> int:
+    """Get the view count for a page including views not yet flushed"""
+    cache_key = f"views:{url}"
+    if cache_key in views_cache:
+        return views_cache[cache_key]
+
+    views_doc = await db_instance.views.find_one({"url": url}, projection={"views": 1})
+    views = (views_doc["views"] if views_doc else 0) + view_buffer.pending_views(url)
+    views_cache[cache_key] = views
+    return views
+
+async def increment_page_views(
+    db_instance,
+    url: str,
+    device_hash: str,
+    request: Request,
+    page: Optional[Dict[str, Any]] = None
+) -> int:
+    """Increment the view count for a page and record analytics data"""
+    cache_key = f"{url}:{device_hash}"
+
+    if cache_key in view_tracking_cache:
+        # Repeat view within the cooldown window
+        return await get_page_views(db_instance, url)
+
+    # This is a new view or one that has expired from the cache
+    view_tracking_cache[cache_key] = True
+
+    # Read the current count before queueing so the new view is counted once
+    views = await get_page_views(db_instance, url) + 1
+    views_cache[f"views:{url}"] = views
+
+    # Get page_id for analytics unless the caller already has the page
+    if page is None:
         page = await db_instance.profile_pages.find_one({"url": url}, projection={"page_id": 1, "analytics_config": 1})
-        
-        # Only record analytics if the page exists and analytics are enabled
-        if page and page.get("analytics_config", {}).get("enabled", True):
-            # Get country info
-            ip_address = request.client.host
-            country_info = await get_country_info(ip_address)
-            
-            # Get user agent info
-            user_agent = request.headers.get("user-agent", "")
-            device_type = detect_device_type(user_agent)
-            browser = detect_browser(user_agent)
-            
-            # Get referrer
-            referrer = request.headers.get("referer", "")
-            
-            # Record analytics data
-            await db_instance.analytics.insert_one({
-                "page_id": page["page_id"],
-                "url": url,
-                "timestamp": datetime.utcnow(),
-                "country_code": country_info["country_code"],
-                "country_name": country_info["country_name"],
-                "device_type": device_type,
-                "browser": browser,
-                "referrer": referrer if referrer else None
-            })
-            
-            # Record the view with additional data
-            await db_instance.view_records.insert_one({
+
+    now = datetime.utcnow()
+
+    # Only record analytics if the page exists and analytics are enabled
+    if page and page.get("analytics_config", {}).get("enabled", True):
+        # Get country info
+        ip_address = request.client.host
+        country_info = await get_country_info(ip_address)
+
+        # Get user agent info
+        user_agent = request.headers.get("user-agent", "")
+
+        # Get referrer
+        referrer = request.headers.get("referer", "")
+
+        view_buffer.record(
+            url,
+            {
                 "url": url,
                 "device_hash": device_hash,
-                "timestamp": datetime.utcnow(),
+                "timestamp": now,
                 "ip_address": ip_address,
                 "user_agent": user_agent,
                 "country_code": country_info["country_code"],
                 "country_name": country_info["country_name"]
-            })
-        else:
-            # Record basic view without analytics
-            await db_instance.view_records.insert_one({
+            },
+            {
+                "page_id": page["page_id"],
                 "url": url,
-                "device_hash": device_hash,
-                "timestamp": datetime.utcnow(),
-                "ip_address": "",
-                "user_agent": ""
-            })
-        
-        views = result["views"] if result else 1
-        views_cache[f"views:{url}"] = views
-        return views
+                "timestamp": now,
+                "country_code": country_info["country_code"],
+                "country_name": country_info["country_name"],
+                "device_type": detect_device_type(user_agent),
+                "browser": detect_browser(user_agent),
+                "referrer": referrer if referrer else None
+            }
+        )
     else:
-        # Return cached view count
-        views_doc = await db_instance.views.find_one({"url": url})
-        views = views_doc["views"] if views_doc else 0
-        return views
-
-async def validate_avatar(avatar_url: str) -> bool:
-    """Validate if the avatar URL is valid and the file is appropriate"""
-    # Check cache first
-    cache_key = f"avatar_validation:{avatar_url}"
-    if cache_key in url_validation_cache:
-        return url_validation_cache[cache_key]
-        
+        # Record basic view without analytics
+        view_buffer.record(url, {
+            "url": url,
+            "device_hash": device_hash,
+            "timestamp": now,
+            "ip_address": "",
+            "user_agent": ""
+        })
+
+    return views
+
+# Font link policy
+#
+# A font link must be a <link rel="stylesheet"> tag whose href points at a
+# trusted font CDN. The verdict depends only on the link text, so it is kept
+# in a process-wide LRU instead of expiring with the other URL caches.
+
+FONT_LINK_REL = re.compile(r"""rel=['"]stylesheet['"]""")
+FONT_LINK_HREF = re.compile(r"""href=['"]([^'"]+)['"]""")
+
+def font_link_domain(font_link: str) -> Optional[str]:
+    href_match = FONT_LINK_HREF.search(font_link)
+    if not href_match:
+        return None
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.head(avatar_url, follow_redirects=True)
-            
-            result = False
-            if response.status_code == 200:
-                content_type = response.headers.get("content-type", "")
-                content_length = int(response.headers.get("content-length", "0"))
-                
-                if (content_type.startswith("image/") or content_type == "image/gif") and content_length <= settings.MAX_AVATAR_SIZE:
-                    result = True
-                    
-            url_validation_cache[cache_key] = result
-            return result
-    except Exception as e:
-        logger.error(f"Error validating avatar: {str(e)}")
+        return urllib.parse.urlparse(href_match.group(1)).netloc
+    except ValueError:
+        return None
+
+DEFAULT_FONT_LINKS = frozenset(font["link"] for font in settings.DEFAULT_FONTS if font["link"])
+TRUSTED_FONT_DOMAINS = frozenset({
+    "fonts.googleapis.com",
+    "fonts.gstatic.com",
+    "use.typekit.net",
+    "use.fontawesome.com",
+    *filter(None, map(font_link_domain, DEFAULT_FONT_LINKS))
+})
+
+@lru_cache(maxsize=4096)
+def font_link_verdict(font_link: str) -> bool:
+    """Whether a font link is a stylesheet tag from Google Fonts or another trusted source"""
+    if not font_link or font_link in DEFAULT_FONT_LINKS:
+        return True
+    if not font_link.startswith("<link") or not FONT_LINK_REL.search(font_link):
         return False
+    return font_link_domain(font_link) in TRUSTED_FONT_DOMAINS
+
+def page_font_links(page) -> Dict[str, str]:
+    """Font links of every text style on a page, template page_config or preferences model"""
+    links = {}
+    for field, value in page:
+        if isinstance(value, TextStyleConfig) and value.font and value.font.link:
+            links[field] = value.font.link
+    return links
+
+def validate_fonts(links: Dict[str, str]) -> List[str]:
+    """Check a batch of font links in one pass and return the keys of those that fail"""
+    return [key for key, link in links.items() if not font_link_verdict(link)]
+
+# Media URL validation
+#
+# Avatar and decoration URLs are probed with HEAD requests through the shared
+# media client. Results are cached separately for passes and failures, so a
+# dead host is not re-probed on every save, and concurrent probes of one URL
+# share a single request.
+
+class MediaValidationService:
+    """Concurrent, cached validation of the media URLs and font links on a page"""
+
+    def __init__(self, positive_ttl: int = 3600, negative_ttl: int = 300, per_host_limit: int = 4):
+        self.valid = TTLCache(maxsize=5000, ttl=positive_ttl)
+        self.invalid = TTLCache(maxsize=5000, ttl=negative_ttl)
+        self.per_host_limit = per_host_limit
+        self.host_limits = TTLCache(maxsize=1000, ttl=600)
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.probes = 0
+        self.cache_hits = 0
+
+    def host_limit(self, host: str) -> asyncio.Semaphore:
+        limit = self.host_limits.get(host)
+        if limit is None:
+            limit = self.host_limits[host] = asyncio.Semaphore(self.per_host_limit)
+        return limit
+
+    async def probe(self, kind: str, url: str) -> bool:
+        parsed = urllib.parse.urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            return False
+        
+        self.probes += 1
+        async with self.host_limit(parsed.hostname):
+            async with http_clients.session("media") as client:
+                response = await client.head(url, follow_redirects=True, timeout=3.0 if kind == "decoration" else 5.0)
+        
+        if response.status_code != 200:
+            return False
+        content_type = response.headers.get("content-type", "")
+        if not content_type.startswith("image/"):
+            return False
+        if kind == "avatar":
+            content_length = int(response.headers.get("content-length", "0"))
+            return content_length <= settings.MAX_AVATAR_SIZE
+        return True
+
+    async def run_probe(self, key: str, kind: str, url: str) -> bool:
+        try:
+            result = await self.probe(kind, url)
+        except Exception as e:
+            logger.warning(f"Error validating {kind} URL {url}: {str(e)}")
+            result = False
+        finally:
+            self.inflight.pop(key, None)
+        (self.valid if result else self.invalid)[key] = True
+        return result
 
-async def validate_decoration(decoration_url: str) -> bool:
-    """Validate if the avatar decoration URL is valid and the file is appropriate"""
-    # Check cache first
-    cache_key = f"decoration_validation:{decoration_url}"
-    if cache_key in url_validation_cache:
-        return url_validation_cache[cache_key]
+    async def check_url(self, kind: str, url: str) -> bool:
+        key = f"{kind}:{url}"
+        if key in self.valid or key in self.invalid:
+            self.cache_hits += 1
+            return key in self.valid
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.create_task(self.run_probe(key, kind, url))
+        return await asyncio.shield(task)
+
+    async def check(self, kind: str, value: str) -> bool:
+        if kind == "font":
+            return font_link_verdict(value)
+        return await self.check_url(kind, value)
+
+    async def validate(self, checks: List[tuple]) -> None:
+        """Run (kind, value, error detail) checks concurrently and raise 400 for the first failure"""
+        checks = [check for check in checks if check[1]]
+        
+        # Font links need no I/O, so settle them in one pass before probing any URLs
+        fonts = {detail: value for kind, value, detail in checks if kind == "font"}
+        for detail in validate_fonts(fonts):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=detail
+            )
         
+        checks = [check for check in checks if check[0] != "font"]
+        results = await asyncio.gather(*(self.check_url(kind, value) for kind, value, _ in checks))
+        for (_, _, detail), ok in zip(checks, results):
+            if not ok:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=detail
+                )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "probes": self.probes,
+            "cache_hits": self.cache_hits,
+            "cached_valid": len(self.valid),
+            "cached_invalid": len(self.invalid),
+            "font_verdicts": font_link_verdict.cache_info()._asdict()
+        }
+
+media_validator = MediaValidationService(
+    positive_ttl=settings.MEDIA_VALIDATION_TTL,
+    negative_ttl=settings.MEDIA_VALIDATION_NEGATIVE_TTL,
+    per_host_limit=settings.MEDIA_VALIDATION_PER_HOST
+)
+
+def style_font_link(style) -> Optional[str]:
+    return style.font.link if style and style.font else None
+
+def page_media_checks(page, suffix: str = "") -> List[tuple]:
+    """Validation checks for the avatar, decoration and fonts of a page or page update"""
+    return [
+        ("avatar", page.avatar_url, "Invalid avatar URL or file too large (max 1MB)"),
+        ("decoration", page.avatar_decoration, "Invalid avatar decoration URL"),
+    ] + [
+        ("font", link, f"Invalid font link for {field[:-len('_style')]}{suffix}")
+        for field, link in page_font_links(page).items()
+    ]
+
+def sniff_image_type(data: bytes) -> Optional[str]:
+    """Content type from the file signature, ignoring whatever the client declared"""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data.startswith(b"BM"):
+        return "image/bmp"
+    if data[4:12] == b"ftypavif":
+        return "image/avif"
+    return None
+
+def decode_drawing_data(data_url: str) -> Optional[tuple]:
+    """Decode a drawing data URL once, returning (bytes, content_type) if it is a valid image"""
+    if not data_url.startswith("data:image/"):
+        return None
+    
     try:
-        async with httpx.AsyncClient(timeout=3.0) as client:
-            response = await client.head(decoration_url, follow_redirects=True)
-            
-            result = False
-            if response.status_code == 200:
-                content_type = response.headers.get("content-type", "")
-                
-                # Check if it's an image (including PNG with transparency) or a GIF
-                if content_type.startswith("image/") or content_type == "image/gif":
-                    result = True
-                    
-            url_validation_cache[cache_key] = result
-            return result
+        # Extract the base64 data
+        header, encoded = data_url.split(",", 1)
+        # Reject oversized payloads before decoding them
+        if len(encoded) * 3 // 4 > settings.MAX_DRAWING_SIZE + 3:
+            return None
+        data = base64.b64decode(encoded)
     except Exception as e:
-        logger.error(f"Error validating decoration: {str(e)}")
-        return False
+        logger.error(f"Error decoding drawing data: {str(e)}")
+        return None
+    
+    content_type = sniff_image_type(data)
+    if len(data) > settings.MAX_DRAWING_SIZE or content_type is None:
+        return None
+    return data, content_type
+
+# Drawing blob storage
+#
+# Drawing images live in the drawing_blobs GridFS bucket, keyed by the SHA-256
+# of their bytes so identical submissions share one blob. Drawing documents
+# only hold the blob id, and listings return URLs instead of inline data.
+#
+# Images are served per drawing rather than per blob, so access follows the
+# drawing the URL names: an approved drawing is public, and the owner's own
+# listing hands out signed, expiring URLs for pending ones. Approval can still
+# be revoked by deleting the drawing, so responses are only cached briefly and
+# then revalidated against the content-hash ETag. Blobs no drawing
+# references are marked orphaned and only deleted after a grace period, and
+# storing the same content again clears the mark, so a concurrent store can
+# never end up pointing at a deleted file.
+
+DRAWING_THUMBNAIL_SIZE = (256, 256)
+BLOB_ORPHAN_GRACE = timedelta(hours=1)
+
+def drawing_bucket() -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(db, bucket_name="drawing_blobs")
+
+def make_drawing_thumbnail(data: bytes) -> Optional[bytes]:
+    if not USE_PILLOW:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # Refuse decompression bombs before decoding pixels
+            if image.width * image.height > 40_000_000:
+                return None
+            image.thumbnail(DRAWING_THUMBNAIL_SIZE)
+            output = io.BytesIO()
+            image.convert("RGBA").save(output, format="PNG", optimize=True)
+            return output.getvalue()
+    except Exception as e:
+        logger.error(f"Error generating drawing thumbnail: {str(e)}")
+        return None
 
-async def validate_font(font_link: str) -> bool:
-    """Validate if the font link is from Google Fonts or another trusted source"""
-    if not font_link:
-        return True
+async def put_blob(blob_id: str, data: bytes, content_type: str) -> None:
+    for attempt in range(3):
+        # Reusing a stored blob also takes it off the orphan list
+        result = await db["drawing_blobs.files"].update_one(
+            {"_id": blob_id},
+            {"$unset": {"metadata.orphaned_at": ""}}
+        )
+        if result.matched_count:
+            return
+        try:
+            await drawing_bucket().upload_from_stream_with_id(
+                blob_id, blob_id, data, metadata={"content_type": content_type}
+            )
+            return
+        except DuplicateKeyError:
+            # Another request stored the same content first, or the chunks of a
+            # collected copy are still being removed; look again
+            await asyncio.sleep(0.1 * (attempt + 1))
+    raise RuntimeError(f"Could not store blob {blob_id}")
+
+async def store_drawing(data: bytes, content_type: str) -> Dict[str, Any]:
+    """Store drawing bytes and a thumbnail, returning the fields to keep on the drawing document"""
+    blob_id = hashlib.sha256(data).hexdigest()
+    await put_blob(blob_id, data, content_type)
+    
+    thumbnail_id = None
+    thumbnail = await asyncio.to_thread(make_drawing_thumbnail, data)
+    if thumbnail is not None:
+        thumbnail_id = f"{blob_id}.thumb"
+        await put_blob(thumbnail_id, thumbnail, "image/png")
     
-    # Check cache first
-    cache_key = f"font_validation:{font_link}"
-    if cache_key in url_validation_cache:
-        return url_validation_cache[cache_key]
+    return {
+        "blob_id": blob_id,
+        "thumbnail_id": thumbnail_id,
+        "content_type": content_type,
+        "size": len(data)
+    }
+
+DRAWING_IMAGE_VARIANTS = ("image", "thumbnail")
+
+def blob_signature(drawing_id: str, variant: str, expires: int) -> str:
+    message = f"drawing_blob:{drawing_id}:{variant}:{expires}".encode()
+    return hmac.new(settings.SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+def blob_url(drawing_id: str, variant: str, signed: bool) -> str:
+    url = f"{settings.API_URL}/drawings/{drawing_id}/{variant}"
+    if not signed:
+        return url
+    # Round the expiry to the hour so repeated listings return the same, cacheable URL
+    expires = int(time.time()) // 3600 * 3600 + 2 * 3600
+    return f"{url}?expires={expires}&sig={blob_signature(drawing_id, variant, expires)}"
+
+def drawing_urls(drawing: Dict[str, Any], signed: bool = False) -> Dict[str, Optional[str]]:
+    """Image URLs for a drawing; signed ones let the page owner see drawings that are not approved yet"""
+    if not drawing.get("blob_id"):
+        # Drawings not yet migrated still carry their data URL inline
+        return {"data_url": drawing.get("data_url"), "thumbnail_url": drawing.get("data_url")}
+    signed = signed and not drawing.get("approved", False)
+    data_url = blob_url(drawing["id"], "image", signed)
+    return {
+        "data_url": data_url,
+        "thumbnail_url": blob_url(drawing["id"], "thumbnail", signed) if drawing.get("thumbnail_id") else data_url
+    }
+
+async def delete_drawings(query: Dict[str, Any]) -> None:
+    """Delete drawing documents and mark the blobs no other drawing still references as orphaned"""
+    blob_ids = [blob_id for blob_id in await db.drawings.distinct("blob_id", query) if blob_id]
+    await db.drawings.delete_many(query)
+    
+    now = datetime.utcnow()
+    for blob_id in blob_ids:
+        if await db.drawings.find_one({"blob_id": blob_id}, projection={"_id": 1}):
+            continue
+        await db["drawing_blobs.files"].update_many(
+            {"_id": {"$in": [blob_id, f"{blob_id}.thumb"]}, "metadata.orphaned_at": {"$exists": False}},
+            {"$set": {"metadata.orphaned_at": now}}
+        )
+    await collect_orphaned_blobs()
+
+async def collect_orphaned_blobs(limit: int = 100) -> None:
+    """Delete blobs that stayed unreferenced for longer than BLOB_ORPHAN_GRACE"""
+    files = db["drawing_blobs.files"]
+    cutoff = datetime.utcnow() - BLOB_ORPHAN_GRACE
+    orphans = await files.find(
+        {"metadata.orphaned_at": {"$lt": cutoff}},
+        projection={"_id": 1}
+    ).limit(limit).to_list(limit)
+    for orphan in orphans:
+        file_id = orphan["_id"]
+        if await db.drawings.find_one({"blob_id": file_id.removesuffix(".thumb")}, projection={"_id": 1}):
+            await files.update_one({"_id": file_id}, {"$unset": {"metadata.orphaned_at": ""}})
+            continue
+        # A store that reused the blob since has cleared orphaned_at, so this no longer matches
+        result = await files.delete_one({"_id": file_id, "metadata.orphaned_at": {"$lt": cutoff}})
+        if result.deleted_count:
+            await db["drawing_blobs.chunks"].delete_many({"files_id": file_id})
+
+async def migrate_inline_drawings(batch_size: int = 100) -> None:
+    """Move drawings stored as inline data URLs into blob storage"""
+    migrated = 0
+    while True:
+        batch = await db.drawings.find(
+            {"blob_id": {"$exists": False}},
+            projection={"_id": 1, "data_url": 1}
+        ).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
         
-    trusted_domains = [
-        "fonts.googleapis.com",
-        "fonts.gstatic.com",
-        "use.typekit.net",
-        "use.fontawesome.com"
-    ]
+        for drawing in batch:
+            decoded = decode_drawing_data(drawing.get("data_url") or "")
+            if decoded is None:
+                # Keep undecodable drawings inline, but stop picking them up
+                await db.drawings.update_one({"_id": drawing["_id"]}, {"$set": {"blob_id": None}})
+                continue
+            fields = await store_drawing(*decoded)
+            await db.drawings.update_one(
+                {"_id": drawing["_id"]},
+                {"$set": fields, "$unset": {"data_url": ""}}
+            )
+            migrated += 1
+        
+        if not await acquire_migration_lock("drawing_blobs"):
+            raise RuntimeError("Lost the migration lease")
+    
+    logger.info(f"Moved {migrated} inline drawings to blob storage")
+
+# Data retention
+#
+# Expiry is left to MongoDB TTL indexes, which delete a little at a time on
+# every TTL monitor pass instead of sweeping a whole range in one delete_many.
+# The indexes are reconciled at startup with the retention periods in
+# Settings, so changing a period only needs a restart.
+
+TTL_POLICIES = [
+    # collection, date field, seconds after that date, window used to backfill a missing expires_at
+    ("view_records", "timestamp", settings.DEVICE_IDENTIFIER_TTL_DAYS * 86400, None),
+    ("analytics", "timestamp", settings.ANALYTICS_RETENTION_DAYS * 86400, None),
+    ("analytics_daily", "day", settings.ANALYTICS_RETENTION_DAYS * 86400, None),
+    ("page_previews", "expires_at", 0, timedelta(minutes=settings.PREVIEW_EXPIRATION_MINUTES)),
+    ("pending_users", "expires_at", 0, timedelta(hours=settings.PENDING_REGISTRATION_EXPIRE_HOURS)),
+    ("verification", "expires_at", 0, timedelta(hours=1)),
+    ("password_reset", "expires_at", 0, timedelta(minutes=30)),
+    ("email_outbox", "sent_at", settings.EMAIL_OUTBOX_RETENTION_DAYS * 86400, None),
+    ("email_outbox", "failed_at", settings.EMAIL_OUTBOX_RETENTION_DAYS * 86400, None),
+    ("purge_jobs", "finished_at", 30 * 86400, None),
+]
+
+async def reconcile_ttl_index(collection_name: str, field: str, seconds: int) -> None:
+    """Create the TTL index on field, or change its expireAfterSeconds to match settings"""
+    collection = db[collection_name]
+    existing = next(
+        (
+            (name, info) for name, info in (await collection.index_information()).items()
+            if info["key"] == [(field, 1)]
+        ),
+        None
+    )
+    if existing is None:
+        await collection.create_index(field, expireAfterSeconds=seconds)
+        logger.info(f"Created TTL index on {collection_name}.{field} ({seconds}s)")
+        return
+    
+    name, info = existing
+    if info.get("expireAfterSeconds") == seconds:
+        return
+    try:
+        # collMod changes the period (or, on MongoDB 5.1+, adds one) without rebuilding the index
+        await db.command("collMod", collection_name, index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds})
+    except OperationFailure:
+        await collection.drop_index(name)
+        await collection.create_index(field, expireAfterSeconds=seconds)
+    logger.info(f"Changed TTL on {collection_name}.{field} from {info.get('expireAfterSeconds')} to {seconds}s")
+
+async def reconcile_ttl_indexes() -> bool:
+    results = await asyncio.gather(
+        *(reconcile_ttl_index(collection_name, field, seconds) for collection_name, field, seconds, _ in TTL_POLICIES),
+        return_exceptions=True
+    )
+    for (collection_name, field, _, _), result in zip(TTL_POLICIES, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error reconciling TTL index on {collection_name}.{field}: {str(result)}")
+    return not any(isinstance(result, Exception) for result in results)
+
+async def backfill_expires_at() -> None:
+    """Give documents written without expires_at one, so their TTL index can remove them"""
+    now = datetime.utcnow()
+    for collection_name, field, _, window in TTL_POLICIES:
+        if window is None:
+            continue
+        # TTL indexes skip documents whose field is missing or not a date
+        result = await db[collection_name].update_many(
+            {field: {"$not": {"$type": "date"}}},
+            [{"$set": {field: {"$add": [{"$ifNull": ["$created_at", now]}, int(window.total_seconds() * 1000)]}}}]
+        )
+        if result.modified_count:
+            logger.info(f"Backfilled {field} on {result.modified_count} {collection_name} documents")
+
+class RetentionMonitor(BackgroundWorker):
+    """Samples how far each TTL-managed collection lags behind its retention period"""
+
+    name = "retention monitor"
+
+    def __init__(self, interval: int = 600, overdue_cap: int = 1000):
+        super().__init__(interval)
+        self.overdue_cap = overdue_cap
+        self.samples: Dict[str, Dict[str, float]] = {}
+        self.ttl_status: Dict[str, int] = {}
+
+    async def sample(self) -> None:
+        now = datetime.utcnow()
+        for collection_name, field, seconds, _ in TTL_POLICIES:
+            oldest = await db[collection_name].find_one(
+                {field: {"$type": "date"}},
+                sort=[(field, 1)],
+                projection={field: 1}
+            )
+            # Documents past their expiry that the TTL monitor has not removed yet. Every
+            # worker samples, so the count walks at most overdue_cap entries of the TTL index
+            overdue = await db[collection_name].count_documents(
+                {field: {"$lt": now - timedelta(seconds=seconds)}},
+                limit=self.overdue_cap
+            )
+            # Keyed by field too, since a collection can expire through more than one
+            self.samples[f"{collection_name}.{field}"] = {
+                "collection": collection_name,
+                "field": field,
+                "retention_seconds": seconds,
+                "oldest_age_seconds": (now - oldest[field]).total_seconds() if oldest else 0.0,
+                "overdue_documents": overdue,
+                "documents": await db[collection_name].estimated_document_count()
+            }
+        try:
+            ttl = (await db.command("serverStatus")).get("metrics", {}).get("ttl", {})
+            self.ttl_status = {"passes": ttl.get("passes", 0), "deleted_documents": ttl.get("deletedDocuments", 0)}
+        except OperationFailure:
+            # serverStatus needs the clusterMonitor role
+            self.ttl_status = {}
+
+    async def step(self) -> None:
+        await self.sample()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"collections": self.samples, "ttl_monitor": self.ttl_status}
+
+retention_monitor = RetentionMonitor(interval=settings.RETENTION_SAMPLE_INTERVAL)
+
+# Index registry
+#
+# Every index is declared once here. Startup hashes the declarations,
+# including the TTL periods, and skips reconciliation entirely when
+# schema_migrations already records that hash. Otherwise each collection's
+# index_information is read concurrently and only the missing indexes are
+# built, one create_indexes call per collection. `python main.py
+# reconcile-indexes` runs the same step ahead of a deploy, and only it drops
+# and rebuilds an index whose unique or sparse flag changed; a worker that
+# finds one logs it and leaves the index alone.
+#
+# A failed reconciliation is recorded against the schema hash, and booting
+# workers skip it for INDEX_RETRY_INTERVAL instead of each running it again.
+
+INDEXES = [
+    # collection, keys, options
+    ("users", "email", {"unique": True}),
+    ("users", "username", {"unique": True, "sparse": True}),
+    ("users", "discord.discord_id", {}),
+    ("users", "discord.expires_at", {"sparse": True}),
+    ("users", "user_number", {}),
+    ("pending_users", "email", {"unique": True}),
+    ("pending_users", "user_number", {}),
+    ("profile_pages", "url", {"unique": True}),
+    ("profile_pages", "user_id", {}),
+    ("profile_pages", [("user_id", 1), ("page_id", 1)], {}),
+    ("views", "url", {"unique": True}),
+    ("templates", "id", {"unique": True}),
+    ("templates", "created_by", {}),
+    ("templates", "use_count", {}),
+    # Keyset pagination sorts, with id as the tie-breaker
+    ("templates", [("use_count", -1), ("id", -1)], {}),
+    ("templates", [("created_at", -1), ("id", -1)], {}),
+    ("templates", [("tags", 1), ("use_count", -1), ("id", -1)], {}),
+    ("templates", [("name", "text"), ("tags", "text"), ("description", "text")], {
+        "weights": {"name": 10, "tags": 5, "description": 1},
+        "name": "templates_text_search"
+    }),
+    ("verification", "token", {"unique": True}),
+    ("verification", "email", {}),
+    ("view_records", [("url", 1), ("device_hash", 1), ("timestamp", -1)], {}),
+    ("password_reset", "email", {}),
+    ("password_reset", "code", {}),
+    ("analytics", "page_id", {}),
+    ("analytics", "url", {}),
+    ("analytics", [("page_id", 1), ("timestamp", -1)], {}),
+    ("analytics", [("country_code", 1), ("page_id", 1)], {}),
+    ("analytics_daily", [("page_id", 1), ("day", 1)], {"unique": True}),
+    ("messages", "page_id", {}),
+    ("messages", "url", {}),
+    ("messages", "user_id", {}),
+    ("messages", [("page_id", 1), ("approved", 1)], {}),
+    ("messages", [("user_id", 1), ("approved", 1)], {}),
+    ("messages", [("user_id", 1), ("timestamp", -1), ("id", -1)], {}),
+    ("messages", [("user_id", 1), ("approved", 1), ("timestamp", -1), ("id", -1)], {}),
+    ("messages", "timestamp", {}),
+    ("drawings", "page_id", {}),
+    ("drawings", "url", {}),
+    ("drawings", "user_id", {}),
+    ("drawings", [("page_id", 1), ("approved", 1)], {}),
+    ("drawings", [("user_id", 1), ("approved", 1)], {}),
+    ("drawings", [("user_id", 1), ("timestamp", -1), ("id", -1)], {}),
+    ("drawings", [("user_id", 1), ("approved", 1), ("timestamp", -1), ("id", -1)], {}),
+    ("drawings", "timestamp", {}),
+    ("drawings", "id", {}),
+    ("drawings", "blob_id", {}),
+    ("drawing_blobs.files", "metadata.orphaned_at", {"sparse": True}),
+    ("email_outbox", [("status", 1), ("next_attempt_at", 1)], {}),
+    ("purge_jobs", [("status", 1), ("next_attempt_at", 1)], {}),
+]
+
+def index_schema_hash() -> str:
+    declared = [INDEXES, [(collection_name, field, seconds) for collection_name, field, seconds, _ in TTL_POLICIES]]
+    return hashlib.sha256(json.dumps(declared, sort_keys=True).encode()).hexdigest()
+
+async def reconcile_collection_indexes(collection_name: str, specs: List[tuple], rebuild: bool = False) -> int:
+    """Build the declared indexes missing from one collection and return how many were built
+    
+    Indexes whose unique or sparse flag changed are only dropped and rebuilt
+    with rebuild; otherwise they are reported as an error once the missing
+    ones are built.
+    """
+    collection = db[collection_name]
+    existing = await collection.index_information()
+    missing = []
+    mismatched = []
+    for keys, options in specs:
+        keys = [(keys, 1)] if isinstance(keys, str) else keys
+        # Text indexes report internal keys, so they are matched by name
+        name = options.get("name")
+        index_name, info = next(
+            ((index_name, info) for index_name, info in existing.items()
+             if (index_name == name if name else info["key"] == keys)),
+            (None, None)
+        )
+        if info is not None:
+            if all(bool(info.get(flag)) == bool(options.get(flag)) for flag in ("unique", "sparse")):
+                continue
+            if not rebuild:
+                mismatched.append(index_name)
+                continue
+            logger.info(f"Dropping index {index_name} on {collection_name} to recreate it with {options}")
+            await collection.drop_index(index_name)
+        missing.append(IndexModel(keys, **options))
+    
+    if missing:
+        await collection.create_indexes(missing)
+        logger.info(f"Created {len(missing)} indexes on {collection_name}")
+    if mismatched:
+        raise RuntimeError(
+            f"Indexes {', '.join(mismatched)} changed unique or sparse options; "
+            "run `python main.py reconcile-indexes` to rebuild them"
+        )
+    return len(missing)
+
+async def reconcile_indexes(rebuild: bool = False) -> bool:
+    specs: Dict[str, List[tuple]] = {}
+    for collection_name, keys, options in INDEXES:
+        specs.setdefault(collection_name, []).append((keys, options))
+    
+    results = await asyncio.gather(
+        *(reconcile_collection_indexes(collection_name, collection_specs, rebuild)
+          for collection_name, collection_specs in specs.items()),
+        return_exceptions=True
+    )
+    for collection_name, result in zip(specs, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error reconciling indexes on {collection_name}: {str(result)}")
+    ttl_ok = await reconcile_ttl_indexes()
+    return ttl_ok and not any(isinstance(result, Exception) for result in results)
+
+async def renew_migration_lock(name: str, every: int = 60) -> None:
+    """Keep extending a migration lease while a long step runs; cancel when done"""
+    while True:
+        await asyncio.sleep(every)
+        await acquire_migration_lock(name)
+
+async def ensure_indexes(force: bool = False, wait_timeout: int = 300) -> bool:
+    """Reconcile indexes unless schema_migrations records the current declarations
     
-    try:
-        # Check if it's a valid link format
-        if not font_link.startswith("<link") or "rel='stylesheet'" not in font_link and 'rel="stylesheet"' not in font_link:
-            url_validation_cache[cache_key] = False
-            return False
-            
-        # Extract href value
-        import re
-        href_match = re.search(r'href=[\'"]([^\'"]+)[\'"]', font_link)
-        if not href_match:
-            url_validation_cache[cache_key] = False
+    Workers that do not get the lock wait for the one that did, so none serves
+    requests before the unique indexes exist. force is the reconcile-indexes
+    command: it runs even when the hash matches or a recent attempt failed, and
+    rebuilds indexes whose options changed.
+    """
+    schema_hash = index_schema_hash()
+    deadline = time.monotonic() + wait_timeout
+    while True:
+        state = await db.schema_migrations.find_one({"_id": "indexes"}) or {}
+        if state.get("hash") == schema_hash and not force:
+            logger.info("Indexes match the recorded schema, skipping reconciliation")
+            return True
+        if (
+            not force and state.get("failed_hash") == schema_hash
+            and state["failed_at"] > datetime.utcnow() - timedelta(seconds=settings.INDEX_RETRY_INTERVAL)
+        ):
+            logger.error(
+                f"Index reconciliation for this schema failed at {state['failed_at']}, "
+                "skipping it; run `python main.py reconcile-indexes` to retry now"
+            )
             return False
-            
-        font_url = href_match.group(1)
         
-        # Check if from trusted domain
-        from urllib.parse import urlparse
-        parsed_url = urlparse(font_url)
-        domain = parsed_url.netloc
+        if await acquire_migration_lock("indexes"):
+            logger.info("Reconciling database indexes...")
+            started = time.perf_counter()
+            heartbeat = asyncio.create_task(renew_migration_lock("indexes"))
+            try:
+                reconciled = await reconcile_indexes(rebuild=force)
+                if reconciled:
+                    update = {
+                        "$set": {"hash": schema_hash, "applied_at": datetime.utcnow()},
+                        "$unset": {"failed_hash": "", "failed_at": ""}
+                    }
+                else:
+                    # Workers waiting on the lock and the next ones to boot back off until the retry interval passes
+                    update = {"$set": {"failed_hash": schema_hash, "failed_at": datetime.utcnow()}}
+                await db.schema_migrations.update_one({"_id": "indexes"}, update, upsert=True)
+            finally:
+                heartbeat.cancel()
+                await db.schema_migrations.delete_one({"_id": "indexes:lock", "owner": WORKER_ID})
+            logger.info(f"Index reconciliation finished in {time.perf_counter() - started:.2f}s")
+            return reconciled
         
-        result = any(domain == trusted for trusted in trusted_domains)
-        url_validation_cache[cache_key] = result
-        return result
-    except Exception as e:
-        logger.error(f"Error validating font link: {str(e)}")
-        return False
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Another worker held the index lock for over {wait_timeout}s")
+        logger.info("Waiting for another worker to reconcile indexes...")
+        await asyncio.sleep(1)
+
+# Background purges
+#
+# Deleting an account or pages removes the user-facing documents right away
+# and queues a purge job for everything that hangs off them. A worker
+# deletes each step's documents in bounded batches with a pause between
+# batches, so a popular page's analytics never land in one huge delete.
+# Jobs record their progress and hold a lease, so a job interrupted by a
+# restart is picked up again by the next worker to poll.
+#
+# A dropped page's URL can be claimed again right away, so URL-keyed data is
+# bounded by the time the job was queued: the single views document goes with
+# the page in drop_pages, and only view_records written before the job are
+# purged.
+
+PAGE_DATA_STEPS = [
+    ("analytics", "page_id"),
+    ("analytics_daily", "page_id"),
+    ("messages", "page_id"),
+    ("drawings", "page_id"),
+    ("view_records", "url"),
+]
+
+def page_purge_steps(pages: List[Dict[str, Any]], collections: Optional[Set[str]] = None) -> List[tuple]:
+    """(collection, field, values[, (date field, cutoff)]) steps removing the data of the given pages"""
+    page_ids = [page["page_id"] for page in pages]
+    urls = [page["url"] for page in pages]
+    queued_at = datetime.utcnow()
+    return [
+        (collection, field, page_ids) if field == "page_id" else (collection, field, urls, ("timestamp", queued_at))
+        for collection, field in PAGE_DATA_STEPS
+        if collections is None or collection in collections
+    ]
 
-async def validate_drawing_data(data_url: str) -> bool:
-    """Validate if the drawing data URL is valid and not too large"""
-    if not data_url.startswith("data:image/"):
-        return False
-    
-    try:
-        # Extract the base64 data
-        header, encoded = data_url.split(",", 1)
-        # Check the size of the decoded data
-        decoded_size = len(base64.b64decode(encoded))
+def purge_step(collection: str, field: str, values: List[Any], before: Optional[tuple] = None) -> Dict[str, Any]:
+    # Stored as field and values because older servers reject $-prefixed keys in documents
+    step = {"collection": collection, "field": field, "values": values}
+    if before is not None:
+        step["before_field"], step["before"] = before
+    return step
+
+def purge_step_query(step: Dict[str, Any]) -> Dict[str, Any]:
+    query = {step["field"]: {"$in": step["values"]}}
+    if step.get("before_field"):
+        query[step["before_field"]] = {"$lt": step["before"]}
+    return query
+
+class PurgeEngine(BackgroundWorker):
+    """Resumable, throttled deletion of the data left behind by deleted accounts and pages"""
+
+    name = "purge worker"
+
+    def __init__(
+        self,
+        batch_size: int = 500,
+        batch_delay: float = 0.1,
+        poll_interval: int = 30,
+        max_attempts: int = 10,
+        lease_seconds: int = 300
+    ):
+        super().__init__(poll_interval)
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.completed = 0
+        self.failed = 0
+        self.deleted = 0
+
+    async def enqueue(self, kind: str, user_id: str, steps: List[tuple]) -> str:
+        now = datetime.utcnow()
+        result = await db.purge_jobs.insert_one({
+            "kind": kind,
+            "user_id": user_id,
+            "steps": [purge_step(*step) for step in steps],
+            "step": 0,
+            "deleted": {},
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now
+        })
+        self.wakeup.set()
+        return str(result.inserted_id)
+
+    async def claim(self) -> Optional[Dict[str, Any]]:
+        now = datetime.utcnow()
+        return await db.purge_jobs.find_one_and_update(
+            {
+                "$or": [
+                    {"status": "pending", "next_attempt_at": {"$lte": now}},
+                    {"status": "running", "lease_until": {"$lt": now}}
+                ]
+            },
+            {"$set": {
+                "status": "running",
+                "lease_until": now + timedelta(seconds=self.lease_seconds),
+                "owner": WORKER_ID
+            }},
+            sort=[("created_at", 1)],
+            return_document=True
+        )
+
+    async def delete_batch(self, collection: str, query: Dict[str, Any]) -> int:
+        # Batches are picked through the step's own index and deleted by _id,
+        # which bounds each delete without a sort over every matching document
+        ids = [doc["_id"] for doc in await db[collection].find(query, projection={"_id": 1}).limit(self.batch_size).to_list(self.batch_size)]
+        if not ids:
+            return 0
+        if collection == "drawings":
+            await delete_drawings({"_id": {"$in": ids}})
+        else:
+            await db[collection].delete_many({"_id": {"$in": ids}})
+        return len(ids)
+
+    async def run_job(self, job: Dict[str, Any]) -> None:
+        steps = job["steps"]
+        step = job.get("step", 0)
+        while step < len(steps):
+            collection = steps[step]["collection"]
+            deleted = await self.delete_batch(collection, purge_step_query(steps[step]))
+            self.deleted += deleted
+            now = datetime.utcnow()
+            update = {"$set": {"lease_until": now + timedelta(seconds=self.lease_seconds)}}
+            if deleted:
+                update["$inc"] = {f"deleted.{collection}": deleted}
+            if deleted < self.batch_size:
+                step += 1
+                update["$set"]["step"] = step
+            # Checkpoint, and stop if another worker took the job over after our lease ran out
+            result = await db.purge_jobs.update_one({"_id": job["_id"], "owner": WORKER_ID}, update)
+            if not result.matched_count:
+                raise RuntimeError("Lost the purge job lease")
+            await asyncio.sleep(self.batch_delay)
         
-        return decoded_size <= settings.MAX_DRAWING_SIZE
-    except Exception as e:
-        logger.error(f"Error validating drawing data: {str(e)}")
-        return False
+        if any(entry["collection"] == "templates" for entry in steps):
+            await invalidate_template_lists()
+
+    async def process_job(self, job: Dict[str, Any]) -> None:
+        try:
+            await self.run_job(job)
+        except Exception as e:
+            attempts = job.get("attempts", 0) + 1
+            if attempts >= self.max_attempts:
+                self.failed += 1
+                logger.error(f"Giving up on purge job {job['_id']} after {attempts} attempts: {str(e)}")
+                update = {"status": "failed", "attempts": attempts, "last_error": str(e), "finished_at": datetime.utcnow()}
+            else:
+                delay = min(30 * 2 ** (attempts - 1), 3600)
+                logger.warning(f"Purge job {job['_id']} failed (attempt {attempts}), retrying in {delay}s: {str(e)}")
+                update = {
+                    "status": "pending",
+                    "attempts": attempts,
+                    "last_error": str(e),
+                    "next_attempt_at": datetime.utcnow() + timedelta(seconds=delay)
+                }
+            await db.purge_jobs.update_one(
+                {"_id": job["_id"], "owner": WORKER_ID},
+                {"$set": update, "$unset": {"lease_until": "", "owner": ""}}
+            )
+            return
+        
+        self.completed += 1
+        logger.info(f"Purge job {job['_id']} ({job['kind']}) complete")
+        await db.purge_jobs.update_one(
+            {"_id": job["_id"], "owner": WORKER_ID},
+            {"$set": {"status": "done", "finished_at": datetime.utcnow()}, "$unset": {"lease_until": "", "owner": ""}}
+        )
 
-async def cleanup_old_view_records():
-    cutoff_date = datetime.utcnow() - timedelta(days=settings.DEVICE_IDENTIFIER_TTL_DAYS)
-    await db.view_records.delete_many({"timestamp": {"$lt": cutoff_date}})
-    logger.info(f"Cleaned up view records older than {cutoff_date}")
+    async def process(self) -> None:
+        while True:
+            job = await self.claim()
+            if job is None:
+                return
+            await self.process_job(job)
 
-async def cleanup_expired_previews():
-    """Cleanup function to remove expired preview pages"""
-    expired_time = datetime.utcnow()
-    result = await db.page_previews.delete_many({
-        "expires_at": {"$lt": expired_time}
-    })
-    if result.deleted_count > 0:
-        logger.info(f"Cleaned up {result.deleted_count} expired preview pages")
+    async def step(self) -> None:
+        await self.process()
 
-async def cleanup_expired_registrations():
-    """Cleanup function to remove expired pending registrations"""
-    result = await db.pending_users.delete_many({
-        "expires_at": {"$lt": datetime.utcnow()}
-    })
-    if result.deleted_count > 0:
-        logger.info(f"Cleaned up {result.deleted_count} expired pending registrations")
-    
-    await db.verification.delete_many({
-        "expires_at": {"$lt": datetime.utcnow()}
-    })
+    def stats(self) -> Dict[str, int]:
+        return {
+            "completed": self.completed,
+            "failed": self.failed,
+            "deleted": self.deleted
+        }
 
-# New cleanup function for analytics data
-async def cleanup_old_analytics():
-    """Cleanup function to remove old analytics data"""
-    cutoff_date = datetime.utcnow() - timedelta(days=settings.ANALYTICS_RETENTION_DAYS)
-    result = await db.analytics.delete_many({
-        "timestamp": {"$lt": cutoff_date}
-    })
-    if result.deleted_count > 0:
-        logger.info(f"Cleaned up {result.deleted_count} old analytics records")
+purge_engine = PurgeEngine(
+    batch_size=settings.PURGE_BATCH_SIZE,
+    batch_delay=settings.PURGE_BATCH_DELAY_MS / 1000,
+    poll_interval=settings.PURGE_POLL_INTERVAL
+)
+
+async def drop_pages(user_id: str, pages: List[Dict[str, Any]]) -> None:
+    """Delete page documents, their view counters and cached copies; enqueue their purge job first"""
+    if not pages:
+        return
+    urls = [page["url"] for page in pages]
+    await db.profile_pages.delete_many({"page_id": {"$in": [page["page_id"] for page in pages]}})
+    # One document per URL, removed now so a page claiming the URL starts from zero
+    await db.views.delete_many({"url": {"$in": urls}})
+    for page in pages:
+        await invalidate_public_page(page["url"])
+        await discard_page_views(page["url"])
+    await invalidate_user_page_list(user_id)
 
 # Endpoints
 
@@ -1131,7 +3481,18 @@ async def health_check(request: Request):
         return {
             "status": "healthy",
             "timestamp": datetime.utcnow(),
-            "environment": settings.ENVIRONMENT
+            "environment": settings.ENVIRONMENT,
+            "password_hashing": password_hasher.stats(),
+            "email_outbox": email_outbox.stats(),
+            "http_clients": http_clients.stats(),
+            "cache_bus": cache_bus.stats(),
+            "caches": {"user": user_cache.stats(), "template": template_cache.stats()},
+            "media_validation": media_validator.stats(),
+            "user_numbers": user_numbers.stats(),
+            "retention": retention_monitor.stats(),
+            "view_buffer": view_buffer.stats(),
+            "purges": purge_engine.stats(),
+            "discord_refresh": discord_refresher.stats()
         }
     except Exception as e:
         logger.error(f"Health check failed: {str(e)}")
@@ -1140,11 +3501,61 @@ async def health_check(request: Request):
             detail="Service unhealthy"
         )
 
+def collect_cache_metrics():
+    caches = [(cache.name, cache.hits, cache.misses, len(cache)) for cache in metered_caches]
+    caches += [(name, cache.hits, cache.misses, len(cache.cache)) for name, cache in (("user", user_cache), ("template", template_cache))]
+    caches.append(("media_validation", media_validator.cache_hits, media_validator.probes, len(media_validator.valid) + len(media_validator.invalid)))
+    for name, hits, misses, size in caches:
+        yield "cache_lookups_total", {"cache": name, "result": "hit"}, hits
+        yield "cache_lookups_total", {"cache": name, "result": "miss"}, misses
+        yield "cache_entries", {"cache": name}, size
+
+def collect_http_client_metrics():
+    for upstream, counters in http_clients.stats().items():
+        yield "http_client_requests_total", {"upstream": upstream}, counters["requests"]
+        yield "http_client_connections_total", {"upstream": upstream}, counters["connections"]
+        yield "http_client_errors_total", {"upstream": upstream}, counters["errors"]
+
+def collect_retention_metrics():
+    for sample in retention_monitor.samples.values():
+        labels = {"collection": sample["collection"], "field": sample["field"]}
+        yield "retention_period_seconds", labels, sample["retention_seconds"]
+        yield "retention_oldest_age_seconds", labels, sample["oldest_age_seconds"]
+        yield "retention_overdue_documents", labels, sample["overdue_documents"]
+        yield "retention_documents", labels, sample["documents"]
+    if retention_monitor.ttl_status:
+        yield "mongodb_ttl_passes_total", {}, retention_monitor.ttl_status["passes"]
+        yield "mongodb_ttl_deleted_documents_total", {}, retention_monitor.ttl_status["deleted_documents"]
+
+def collect_view_buffer_metrics():
+    for kind, count in (("analytics", len(view_buffer.analytics)), ("view_records", len(view_buffer.view_records)), ("rollups", len(view_buffer.unrolled))):
+        yield "view_buffer_pending", {"kind": kind}, count
+    for kind, count in view_buffer.dropped.items():
+        yield "view_buffer_dropped_total", {"kind": kind}, count
+
+metrics.add_collector(collect_cache_metrics)
+metrics.add_collector(collect_http_client_metrics)
+metrics.add_collector(collect_retention_metrics)
+metrics.add_collector(collect_view_buffer_metrics)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint(request: Request):
+    """Prometheus scrape endpoint for this worker"""
+    # Route traffic and database timings are not public, so no token means no endpoint
+    if not settings.METRICS_ENABLED or not settings.METRICS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+    supplied = request.headers.get("authorization", "").encode()
+    if not secrets.compare_digest(supplied, f"Bearer {settings.METRICS_TOKEN}".encode()):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid metrics token"
+        )
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/register", response_model=UserResponse)
 @limiter.limit("5/minute")
 async def register_user(
     request: Request,
-    background_tasks: BackgroundTasks,
     email: str = Body(...),
     password: str = Body(...),
     username: Optional[str] = Body(None),
@@ -1160,8 +3571,6 @@ async def register_user(
             detail=str(ve)
         )
     
-    user_number = await get_next_user_number(db)
-    
     # Check if email is already registered
     existing_user = await db.users.find_one({"email": user.email}, projection={"_id": 1})
     if existing_user:
@@ -1194,6 +3603,7 @@ async def register_user(
                 }
             )
     
+    user_number = await user_numbers.allocate()
     user_id = str(user_number)
     
     verification_token = secrets.token_urlsafe(32)
@@ -1205,7 +3615,7 @@ async def register_user(
         "email": user.email,
         "username": user.username,  # This will be null if not provided
         "name": user.name,
-        "hashed_password": get_password_hash(user.password),
+        "hashed_password": await get_password_hash(user.password),
         "created_at": datetime.utcnow(),
         "expires_at": datetime.utcnow() + timedelta(hours=1),
         "tags": [],
@@ -1379,8 +3789,7 @@ async def register_user(
         "expires_at": datetime.utcnow() + timedelta(hours=1)
     })
     
-    background_tasks.add_task(
-        send_email_async,
+    await send_email_async(
         user.email,
         "Verify Your Email",
         verification_email
@@ -1452,25 +3861,31 @@ async def change_password(
         )
     
     # Verify current password
-    if not await verify_password(current_password, current_user["hashed_password"]):
+    user = await load_full_user(current_user)
+    if not await verify_password(current_password, user["hashed_password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Current password is incorrect"
         )
     
     # Update password
-    hashed_password = get_password_hash(new_password)
-    await db.users.update_one(
+    hashed_password = await get_password_hash(new_password)
+    # Bumping token_version signs out every other session
+    user = await db.users.find_one_and_update(
         {"id": current_user["id"]},
-        {"$set": {"hashed_password": hashed_password}}
+        {"$set": {"hashed_password": hashed_password}, "$inc": {"token_version": 1}},
+        projection={"email": 1, "token_version": 1},
+        return_document=True
     )
     
     # Clear cache
-    await user_cache.delete(f"user:{current_user['email']}")
-    if current_user.get("username"):
-        await user_cache.delete(f"username:{current_user['username']}")
+    await invalidate_user_cache(current_user["email"], current_user.get("username"))
     
-    return {"message": "Password changed successfully"}
+    return {
+        "message": "Password changed successfully",
+        "access_token": create_user_token(user),
+        "token_type": "bearer"
+    }
 
 
 @app.get("/search-templates")
@@ -1479,61 +3894,58 @@ async def search_templates(
     request: Request,
     q: str = Query(..., min_length=2, description="Search query"),
     page: int = Query(1, ge=1),
-    limit: int = Query(10, ge=1, le=50)
+    limit: int = Query(10, ge=1, le=50),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page; replaces page")
 ):
     """Search for templates by name, description, or tags"""
-    # Create text search query
-    search_query = {
-        "$or": [
-            {"name": {"$regex": q, "$options": "i"}},
-            {"description": {"$regex": q, "$options": "i"}},
-            {"tags": {"$regex": q, "$options": "i"}}
-        ]
-    }
-    
-    # Calculate skip
-    skip = (page - 1) * limit
-    
-    # Query templates
-    templates = []
-    cursor = db.templates.find(search_query).sort("use_count", -1).skip(skip).limit(limit)
+    sort_params = [("search_score", -1), ("use_count", -1), ("_id", 1)]
+    
+    # Rank by text relevance, boosted logarithmically by popularity so heavily
+    # used templates rise without burying better matches
+    text_match = {"$text": {"$search": q}}
+    pipeline = [
+        {"$match": text_match},
+        {"$addFields": {"search_score": {"$multiply": [
+            {"$meta": "textScore"},
+            {"$add": [1, {"$log10": {"$add": [{"$ifNull": ["$use_count", 0]}, 1]}}]}
+        ]}}}
+    ]
+    # Continue after the last result when a cursor is given, cutting the matches
+    # down before the sort so deep pages only sort what is left; otherwise skip to the page
+    if cursor:
+        pipeline.append({"$match": keyset_filter(sort_params, decode_cursor(cursor, len(sort_params)))})
+    pipeline.append({"$sort": dict(sort_params)})
+    if not cursor:
+        pipeline.append({"$skip": (page - 1) * limit})
+    pipeline.append({"$limit": limit})
+    
+    rows, total_count = await asyncio.gather(
+        db.templates.aggregate(pipeline).to_list(limit),
+        db.templates.count_documents(text_match)
+    )
+    continuation = next_cursor(rows, sort_params, limit)
+    for row in rows:
+        row.pop("search_score", None)
     
-    # Process templates and add username
-    async for template in cursor:
-        # Get username of template creator
-        user = await db.users.find_one(
-            {"id": template["created_by"]}, 
-            projection={"username": 1}
-        )
-        username = user.get("username") if user else None
-        
-        # Format template
-        template["id"] = str(template["id"])
-        if "_id" in template:
-            template["_id"] = str(template["_id"])
-        
-        templates.append({
-            **template,
-            "created_by_username": username
-        })
+    # Add creator usernames
+    templates = await with_creator_usernames(rows)
     
-    # Get total count for pagination
-    total_count = await db.templates.count_documents(search_query)
     total_pages = (total_count + limit - 1) // limit
     
     return {
         "templates": templates,
         "total": total_count,
-        "page": page,
+        # Cursor requests are not numbered pages
+        "page": None if cursor else page,
         "limit": limit,
-        "total_pages": total_pages
+        "total_pages": total_pages,
+        "next_cursor": continuation
     }
 
 @app.post("/resend-verification")
 @limiter.limit(RateLimits.AUTH_LIMIT)
 async def resend_verification_email(
     request: Request,
-    background_tasks: BackgroundTasks,
     data: dict = Body(...)
 ):
     """Resend verification email to user"""
@@ -1686,8 +4098,7 @@ async def resend_verification_email(
     </html>
     """
     
-    background_tasks.add_task(
-        send_email_async,
+    await send_email_async(
         email,
         "Verify Your Email",
         verification_email
@@ -1727,7 +4138,7 @@ async def verify_email(request: Request, token: str):
                     {"$set": {"is_verified": True}}
                 )
                 await db.verification.delete_one({"token": token})
-                await user_cache.delete(f"user:{verification['email']}")
+                await invalidate_user_cache(verification["email"])
                 
                 return JSONResponse(
                     status_code=status.HTTP_200_OK,
@@ -1813,7 +4224,7 @@ async def verify_email(request: Request, token: str):
         # Clean up pending user and verification records
         await db.pending_users.delete_one({"email": verification["email"]})
         await db.verification.delete_one({"token": token})
-        await user_cache.delete(f"user:{verification['email']}")
+        await invalidate_user_cache(verification["email"])
         
         return JSONResponse(
             status_code=status.HTTP_200_OK,
@@ -1845,10 +4256,7 @@ async def login_for_access_token(request: Request, form_data: OAuth2PasswordRequ
             )
         
         access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": user["email"]},
-            expires_delta=access_token_expires
-        )
+        access_token = create_user_token(user, expires_delta=access_token_expires)
         
         # Count pages
         page_count = await db.profile_pages.count_documents({"user_id": user["id"]})
@@ -1928,6 +4336,8 @@ async def login_for_access_token(request: Request, form_data: OAuth2PasswordRequ
             "gender": user.get("gender"),
             "pronouns": user.get("pronouns")
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Login error: {str(e)}")
         return JSONResponse(
@@ -1939,12 +4349,11 @@ async def login_for_access_token(request: Request, form_data: OAuth2PasswordRequ
 @limiter.limit(RateLimits.AUTH_LIMIT)
 async def request_password_reset(
     request: Request,
-    background_tasks: BackgroundTasks,
     reset_request: UserPasswordReset
 ):
     # Don't reveal if the user exists or not to prevent enumeration attacks
     user = await db.users.find_one(
-        {"email": reset_request.email},
+        {"email": reset_request.email, "deleted_at": {"$exists": False}},
         projection={"_id": 1, "is_verified": 1}
     )
     
@@ -2060,8 +4469,7 @@ async def request_password_reset(
         </html>
         """
         
-        background_tasks.add_task(
-            send_email_async,
+        await send_email_async(
             reset_request.email,
             "Password Reset Request",
             reset_email
@@ -2093,13 +4501,14 @@ async def reset_password(request: Request, reset_data: UserPasswordChange):
         {"$set": {"used": True}}
     )
     
-    hashed_password = get_password_hash(reset_data.new_password)
-    await db.users.update_one(
+    hashed_password = await get_password_hash(reset_data.new_password)
+    user = await db.users.find_one_and_update(
         {"email": reset_data.email},
-        {"$set": {"hashed_password": hashed_password}}
+        {"$set": {"hashed_password": hashed_password}, "$inc": {"token_version": 1}},
+        projection={"username": 1}
     )
     
-    await user_cache.delete(f"user:{reset_data.email}")
+    await invalidate_user_cache(reset_data.email, user.get("username") if user else None)
     
     return {"message": "Password reset successfully"}
 
@@ -2262,11 +4671,9 @@ async def complete_onboarding(
             )
     
     # Validate avatar URL if provided
-    if onboarding_data.avatar_url and not await validate_avatar(onboarding_data.avatar_url):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid avatar URL or file too large (max 1MB)"
-        )
+    await media_validator.validate([
+        ("avatar", onboarding_data.avatar_url, "Invalid avatar URL or file too large (max 1MB)")
+    ])
     
     # Calculate age from date of birth if provided
     age = None
@@ -2386,9 +4793,8 @@ async def complete_onboarding(
         })
         
     # Clear cache
-    await user_cache.delete(f"user:{current_user['email']}")
-    if current_user.get("username"):
-        await user_cache.delete(f"username:{current_user['username']}")
+    await invalidate_user_public_pages(current_user["id"])
+    await invalidate_user_cache(current_user["email"], current_user.get("username"))
     
     # Get updated user
     updated_user = await db.users.find_one({"id": current_user["id"]})
@@ -2467,34 +4873,8 @@ async def create_profile_page(
             detail="URL already taken"
         )
     
-    # Validate avatar URL if provided
-    if page_data.avatar_url and not await validate_avatar(page_data.avatar_url):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid avatar URL or file too large (max 1MB)"
-        )
-        
-    # Validate avatar decoration if provided
-    if page_data.avatar_decoration and not await validate_decoration(page_data.avatar_decoration):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid avatar decoration URL"
-        )
-        
-    # Validate custom fonts if provided
-    if page_data.name_style and page_data.name_style.font and page_data.name_style.font.link:
-        if not await validate_font(page_data.name_style.font.link):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid font link for name"
-            )
-            
-    if page_data.username_style and page_data.username_style.font and page_data.username_style.font.link:
-        if not await validate_font(page_data.username_style.font.link):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid font link for username"
-            )
+    # Validate avatar, decoration and custom fonts concurrently
+    await media_validator.validate(page_media_checks(page_data))
     
     # Generate page ID
     page_id = str(ObjectId())
@@ -2517,6 +4897,7 @@ async def create_profile_page(
     
     # Insert page
     await db.profile_pages.insert_one(page_dict)
+    await invalidate_user_page_list(current_user["id"])
     
     return {**page_data.dict(), "page_id": page_id}
 
@@ -2579,34 +4960,8 @@ async def update_profile_page(
             detail="Page not found or you don't have permission to update it"
         )
     
-    # Validate avatar URL if provided
-    if page_update.avatar_url and not await validate_avatar(page_update.avatar_url):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid avatar URL or file too large (max 1MB)"
-        )
-        
-    # Validate avatar decoration if provided
-    if page_update.avatar_decoration and not await validate_decoration(page_update.avatar_decoration):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid avatar decoration URL"
-        )
-        
-    # Validate custom fonts if provided
-    if page_update.name_style and page_update.name_style.font and page_update.name_style.font.link:
-        if not await validate_font(page_update.name_style.font.link):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid font link for name"
-            )
-            
-    if page_update.username_style and page_update.username_style.font and page_update.username_style.font.link:
-        if not await validate_font(page_update.username_style.font.link):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid font link for username"
-            )
+    # Validate avatar, decoration and custom fonts concurrently
+    await media_validator.validate(page_media_checks(page_update))
     
     # Validate timezone if provided
     if page_update.timezone and page_update.timezone not in settings.TIMEZONES:
@@ -2626,11 +4981,13 @@ async def update_profile_page(
                 detail="URL already taken"
             )
         
-        # Update views collection with new URL
+        # Update views collection with new URL, and send views every worker still
+        # has queued for the old URL after it
         await db.views.update_one(
             {"url": existing_page["url"]},
             {"$set": {"url": update_data["url"]}}
         )
+        await rename_page_views(existing_page["url"], update_data["url"])
         
         # Update analytics to point to the new URL
         await db.analytics.update_many(
@@ -2655,6 +5012,10 @@ async def update_profile_page(
         {"page_id": page_id},
         {"$set": {**update_data, "updated_at": datetime.utcnow()}}
     )
+    await invalidate_public_page(existing_page["url"])
+    if "url" in update_data:
+        await invalidate_public_page(update_data["url"])
+    await invalidate_user_page_list(current_user["id"])
     
     # Get updated page
     updated_page = await db.profile_pages.find_one({"page_id": page_id})
@@ -2696,8 +5057,7 @@ async def get_page_analytics(
     url = page["url"]
     
     # Get total views
-    views_doc = await db.views.find_one({"url": url})
-    total_views = views_doc["views"] if views_doc else 0
+    total_views = await get_page_views(db, url)
     
     # Prepare analytics response
     analytics_response = {
@@ -2705,73 +5065,48 @@ async def get_page_analytics(
         "countries": {},
         "daily_views": {},
         "hourly_distribution": {},
+        "devices": {},
+        "browsers": {},
+        "referrers": {},
         "recent_views": []
     }
     
     # Get analytics data if available
     if total_views > 0:
+        # Sum the per-day rollups over the retention window
+        end_date = datetime.utcnow()
+        retention_start = end_date - timedelta(days=settings.ANALYTICS_RETENTION_DAYS)
+        daily_start = datetime(end_date.year, end_date.month, end_date.day) - timedelta(days=30)
+        show_time_data = page.get("analytics_config", {}).get("show_time_data", True)
+        
+        totals = {field: {} for field in ROLLUP_COUNTER_FIELDS}
+        async for rollup in db.analytics_daily.find(
+            {"page_id": page_id, "day": {"$gte": retention_start}}
+        ).sort("day", 1):
+            for field in ROLLUP_COUNTER_FIELDS:
+                for key, count in rollup.get(field, {}).items():
+                    totals[field][key] = totals[field].get(key, 0) + count
+            
+            if show_time_data and rollup["day"] >= daily_start:
+                analytics_response["daily_views"][rollup["day"].strftime("%Y-%m-%d")] = rollup.get("total", 0)
+        
         # Get country data if enabled
         if page.get("analytics_config", {}).get("show_country_data", True):
-            # Aggregate views by country
-            country_pipeline = [
-                {"$match": {"page_id": page_id}},
-                {"$group": {
-                    "_id": {"country_code": "$country_code", "country_name": "$country_name"},
-                    "count": {"$sum": 1}
-                }},
-                {"$sort": {"count": -1}},
-                {"$limit": 10}  # Top 10 countries
-            ]
-            
-            country_cursor = db.analytics.aggregate(country_pipeline)
-            async for country in country_cursor:
-                country_code = country["_id"]["country_code"]
-                country_name = country["_id"]["country_name"]
-                if country_code and country_name:
-                    analytics_response["countries"][f"{country_code}:{country_name}"] = country["count"]
+            # Top 10 countries
+            top_countries = sorted(totals["countries"].items(), key=lambda item: item[1], reverse=True)[:10]
+            for key, count in top_countries:
+                analytics_response["countries"][decode_rollup_key(key)] = count
         
         # Get time data if enabled
-        if page.get("analytics_config", {}).get("show_time_data", True):
-            # Calculate date range (last 30 days)
-            end_date = datetime.utcnow()
-            start_date = end_date - timedelta(days=30)
-            
-            # Aggregate views by day
-            daily_pipeline = [
-                {"$match": {
-                    "page_id": page_id,
-                    "timestamp": {"$gte": start_date, "$lte": end_date}
-                }},
-                {"$group": {
-                    "_id": {
-                        "year": {"$year": "$timestamp"},
-                        "month": {"$month": "$timestamp"},
-                        "day": {"$dayOfMonth": "$timestamp"}
-                    },
-                    "count": {"$sum": 1}
-                }},
-                {"$sort": {"_id.year": 1, "_id.month": 1, "_id.day": 1}}
-            ]
-            
-            daily_cursor = db.analytics.aggregate(daily_pipeline)
-            async for day in daily_cursor:
-                date_str = f"{day['_id']['year']}-{day['_id']['month']:02d}-{day['_id']['day']:02d}"
-                analytics_response["daily_views"][date_str] = day["count"]
-            
-            # Aggregate views by hour
-            hourly_pipeline = [
-                {"$match": {"page_id": page_id}},
-                {"$group": {
-                    "_id": {"hour": {"$hour": "$timestamp"}},
-                    "count": {"$sum": 1}
-                }},
-                {"$sort": {"_id.hour": 1}}
-            ]
-            
-            hourly_cursor = db.analytics.aggregate(hourly_pipeline)
-            async for hour in hourly_cursor:
-                hour_str = f"{hour['_id']['hour']:02d}:00"
-                analytics_response["hourly_distribution"][hour_str] = hour["count"]
+        if show_time_data:
+            for hour in sorted(totals["hours"]):
+                analytics_response["hourly_distribution"][f"{hour}:00"] = totals["hours"][hour]
+        
+        for field in ["devices", "browsers", "referrers"]:
+            analytics_response[field] = {
+                decode_rollup_key(key): count
+                for key, count in sorted(totals[field].items(), key=lambda item: item[1], reverse=True)
+            }
         
         # Get recent views (limited to 10)
         recent_views_cursor = db.analytics.find(
@@ -2923,7 +5258,8 @@ async def get_user_messages(
     request: Request,
     current_user: dict = Depends(get_current_verified_user),
     pending_only: bool = Query(False, description="Only show pending messages"),
-    limit: int = Query(50, ge=1, le=100)
+    limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page")
 ):
     """Get all messages for the user's pages"""
     # Prepare query
@@ -2931,17 +5267,20 @@ async def get_user_messages(
     if pending_only:
         query["approved"] = False
     
+    # Newest first, with id breaking ties between messages sent in the same instant
+    sort_params = [("timestamp", -1), ("id", -1)]
+    if cursor:
+        query.update(keyset_filter(sort_params, decode_cursor(cursor, len(sort_params))))
+    
     # Get messages
     messages = []
-    cursor = db.messages.find(query).sort("timestamp", -1).limit(limit)
+    rows = await db.messages.find(query).sort(sort_params).limit(limit).to_list(limit)
     
-    async for msg in cursor:
-        # Get page title
-        page = await db.profile_pages.find_one(
-            {"page_id": msg["page_id"]},
-            projection={"title": 1, "url": 1}
-        )
-        
+    # Get page titles in one query
+    pages = await get_page_summaries(msg["page_id"] for msg in rows)
+    
+    for msg in rows:
+        page = pages.get(msg["page_id"])
         messages.append({
             "id": msg["id"],
             "page_id": msg["page_id"],
@@ -2953,7 +5292,7 @@ async def get_user_messages(
             "approved": msg["approved"]
         })
     
-    return {"messages": messages}
+    return {"messages": messages, "next_cursor": next_cursor(rows, sort_params, limit)}
 
 @app.post("/messages/{message_id}/approve")
 @limiter.limit(RateLimits.MODIFY_LIMIT)
@@ -3063,7 +5402,8 @@ async def create_anonymous_drawing(
         )
     
     # Validate drawing data
-    if not await validate_drawing_data(drawing.data_url):
+    decoded = decode_drawing_data(drawing.data_url)
+    if decoded is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid drawing data or drawing too large"
@@ -3088,6 +5428,9 @@ async def create_anonymous_drawing(
             detail="This page has reached its maximum drawing limit"
         )
     
+    # Store the image once as raw bytes
+    blob_fields = await store_drawing(*decoded)
+    
     # Prepare drawing data
     drawing_id = str(ObjectId())
     drawing_data = {
@@ -3095,7 +5438,7 @@ async def create_anonymous_drawing(
         "page_id": page_id,
         "url": page["url"],
         "user_id": page["user_id"],
-        "data_url": drawing.data_url,
+        **blob_fields,
         "sender_name": drawing.sender_name,
         "timestamp": datetime.utcnow(),
         "approved": not page.get("drawings_config", {}).get("require_approval", True),
@@ -3152,7 +5495,7 @@ async def get_page_drawings(
     async for draw in cursor:
         drawings.append({
             "id": draw["id"],
-            "data_url": draw["data_url"],
+            **drawing_urls(draw),
             "sender_name": draw.get("sender_name"),
             "timestamp": draw["timestamp"],
             "approved": draw["approved"]
@@ -3166,7 +5509,8 @@ async def get_user_drawings(
     request: Request,
     current_user: dict = Depends(get_current_verified_user),
     pending_only: bool = Query(False, description="Only show pending drawings"),
-    limit: int = Query(30, ge=1, le=50)
+    limit: int = Query(30, ge=1, le=50),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page")
 ):
     """Get all drawings for the user's pages"""
     # Prepare query
@@ -3174,29 +5518,96 @@ async def get_user_drawings(
     if pending_only:
         query["approved"] = False
     
+    # Newest first, with id breaking ties between drawings sent in the same instant
+    sort_params = [("timestamp", -1), ("id", -1)]
+    if cursor:
+        query.update(keyset_filter(sort_params, decode_cursor(cursor, len(sort_params))))
+    
     # Get drawings
     drawings = []
-    cursor = db.drawings.find(query).sort("timestamp", -1).limit(limit)
+    rows = await db.drawings.find(query).sort(sort_params).limit(limit).to_list(limit)
     
-    async for draw in cursor:
-        # Get page title
-        page = await db.profile_pages.find_one(
-            {"page_id": draw["page_id"]},
-            projection={"title": 1, "url": 1}
-        )
-        
+    # Get page titles in one query
+    pages = await get_page_summaries(draw["page_id"] for draw in rows)
+    
+    for draw in rows:
+        page = pages.get(draw["page_id"])
         drawings.append({
             "id": draw["id"],
             "page_id": draw["page_id"],
             "page_title": page["title"] if page else "Unknown Page",
             "page_url": page["url"] if page else "",
-            "data_url": draw["data_url"],
+            **drawing_urls(draw, signed=True),
             "sender_name": draw.get("sender_name"),
             "timestamp": draw["timestamp"],
             "approved": draw["approved"]
         })
     
-    return {"drawings": drawings}
+    return {"drawings": drawings, "next_cursor": next_cursor(rows, sort_params, limit)}
+
+@app.get("/drawings/{drawing_id}/{variant}")
+@limiter.limit(RateLimits.BLOB_LIMIT)
+async def get_drawing_blob(
+    request: Request,
+    drawing_id: str,
+    variant: str,
+    expires: Optional[int] = Query(None),
+    sig: Optional[str] = Query(None)
+):
+    """Stream the image or thumbnail of an approved drawing, or of a pending one through a signed URL"""
+    drawing = None
+    if variant in DRAWING_IMAGE_VARIANTS:
+        drawing = await db.drawings.find_one(
+            {"id": drawing_id},
+            projection={"blob_id": 1, "thumbnail_id": 1, "approved": 1}
+        )
+    if not drawing or not drawing.get("blob_id"):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Drawing not found"
+        )
+    
+    blob_id = drawing["blob_id"]
+    if variant == "thumbnail" and drawing.get("thumbnail_id"):
+        blob_id = drawing["thumbnail_id"]
+    
+    # Blob ids are content hashes, so the ETag stays valid for as long as the drawing exists
+    headers = {"ETag": f'"{blob_id}"', "Cache-Control": "public, max-age=300, must-revalidate"}
+    if not drawing.get("approved"):
+        if (
+            expires is None or sig is None or expires < time.time()
+            or not hmac.compare_digest(sig, blob_signature(drawing_id, variant, expires))
+        ):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Drawing not found"
+            )
+        # Only the owner holds this URL, and the drawing may still be rejected
+        headers["Cache-Control"] = "private, max-age=300, must-revalidate"
+    
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    try:
+        grid_out = await drawing_bucket().open_download_stream(blob_id)
+    except NoFile:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Drawing not found"
+        )
+    
+    async def read_chunks():
+        while True:
+            chunk = await grid_out.readchunk()
+            if not chunk:
+                break
+            yield chunk
+    
+    return StreamingResponse(
+        read_chunks(),
+        media_type=(grid_out.metadata or {}).get("content_type", "application/octet-stream"),
+        headers={**headers, "Content-Length": str(grid_out.length), "X-Content-Type-Options": "nosniff"}
+    )
 
 @app.post("/drawings/{drawing_id}/approve")
 @limiter.limit(RateLimits.MODIFY_LIMIT)
@@ -3265,91 +5676,59 @@ async def delete_drawing(
         )
     
     # Delete the drawing
-    await db.drawings.delete_one({"id": drawing_id})
+    await delete_drawings({"id": drawing_id})
     
     return {"message": "Drawing deleted successfully"}
 
-@app.delete("/account")
+@app.delete("/account", status_code=status.HTTP_202_ACCEPTED)
 @limiter.limit(RateLimits.MODIFY_LIMIT)
 async def delete_account(
     request: Request,
     current_user: dict = Depends(get_current_verified_user),
     password: str = Body(..., embed=True)
 ):
-    """Delete the user's account and all associated data"""
+    """Delete the user's account now and purge all associated data in the background"""
     
     # Verify password before deletion
-    if not await verify_password(password, current_user["hashed_password"]):
+    user = await load_full_user(current_user)
+    if not await verify_password(password, user["hashed_password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect password"
         )
     
     try:
-        # Start transaction to ensure all data is deleted atomically
-        async with await db_client.start_session() as session:
-            async with session.start_transaction():
-                user_id = current_user["id"]
-                email = current_user["email"]
-                username = current_user.get("username")
-                
-                # 1. Get all user's page URLs for cleanup
-                pages = []
-                async for page in db.profile_pages.find(
-                    {"user_id": user_id},
-                    projection={"url": 1, "page_id": 1}
-                ):
-                    pages.append(page)
-                
-                # 2. Delete all user's pages
-                if pages:
-                    page_ids = [page["page_id"] for page in pages]
-                    urls = [page["url"] for page in pages]
-                    
-                    # Delete pages
-                    await db.profile_pages.delete_many({"user_id": user_id})
-                    
-                    # Delete views for pages
-                    await db.views.delete_many({"url": {"$in": urls}})
-                    
-                    # Delete analytics for pages
-                    await db.analytics.delete_many({"page_id": {"$in": page_ids}})
-                    
-                    # Delete messages for pages
-                    await db.messages.delete_many({"page_id": {"$in": page_ids}})
-                    
-                    # Delete drawings for pages
-                    await db.drawings.delete_many({"page_id": {"$in": page_ids}})
-                    
-                    # Delete view records for pages
-                    await db.view_records.delete_many({"url": {"$in": urls}})
-                
-                # 3. Delete user's templates
-                await db.templates.delete_many({"created_by": user_id})
-                
-                # 4. Delete any pending verifications
-                await db.verification.delete_many({"email": email})
-                
-                # 5. Delete any password reset requests
-                await db.password_reset.delete_many({"email": email})
-                
-                # 6. Delete any page previews
-                await db.page_previews.delete_many({"user_id": user_id})
-                
-                # 7. Finally delete the user
-                await db.users.delete_one({"id": user_id})
-                
-                # 8. Clear cache entries
-                await user_cache.delete(f"user:{email}")
-                if username:
-                    await user_cache.delete(f"username:{username}")
-                
-                # Clear page cache entries
-                for page in pages:
-                    if f"views:{page['url']}" in views_cache:
-                        views_cache.pop(f"views:{page['url']}")
-                
-        return {"message": "Account and all associated data have been permanently deleted"}
+        user_id = current_user["id"]
+        email = current_user["email"]
+        username = current_user.get("username")
+        
+        # 1. Tombstone the user so logins and lookups stop finding the account
+        await db.users.update_one({"id": user_id}, {"$set": {"deleted_at": datetime.utcnow()}})
+        await invalidate_user_public_pages(user_id)
+        await invalidate_user_cache(email, username)
+        
+        # 2. Queue everything else, finishing with the tombstoned user document,
+        # before anything is deleted so no data is left without a job
+        pages = await db.profile_pages.find(
+            {"user_id": user_id},
+            projection={"url": 1, "page_id": 1}
+        ).to_list(None)
+        job_id = await purge_engine.enqueue("account", user_id, page_purge_steps(pages) + [
+            ("profile_pages", "user_id", [user_id]),
+            ("templates", "created_by", [user_id]),
+            ("verification", "email", [email]),
+            ("password_reset", "email", [email]),
+            ("page_previews", "user_id", [user_id]),
+            ("users", "id", [user_id]),
+        ])
+        
+        # 3. Take the user's pages offline
+        await drop_pages(user_id, pages)
+        
+        return {
+            "message": "Your account has been deleted. Remaining data is being removed in the background.",
+            "purge_job_id": job_id
+        }
         
     except Exception as e:
         logger.error(f"Error deleting account for user {current_user['id']}: {str(e)}")
@@ -3372,7 +5751,8 @@ async def clear_user_data(
     """Clear specific user data without deleting the account"""
     
     # Verify password before proceeding
-    if not await verify_password(password, current_user["hashed_password"]):
+    user = await load_full_user(current_user)
+    if not await verify_password(password, user["hashed_password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect password"
@@ -3383,6 +5763,7 @@ async def clear_user_data(
         email = current_user["email"]
         username = current_user.get("username")
         cleared_items = []
+        purge_jobs = []
         
         # 1. Clear profile information if requested
         if clear_profile:
@@ -3406,122 +5787,76 @@ async def clear_user_data(
             )
             
             # Clear cache
-            await user_cache.delete(f"user:{email}")
-            if username:
-                await user_cache.delete(f"username:{username}")
+            await invalidate_user_public_pages(user_id)
+            await invalidate_user_cache(email, username)
                 
             cleared_items.append("profile information")
         
         # 2. Clear analytics data if requested
         if clear_analytics:
-            # Get all user's page IDs
-            page_ids = []
-            async for page in db.profile_pages.find(
+            pages = await db.profile_pages.find(
                 {"user_id": user_id},
-                projection={"page_id": 1}
-            ):
-                page_ids.append(page["page_id"])
+                projection={"url": 1, "page_id": 1}
+            ).to_list(None)
             
-            if page_ids:
-                # Delete analytics for user's pages
-                await db.analytics.delete_many({"page_id": {"$in": page_ids}})
-                
-                # Reset view counts
-                async for page in db.profile_pages.find(
-                    {"user_id": user_id},
-                    projection={"url": 1}
-                ):
-                    await db.views.update_one(
-                        {"url": page["url"]},
-                        {"$set": {"views": 0}}
-                    )
-                    
-                    # Clear view cache
-                    if f"views:{page['url']}" in views_cache:
-                        views_cache.pop(f"views:{page['url']}")
+            if pages:
+                # Reset view counts now and purge the analytics rows in the background
+                urls = [page["url"] for page in pages]
+                await db.views.update_many({"url": {"$in": urls}}, {"$set": {"views": 0}})
+                for url in urls:
+                    await invalidate_page_views(url)
+                purge_jobs.append(await purge_engine.enqueue(
+                    "analytics", user_id, page_purge_steps(pages, {"analytics", "analytics_daily"})
+                ))
                 
                 cleared_items.append("analytics data")
         
         # 3. Clear templates if requested
         if clear_templates:
             await db.templates.delete_many({"created_by": user_id})
+            await invalidate_template_lists()
             cleared_items.append("templates")
         
         # 4. Clear pages if requested (but keep at least one)
         if clear_pages:
-            # Count user's pages
-            page_count = await db.profile_pages.count_documents({"user_id": user_id})
+            # Keep the user's primary page (username page) or else the oldest page
+            kept_page = None
+            if username:
+                kept_page = await db.profile_pages.find_one({"url": username, "user_id": user_id}, projection={"page_id": 1})
+            if not kept_page:
+                kept_page = await db.profile_pages.find_one(
+                    {"user_id": user_id},
+                    sort=[("created_at", 1)],
+                    projection={"page_id": 1}
+                )
             
-            if page_count > 1:
-                # Keep the user's primary page (username page) or the oldest page
-                if username:
-                    # Find and keep the page with URL matching username
-                    primary_page = await db.profile_pages.find_one({"url": username, "user_id": user_id})
-                    if primary_page:
-                        # Delete all other pages
-                        await db.profile_pages.delete_many({
-                            "user_id": user_id,
-                            "url": {"$ne": username}
-                        })
-                        
-                        # Get the deleted page URLs
-                        async for page in db.profile_pages.find(
-                            {"user_id": user_id, "url": {"$ne": username}},
-                            projection={"url": 1, "page_id": 1}
-                        ):
-                            # Clean up associated data
-                            await db.views.delete_one({"url": page["url"]})
-                            await db.analytics.delete_many({"page_id": page["page_id"]})
-                            await db.messages.delete_many({"page_id": page["page_id"]})
-                            await db.drawings.delete_many({"page_id": page["page_id"]})
-                            
-                            # Clear cache
-                            if f"views:{page['url']}" in views_cache:
-                                views_cache.pop(f"views:{page['url']}")
-                else:
-                    # Keep only the oldest page
-                    oldest_page = await db.profile_pages.find_one(
-                        {"user_id": user_id},
-                        sort=[("created_at", 1)]
-                    )
-                    
-                    if oldest_page:
-                        # Delete all other pages
-                        await db.profile_pages.delete_many({
-                            "user_id": user_id,
-                            "page_id": {"$ne": oldest_page["page_id"]}
-                        })
-                        
-                        # Get the deleted page URLs
-                        async for page in db.profile_pages.find(
-                            {"user_id": user_id, "page_id": {"$ne": oldest_page["page_id"]}},
-                            projection={"url": 1, "page_id": 1}
-                        ):
-                            # Clean up associated data
-                            await db.views.delete_one({"url": page["url"]})
-                            await db.analytics.delete_many({"page_id": page["page_id"]})
-                            await db.messages.delete_many({"page_id": page["page_id"]})
-                            await db.drawings.delete_many({"page_id": page["page_id"]})
-                            
-                            # Clear cache
-                            if f"views:{page['url']}" in views_cache:
-                                views_cache.pop(f"views:{page['url']}")
-                
+            # Look the other pages up before deleting them, so their data can still be found
+            pages = []
+            if kept_page:
+                pages = await db.profile_pages.find(
+                    {"user_id": user_id, "page_id": {"$ne": kept_page["page_id"]}},
+                    projection={"url": 1, "page_id": 1}
+                ).to_list(None)
+            
+            if pages:
+                purge_jobs.append(await purge_engine.enqueue("pages", user_id, page_purge_steps(pages)))
+                await drop_pages(user_id, pages)
+                await invalidate_user_public_pages(user_id)
                 cleared_items.append("additional profile pages")
-            else:
+            elif not cleared_items:
                 # Cannot delete the only page
-                if clear_pages and len(cleared_items) == 0:
-                    return {
-                        "message": "Cannot clear your only profile page. You must keep at least one page.",
-                        "cleared_items": []
-                    }
+                return {
+                    "message": "Cannot clear your only profile page. You must keep at least one page.",
+                    "cleared_items": []
+                }
         
         if not cleared_items:
             return {"message": "No data was selected to be cleared", "cleared_items": []}
             
         return {
             "message": "Selected data has been cleared successfully",
-            "cleared_items": cleared_items
+            "cleared_items": cleared_items,
+            "purge_job_ids": purge_jobs
         }
         
     except Exception as e:
@@ -3545,7 +5880,7 @@ async def get_discord_tokens(code: str) -> Dict[str, Any]:
     }
     
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
+        async with http_clients.session("discord") as client:
             response = await client.post(
                 f"{settings.DISCORD_API_ENDPOINT}/oauth2/token", 
                 data=data, 
@@ -3576,7 +5911,7 @@ async def refresh_discord_token(refresh_token: str) -> Dict[str, Any]:
         'refresh_token': refresh_token
     }
     
-    async with httpx.AsyncClient() as client:
+    async with http_clients.session("discord") as client:
         response = await client.post(f"{settings.DISCORD_API_ENDPOINT}/oauth2/token", 
                                     data=data, 
                                     headers={'Content-Type': 'application/x-www-form-urlencoded'})
@@ -3589,7 +5924,7 @@ async def refresh_discord_token(refresh_token: str) -> Dict[str, Any]:
 
 async def get_discord_user(access_token: str) -> Dict[str, Any]:
     """Get Discord user information"""
-    async with httpx.AsyncClient() as client:
+    async with http_clients.session("discord") as client:
         response = await client.get(f"{settings.DISCORD_API_ENDPOINT}/users/@me", 
                                    headers={'Authorization': f'Bearer {access_token}'})
         
@@ -3602,6 +5937,225 @@ async def get_discord_user(access_token: str) -> Dict[str, Any]:
             
         return response.json()
 
+# Discord token refresh
+#
+# Connections whose access token expires within the next day are read in
+# pages ordered by _id, so no cursor stays open while Discord is called.
+# Each page is refreshed with bounded parallelism and written back with a
+# single bulk_write. Discord's rate-limit headers pause all refreshes until
+# the bucket resets, and a 429 is retried after its retry_after. Passes run
+# in whichever worker holds the discord_token_refresh lease. A heartbeat
+# renews it every minute during a pass, no request goes out once it may have
+# lapsed, and between passes it is kept until the next one or released on
+# shutdown.
+
+class DiscordTokenRefresher(BackgroundWorker):
+    """Refreshes expiring Discord tokens with bounded parallelism and batched writes"""
+
+    name = "Discord token refresh task"
+
+    LEASE = "discord_token_refresh"
+
+    def __init__(self, concurrency: int = 5, batch_size: int = 100, interval: int = 6 * 60 * 60,
+                 window: timedelta = timedelta(hours=24), max_attempts: int = 3):
+        # Workers without the lease check back every 15 minutes in case its holder died
+        super().__init__(min(interval, 15 * 60))
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.window = window
+        self.max_attempts = max_attempts
+        # Monotonic time before which no request is sent to Discord
+        self.resume_at = 0.0
+        self.refreshed = 0
+        self.disconnected = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.last_run: Optional[datetime] = None
+        # Monotonic time until which this worker is sure it holds the lease
+        self.lease_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    @staticmethod
+    def retry_after(response: httpx.Response) -> float:
+        try:
+            return float(response.json()["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            pass
+        try:
+            return float(response.headers.get("Retry-After", "1"))
+        except ValueError:
+            return 1.0
+
+    async def renew_lease(self) -> bool:
+        started = time.monotonic()
+        if await acquire_migration_lock(self.LEASE):
+            # A minute short of the stored expiry, for clock skew between workers
+            self.lease_until = started + (MIGRATION_LOCK_MINUTES - 1) * 60
+            return True
+        self.lease_until = 0.0
+        return False
+
+    def holds_lease(self) -> bool:
+        return time.monotonic() < self.lease_until
+
+    async def keep_lease(self, every: int = 60) -> None:
+        """Renew the lease while a pass runs; cancel when it is done"""
+        while True:
+            await asyncio.sleep(every)
+            try:
+                if not await self.renew_lease():
+                    logger.warning("Lost the Discord refresh lease, stopping the pass")
+                    return
+            except Exception as e:
+                # Keep the current lease until it lapses; the next beat tries again
+                logger.error(f"Error renewing the Discord refresh lease: {str(e)}")
+
+    async def request_refresh(self, refresh_token: str) -> Optional[httpx.Response]:
+        data = {
+            'client_id': settings.DISCORD_CLIENT_ID,
+            'client_secret': settings.DISCORD_CLIENT_SECRET,
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token
+        }
+        for attempt in range(self.max_attempts):
+            delay = self.resume_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if not self.holds_lease():
+                # Another worker may be refreshing now, and Discord rotates the token
+                return None
+            async with http_clients.session("discord") as client:
+                response = await client.post(f"{settings.DISCORD_API_ENDPOINT}/oauth2/token",
+                                             data=data,
+                                             headers={'Content-Type': 'application/x-www-form-urlencoded'})
+            if response.status_code == 429:
+                self.rate_limited += 1
+                self.pause(self.retry_after(response))
+                continue
+            if response.headers.get("X-RateLimit-Remaining") == "0":
+                self.pause(float(response.headers.get("X-RateLimit-Reset-After", "1")))
+            return response
+        return response
+
+    async def refresh_user(self, user: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """The update to apply for this user, or None to leave the connection for the next run"""
+        async with self.semaphore:
+            try:
+                response = await self.request_refresh(user["discord"]["refresh_token"])
+            except httpx.HTTPError as e:
+                self.failed += 1
+                logger.error(f"Error refreshing Discord token for user {user['id']}: {str(e)}")
+                return None
+        if response is None:
+            return None
+        
+        if response.status_code == 200:
+            token_data = response.json()
+            self.refreshed += 1
+            expires_in = token_data.get("expires_in", 604800)  # Default to 7 days
+            return {"$set": {
+                "discord.access_token": token_data.get("access_token"),
+                "discord.refresh_token": token_data.get("refresh_token"),
+                "discord.expires_at": datetime.utcnow() + timedelta(seconds=expires_in)
+            }}
+        if response.status_code in (400, 401):
+            # invalid_grant: the user revoked access, so the connection is gone
+            self.disconnected += 1
+            logger.warning(f"Failed to refresh Discord token for user {user['id']}, removing connection")
+            return {"$unset": {"discord": ""}}
+        # Rate limited past max_attempts or a Discord outage; the token is still valid for now
+        self.failed += 1
+        logger.error(f"Discord token refresh for user {user['id']} failed with status {response.status_code}")
+        return None
+
+    async def refresh_page(self, users: List[Dict[str, Any]]) -> None:
+        updates = await asyncio.gather(*(self.refresh_user(user) for user in users))
+        changed = [(user, update) for user, update in zip(users, updates) if update is not None]
+        if not changed:
+            return
+        
+        # Matching on the old refresh token skips users who reconnected or refreshed meanwhile
+        await db.users.bulk_write([
+            UpdateOne({"_id": user["_id"], "discord.refresh_token": user["discord"]["refresh_token"]}, update)
+            for user, update in changed
+        ], ordered=False)
+        
+        for user, update in changed:
+            if "$unset" in update:
+                await invalidate_user_public_pages(user["id"])
+            await invalidate_user_cache(user["email"], user.get("username"))
+
+    async def refresh_expiring(self) -> int:
+        now = datetime.utcnow()
+        query = {
+            "discord.expires_at": {"$gt": now, "$lt": now + self.window},
+            "discord.refresh_token": {"$exists": True, "$ne": None}
+        }
+        checked = 0
+        last_id = None
+        while True:
+            page_query = dict(query, _id={"$gt": last_id}) if last_id is not None else query
+            users = await db.users.find(
+                page_query,
+                projection={"id": 1, "email": 1, "username": 1, "discord.refresh_token": 1}
+            ).sort("_id", 1).limit(self.batch_size).to_list(self.batch_size)
+            if not users:
+                break
+            await self.refresh_page(users)
+            checked += len(users)
+            last_id = users[-1]["_id"]
+            # The page is written even if the lease lapsed mid-way, since Discord
+            # already rotated the tokens of the users refreshed before that
+            if not self.holds_lease():
+                raise RuntimeError("Lost the Discord refresh lease")
+            if len(users) < self.batch_size:
+                break
+        self.last_run = now
+        return checked
+
+    async def step(self) -> Optional[float]:
+        # Discord rotates refresh tokens, so two workers refreshing one user would
+        # revoke each other's; only the worker holding the lease runs a pass
+        if not await self.renew_lease():
+            return None
+        heartbeat = asyncio.create_task(self.keep_lease())
+        try:
+            checked = await self.refresh_expiring()
+        finally:
+            heartbeat.cancel()
+        if checked:
+            logger.info(f"Checked {checked} expiring Discord connections")
+        # Keep the lease until the next pass, so the other workers stay idle
+        await db.schema_migrations.update_one(
+            {"_id": f"{self.LEASE}:lock", "owner": WORKER_ID},
+            {"$set": {"locked_until": datetime.utcnow() + timedelta(seconds=self.interval)}}
+        )
+        return self.interval
+
+    async def stop(self) -> None:
+        await super().stop()
+        # Hand the lease over now rather than leaving the other workers idle until it expires
+        self.lease_until = 0.0
+        await db.schema_migrations.delete_one({"_id": f"{self.LEASE}:lock", "owner": WORKER_ID})
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "refreshed": self.refreshed,
+            "disconnected": self.disconnected,
+            "failed": self.failed,
+            "rate_limited": self.rate_limited,
+            "last_run": self.last_run
+        }
+
+discord_refresher = DiscordTokenRefresher(
+    concurrency=settings.DISCORD_REFRESH_CONCURRENCY,
+    batch_size=settings.DISCORD_REFRESH_BATCH_SIZE,
+    interval=settings.DISCORD_REFRESH_INTERVAL
+)
+
 # Discord integration endpoints
 
 @app.get("/discord/auth-url")
@@ -3704,9 +6258,8 @@ async def connect_discord(
             logger.info(f"Discord data in DB: {updated_user['discord']}")
         
         # Clear cache - IMPORTANT: This ensures fresh data is fetched
-        await user_cache.delete(f"user:{current_user['email']}")
-        if current_user.get("username"):
-            await user_cache.delete(f"username:{current_user['username']}")
+        await invalidate_user_public_pages(current_user["id"])
+        await invalidate_user_cache(current_user["email"], current_user.get("username"))
         
         logger.info("User cache cleared")
         
@@ -3759,9 +6312,8 @@ async def disconnect_discord(
     )
     
     # Clear cache
-    await user_cache.delete(f"user:{fresh_user['email']}")
-    if fresh_user.get("username"):
-        await user_cache.delete(f"username:{fresh_user['username']}")
+    await invalidate_user_public_pages(fresh_user["id"])
+    await invalidate_user_cache(fresh_user["email"], fresh_user.get("username"))
     
     return {"message": "Discord account disconnected successfully"}
 
@@ -3772,6 +6324,7 @@ async def refresh_discord_connection(
     current_user: dict = Depends(get_current_verified_user)
 ):
     """Refresh Discord connection tokens"""
+    current_user = await load_full_user(current_user)
     # Check if user has a connected Discord account
     if "discord" not in current_user:
         raise HTTPException(
@@ -3800,9 +6353,8 @@ async def refresh_discord_connection(
             )
             
             # Clear cache
-            await user_cache.delete(f"user:{current_user['email']}")
-            if current_user.get("username"):
-                await user_cache.delete(f"username:{current_user['username']}")
+            await invalidate_user_public_pages(current_user["id"])
+            await invalidate_user_cache(current_user["email"], current_user.get("username"))
             
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -3837,9 +6389,8 @@ async def refresh_discord_connection(
         )
         
         # Clear cache
-        await user_cache.delete(f"user:{current_user['email']}")
-        if current_user.get("username"):
-            await user_cache.delete(f"username:{current_user['username']}")
+        await invalidate_user_public_pages(current_user["id"])
+        await invalidate_user_cache(current_user["email"], current_user.get("username"))
         
         return {
             "message": "Discord connection refreshed successfully",
@@ -3865,22 +6416,10 @@ async def create_page_preview(
     preview_data: ProfilePage,
     current_user: dict = Depends(get_current_verified_user)
 ):
-    """Create a temporary preview of a page without saving it permanently"""
-    
-    # Validate custom fonts if provided
-    if preview_data.name_style and preview_data.name_style.font and preview_data.name_style.font.link:
-        if not await validate_font(preview_data.name_style.font.link):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid font link for name"
-            )
-            
-    if preview_data.username_style and preview_data.username_style.font and preview_data.username_style.font.link:
-        if not await validate_font(preview_data.username_style.font.link):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid font link for username"
-            )
+    """Create a temporary preview of a page without saving it permanently"""
+    
+    # Validate avatar, decoration and custom fonts concurrently
+    await media_validator.validate(page_media_checks(preview_data))
     
     # Generate preview ID
     preview_id = str(ObjectId())
@@ -4093,9 +6632,8 @@ async def update_user_profile(
         })
     
     # Clear cache
-    await user_cache.delete(f"user:{current_user['email']}")
-    if current_user.get("username"):
-        await user_cache.delete(f"username:{current_user['username']}")
+    await invalidate_user_public_pages(current_user["id"])
+    await invalidate_user_cache(current_user["email"], current_user.get("username"))
     
     # Get updated user
     updated_user = await db.users.find_one({"id": current_user["id"]})
@@ -4135,7 +6673,7 @@ async def delete_profile_page(
     page = await db.profile_pages.find_one({
         "page_id": page_id,
         "user_id": current_user["id"]
-    }, projection={"url": 1})
+    }, projection={"url": 1, "page_id": 1})
     
     if not page:
         raise HTTPException(
@@ -4158,74 +6696,26 @@ async def delete_profile_page(
             detail="You cannot delete your last page"
         )
     
-    # Delete page
-    await db.profile_pages.delete_one({"page_id": page_id})
-    
-    # Delete associated views
-    await db.views.delete_one({"url": page["url"]})
-    
-    # Delete associated analytics
-    await db.analytics.delete_many({"page_id": page_id})
-    
-    # Delete associated messages
-    await db.messages.delete_many({"page_id": page_id})
-    
-    # Delete associated drawings
-    await db.drawings.delete_many({"page_id": page_id})
-    
-    # Clear cache
-    if f"views:{page['url']}" in views_cache:
-        views_cache.pop(f"views:{page['url']}")
+    # Delete the page now and its views, analytics, messages and drawings in the background
+    await purge_engine.enqueue("pages", current_user["id"], page_purge_steps([page]))
+    await drop_pages(current_user["id"], [page])
     
     return {"message": "Page deleted successfully"}
 
         
-@app.get("/p/{url}", response_class=ORJSONResponse)
-@limiter.limit(RateLimits.READ_LIMIT)
-async def get_public_page(request: Request, url: str, template_id: Optional[str] = None):
-    # If template_id is provided, return the template preview
-    if template_id:
-        cache_key = f"template_preview:{template_id}"
-        cached_template = template_cache.get(cache_key)
-        if cached_template:
-            return cached_template
-            
-        template = await db.templates.find_one({"id": template_id})
-        if not template:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Template not found"
-            )
-            
-        # Get user who created the template
-        template_creator = await db.users.find_one(
-            {"id": template["created_by"]},
-            projection={"username": 1, "name": 1}
-        )
-        
-        # Prepare response data with template preview flag
-        response_data = {
-            "page": template["page_config"],
-            "user": {
-                "username": template_creator.get("username") if template_creator else "User",
-                "name": template_creator.get("name") if template_creator else "User",
-            },
-            "is_template_preview": True,
-            "template_id": template_id,
-            "template_name": template["name"]
-        }
-        
-        # Cache the template preview
-        template_cache[cache_key] = response_data
-        return response_data
-    
-    
+# Public page cache
+#
+# /p/{url} payloads are stored pre-serialized without the view count, which
+# is spliced in per request. Writers must invalidate entries explicitly.
+
+async def build_public_page(url: str) -> Dict[str, Any]:
+    """Assemble the public payload for a page and store it in public_page_cache"""
     # Try to find the page by URL
     page = await db.profile_pages.find_one({"url": url})
     
     if not page:
         # Check if it's a username
-        user = await db.users.find_one({"username": url})
+        user = await db.users.find_one({"username": url, "deleted_at": {"$exists": False}})
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -4259,10 +6749,6 @@ async def get_public_page(request: Request, url: str, template_id: Optional[str]
             detail="User not found"
         )
     
-    # Handle views if enabled
-    device_hash = await generate_device_identifier(request)
-    views = 0
-
     if page and "name_style" in page and isinstance(page["name_style"], dict):
         if "font" in page["name_style"] and isinstance(page["name_style"]["font"], dict):
             # Ensure the font link is included
@@ -4283,10 +6769,6 @@ async def get_public_page(request: Request, url: str, template_id: Optional[str]
                 "link": font.get("link", "")
             }
     
-    if page.get("show_views", True):
-        # Pass the request to include analytics data
-        views = await increment_page_views(db, url, device_hash, request)
-    
     # Prepare response data
     # Convert ObjectId to string
     if "_id" in page:
@@ -4304,8 +6786,7 @@ async def get_public_page(request: Request, url: str, template_id: Optional[str]
             "name": user.get("name"),
             "joined_at": user.get("joined_at"),
             "tags": user.get("tags", [])
-        },
-        "views": views
+        }
     }
     
     # Filter user data based on display preferences
@@ -4360,22 +6841,89 @@ async def get_public_page(request: Request, url: str, template_id: Optional[str]
             "status": discord.get("status"),
             "activity": discord.get("activity")
         }
-        
-        logger.info(f"Added Discord data to public page response for user {user['id']}")
     
-    return response_data
+    body = dump_json(response_data)
+    cached_page = {
+        "body": body,
+        # The view count is not part of the validator, it is spliced in later
+        "etag": make_etag(body),
+        "show_views": page.get("show_views", True),
+        # Just what increment_page_views needs, so views skip the page lookup
+        "page": {
+            "page_id": page["page_id"],
+            "analytics_config": page.get("analytics_config", {})
+        }
+    }
+    public_page_cache[url] = cached_page
+    # Owners outlive the entries the cache drops by itself, so prune them once they outnumber it
+    if len(public_page_owners) >= 2 * public_page_cache.maxsize:
+        prune_page_cache_owners()
+    public_page_owners.setdefault(page["user_id"], set()).add(url)
+    return cached_page
 
+@app.get("/p/{url}", response_class=ORJSONResponse)
+@limiter.limit(RateLimits.READ_LIMIT)
+async def get_public_page(request: Request, url: str, template_id: Optional[str] = None):
+    # If template_id is provided, return the template preview
+    if template_id:
+        async def load_template_preview():
+            template = await db.templates.find_one({"id": template_id})
+            if not template:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Template not found"
+                )
+                
+            # Get user who created the template
+            template_creator = await db.users.find_one(
+                {"id": template["created_by"]},
+                projection={"username": 1, "name": 1}
+            )
+            
+            # Prepare response data with template preview flag
+            return {
+                "page": template["page_config"],
+                "user": {
+                    "username": template_creator.get("username") if template_creator else "User",
+                    "name": template_creator.get("name") if template_creator else "User",
+                },
+                "is_template_preview": True,
+                "template_id": template_id,
+                "template_name": template["name"]
+            }
+        
+        return await template_cache.get_or_load(f"template_preview:{template_id}", load_template_preview)
+    
+    
+    cached_page = public_page_cache.get(url)
+    if cached_page is None:
+        cached_page = await build_public_page(url)
     
+    # Handle views if enabled
+    views = 0
+    if cached_page["show_views"]:
+        device_hash = await generate_device_identifier(request)
+        # Pass the request to include analytics data
+        views = await increment_page_views(db, url, device_hash, request, cached_page["page"])
+    
+    # The body carries the live view count, so the tag does too; a page is only
+    # resent when it or its count changed, and the view is counted either way
+    etag = cached_page["etag"][:-1] + f'-{views}"'
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    # Splice the live view count into the cached {"page", "user"} object
+    body = cached_page["body"][:-1] + b',"views":' + str(views).encode() + b"}"
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"ETag": etag, "Cache-Control": "no-cache"}
+    )
+
 @app.get("/views/{url}")
 @limiter.limit(RateLimits.READ_LIMIT)
 async def get_views(request: Request, url: str):
-    cache_key = f"views:{url}"
-    if cache_key in views_cache:
-        return {"views": views_cache[cache_key]}
-    
-    views_doc = await db.views.find_one({"url": url}, projection={"views": 1})
-    views = views_doc["views"] if views_doc else 0
-    views_cache[cache_key] = views
+    views = await get_page_views(db, url)
     return {"views": views}
 
 @app.put("/preferences")
@@ -4386,27 +6934,17 @@ async def update_display_preferences(
     current_user: dict = Depends(get_current_verified_user)
 ):
     # Validate custom fonts if provided
-    if preferences.default_name_style and preferences.default_name_style.font and preferences.default_name_style.font.link:
-        if not await validate_font(preferences.default_name_style.font.link):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid font link for name"
-            )
-            
-    if preferences.default_username_style and preferences.default_username_style.font and preferences.default_username_style.font.link:
-        if not await validate_font(preferences.default_username_style.font.link):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid font link for username"
-            )
+    await media_validator.validate([
+        ("font", style_font_link(preferences.default_name_style), "Invalid font link for name"),
+        ("font", style_font_link(preferences.default_username_style), "Invalid font link for username"),
+    ])
     
     await db.users.update_one(
         {"id": current_user["id"]},
         {"$set": {"display_preferences": preferences.dict()}}
     )
-    await user_cache.delete(f"user:{current_user['email']}")
-    if "username" in current_user and current_user["username"]:
-        await user_cache.delete(f"username:{current_user['username']}")
+    await invalidate_user_public_pages(current_user["id"])
+    await invalidate_user_cache(current_user["email"], current_user.get("username"))
     
     return {"message": "Display preferences updated successfully"}
 
@@ -4425,20 +6963,8 @@ async def create_template(
             detail=f"You have reached the maximum limit of {settings.MAX_TEMPLATES} templates"
         )
     
-    # Validate custom fonts in the template's page_config
-    if template_data.page_config.name_style and template_data.page_config.name_style.font and template_data.page_config.name_style.font.link:
-        if not await validate_font(template_data.page_config.name_style.font.link):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid font link for name in template"
-            )
-            
-    if template_data.page_config.username_style and template_data.page_config.username_style.font and template_data.page_config.username_style.font.link:
-        if not await validate_font(template_data.page_config.username_style.font.link):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid font link for username in template"
-            )
+    # Validate media and custom fonts in the template's page_config
+    await media_validator.validate(page_media_checks(template_data.page_config, " in template"))
     
     # Generate template ID
     template_id = str(ObjectId())
@@ -4456,6 +6982,7 @@ async def create_template(
     
     # Insert template
     await db.templates.insert_one(template_dict)
+    await invalidate_template_lists()
     
     # Get username for response
     template_response = {
@@ -4469,56 +6996,50 @@ async def create_template(
 @limiter.limit(RateLimits.READ_LIMIT)
 async def get_templates(
     request: Request,
+    response: Response,
     page: int = Query(1, ge=1),
     limit: int = Query(10, ge=1, le=50),
     sort_by: str = Query("use_count", regex="^(use_count|created_at)$"),
     sort_order: str = Query("desc", regex="^(asc|desc)$"),
-    tag: Optional[str] = Query(None)
+    tag: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page; replaces page")
 ):
-    # Cache key based on query params
-    cache_key = f"templates:list:{page}:{limit}:{sort_by}:{sort_order}:{tag or 'none'}"
-    cached_result = template_cache.get(cache_key)
-    if cached_result:
-        return cached_result
-    
-    # Prepare filter
-    filter_query = {}
-    if tag:
-        filter_query["tags"] = tag
-    
-    # Prepare sort
+    # Prepare sort, with id breaking ties so every row has a unique position
     sort_direction = -1 if sort_order == "desc" else 1
-    sort_params = [(sort_by, sort_direction)]
-    
-    # Calculate skip
-    skip = (page - 1) * limit
+    sort_params = [(sort_by, sort_direction), ("id", sort_direction)]
+    after = decode_cursor(cursor, len(sort_params)) if cursor else None
     
-    # Query templates
-    templates = []
-    cursor = db.templates.find(filter_query).sort(sort_params).skip(skip).limit(limit)
+    # Cache key based on query params
+    cache_key = f"templates:list:{cursor or page}:{limit}:{sort_by}:{sort_order}:{tag or 'none'}"
     
-    # Process templates and add username
-    async for template in cursor:
-        # Get username of template creator
-        user = await db.users.find_one(
-            {"id": template["created_by"]},
-            projection={"username": 1}
-        )
-        username = user.get("username") if user else None
+    async def load_templates():
+        # Prepare filter
+        filter_query = {}
+        if tag:
+            filter_query["tags"] = tag
         
-        # Format template
-        template["id"] = str(template["id"])
-        if "_id" in template:
-            template["_id"] = str(template["_id"])
+        if after is not None:
+            filter_query.update(keyset_filter(sort_params, after))
+            query = db.templates.find(filter_query).sort(sort_params).limit(limit)
+        else:
+            # Offset paging is kept for old clients; it gets slower with depth
+            query = db.templates.find(filter_query).sort(sort_params).skip((page - 1) * limit).limit(limit)
         
-        templates.append({
-            **template,
-            "created_by_username": username
-        })
+        # Query templates and add creator usernames
+        rows = await query.to_list(limit)
+        continuation = next_cursor(rows, sort_params, limit)
+        templates = await with_creator_usernames(rows)
+        
+        return templates, make_etag(dump_json(templates)), continuation
     
-    # Cache the result
-    template_cache[cache_key] = templates
+    templates, etag, continuation = await template_cache.get_or_load(cache_key, load_templates)
     
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    if continuation:
+        response.headers["X-Next-Cursor"] = continuation
     return templates
 
 
@@ -4526,39 +7047,28 @@ async def get_templates(
 @limiter.limit(RateLimits.READ_LIMIT)
 async def get_template(request: Request, template_id: str):
     # Check cache
-    cache_key = f"template:{template_id}"
-    cached_template = template_cache.get(cache_key)
-    if cached_template:
-        return cached_template
-    
-    template = await db.templates.find_one({"id": template_id})
-    
-    if not template:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Template not found"
-        )
-    
-    # Get username of template creator
-    user = await db.users.find_one(
-        {"id": template["created_by"]},
-        projection={"username": 1}
-    )
-    username = user.get("username") if user else None
-    
-    # Format template
-    if "_id" in template:
-        template["_id"] = str(template["_id"])
-    
-    template_response = {
-        **template,
-        "created_by_username": username
-    }
-    
-    # Cache result
-    template_cache[cache_key] = template_response
+    async def load_template():
+        template = await db.templates.find_one({"id": template_id})
+        
+        if not template:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Template not found"
+            )
+        
+        # Get username of template creator
+        username = (await resolve_usernames([template["created_by"]])).get(template["created_by"])
+        
+        # Format template
+        if "_id" in template:
+            template["_id"] = str(template["_id"])
+        
+        return {
+            **template,
+            "created_by_username": username
+        }
     
-    return template_response
+    return await template_cache.get_or_load(f"template:{template_id}", load_template)
     
 @app.post("/use-template/{template_id}")
 @limiter.limit(RateLimits.MODIFY_LIMIT)
@@ -4634,8 +7144,10 @@ async def use_template(
         {"$inc": {"use_count": 1}}
     )
     
+    await invalidate_user_page_list(current_user["id"])
+    
     # Clear template cache
-    template_cache.pop(f"template:{template_id}", None)
+    await invalidate_template(template_id)
     
     return {
         "message": "Page created from template",
@@ -4700,6 +7212,8 @@ async def apply_template_to_page(
         {"page_id": page_id},
         {"$set": {**update_data, "updated_at": datetime.utcnow(), "applied_template_id": template_id}}
     )
+    await invalidate_public_page(existing_page["url"])
+    await invalidate_user_page_list(current_user["id"])
     
     # Increment template use count
     await db.templates.update_one(
@@ -4708,7 +7222,7 @@ async def apply_template_to_page(
     )
     
     # Clear template cache
-    template_cache.pop(f"template:{template_id}", None)
+    await invalidate_template(template_id)
     
     # Get updated page
     updated_page = await db.profile_pages.find_one({"page_id": page_id})
@@ -4850,48 +7364,29 @@ async def get_trending_templates(
     limit: int = Query(5, ge=1, le=20)
 ):
     # Check cache
-    cache_key = f"trending_templates:{limit}"
-    cached_templates = template_cache.get(cache_key)
-    if cached_templates:
-        return {"templates": cached_templates}
-    
-    templates = []
-    cursor = db.templates.find().sort("use_count", -1).limit(limit)
-    
-    async for template in cursor:
-        # Get username of template creator
-        user = await db.users.find_one(
-            {"id": template["created_by"]},
-            projection={"username": 1}
-        )
-        username = user.get("username") if user else None
-        
-        # Format template
-        template["id"] = str(template["id"])
-        if "_id" in template:
-            template["_id"] = str(template["_id"])
-        
-        templates.append({
-            **template,
-            "created_by_username": username
-        })
-    
-    # Cache the result
-    template_cache[cache_key] = templates
+    async def load_trending_templates():
+        cursor = db.templates.find().sort("use_count", -1).limit(limit)
+        return await with_creator_usernames(await cursor.to_list(limit))
     
+    templates = await template_cache.get_or_load(f"trending_templates:{limit}", load_trending_templates)
     return {"templates": templates}
 
 @app.get("/user/{username}/pages", response_class=ORJSONResponse)
 @limiter.limit(RateLimits.READ_LIMIT)
-async def get_user_public_pages(request: Request, username: str):
+async def get_user_public_pages(request: Request, response: Response, username: str):
     # Check cache
     cache_key = f"user_pages:{username}"
     cached_result = page_cache.get(cache_key)
     if cached_result:
-        return cached_result
+        result, etag = cached_result
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+        return result
     
     user = await db.users.find_one(
-        {"username": username},
+        {"username": username, "deleted_at": {"$exists": False}},
         projection={"id": 1, "name": 1, "avatar_url": 1, "avatar_decoration": 1}
     )
     if not user:
@@ -4921,61 +7416,164 @@ async def get_user_public_pages(request: Request, username: str):
     }
     
     # Cache the result
-    page_cache[cache_key] = result
-    
+    etag = make_etag(dump_json(result))
+    page_cache[cache_key] = (result, etag)
+    if len(page_cache_owners) >= 2 * page_cache.maxsize:
+        prune_page_cache_owners()
+    page_cache_owners[user["id"]] = cache_key
+    
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
     return result
 
-@app.post("/upload")
-@limiter.limit(RateLimits.UPLOAD_LIMIT)
-async def upload_image(
-    request: Request,
-    file: UploadFile = File(...),
-    current_user: dict = Depends(get_current_user)
-):
-    """Upload an image to ImgBB and return the URL"""
-    # Check file size (32MB max according to ImgBB)
-    MAX_SIZE = 32 * 1024 * 1024  # 32MB
-    
-    # Read the file content
-    file_content = await file.read()
-    
-    # Check file size
-    if len(file_content) > MAX_SIZE:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"File too large. Maximum size is 32MB."
+# Image uploads
+#
+# /upload parses the multipart body as it arrives, so an oversized request is
+# rejected after at most MAX_UPLOAD_SIZE bytes and the file never sits in
+# memory in full. Files are spooled to disk past 1 MB and handed to the
+# storage backend as a stream.
+
+UPLOAD_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/bmp": ".bmp",
+    "image/avif": ".avif",
+}
+
+class StreamingUpload:
+    """Incremental multipart/form-data reader that keeps one file field"""
+
+    # Room for part headers and other small form fields around the file
+    MULTIPART_OVERHEAD = 64 * 1024
+
+    def __init__(self, field_name: str, max_size: int):
+        self.field_name = field_name.encode()
+        self.max_size = max_size
+        self.file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        self.filename: Optional[str] = None
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.head = b""
+        self.found = False
+        self.too_large = False
+        self.in_file = False
+        self.headers: Dict[bytes, bytes] = {}
+        self.header_field = b""
+        self.header_value = b""
+
+    def on_part_begin(self) -> None:
+        self.headers = {}
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self.header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field = b""
+        self.header_value = b""
+
+    def on_headers_finished(self) -> None:
+        _, options = parse_options_header(self.headers.get(b"content-disposition", b""))
+        self.in_file = (
+            not self.found
+            and options.get(b"name") == self.field_name
+            and b"filename" in options
         )
-    
-    # Check file type
-    content_type = file.content_type
-    if not content_type.startswith("image/"):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Only image files are allowed."
-        )
-    
-    # Prepare the request to ImgBB
-    IMGBB_API_KEY = os.getenv("IMGBB_API_KEY", "")
-    if not IMGBB_API_KEY:
+        if self.in_file:
+            self.filename = options[b"filename"].decode("utf-8", "replace")
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if not self.in_file or self.too_large:
+            return
+        chunk = data[start:end]
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            self.too_large = True
+            return
+        if len(self.head) < 32:
+            self.head += chunk[:32 - len(self.head)]
+        self.sha256.update(chunk)
+        self.file.write(chunk)
+
+    def on_part_end(self) -> None:
+        if self.in_file:
+            self.found = True
+            self.in_file = False
+
+    def reject_too_large(self) -> None:
+        self.file.close()
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Image upload service is not configured."
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File too large. Maximum size is {self.max_size // (1024 * 1024)}MB."
         )
-    
-    try:
-        # Convert image to base64
-        import base64
-        file_base64 = base64.b64encode(file_content).decode("utf-8")
+
+    async def receive(self, request: Request) -> None:
+        content_type, options = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in options:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Expected a multipart/form-data upload."
+            )
+        
+        # Refuse declared oversize bodies before reading any of them
+        body_limit = self.max_size + self.MULTIPART_OVERHEAD
+        content_length = request.headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > body_limit:
+            self.reject_too_large()
+        
+        parser = MultipartParser(options[b"boundary"], callbacks={
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        })
+        received = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > body_limit:
+                self.reject_too_large()
+            parser.write(chunk)
+            if self.too_large:
+                self.reject_too_large()
+        parser.finalize()
+        
+        if not self.found:
+            self.file.close()
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="No file uploaded."
+            )
+        self.file.seek(0)
+
+class ImgBBStorage:
+    """Forwards uploads to ImgBB as a streamed multipart file"""
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+
+    async def save(self, upload: StreamingUpload, content_type: str) -> Dict[str, Any]:
+        if not self.api_key:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Image upload service is not configured."
+            )
         
         # Send the request to ImgBB
-        async with httpx.AsyncClient(timeout=10.0) as client:
+        async with http_clients.session("imgbb") as client:
             response = await client.post(
                 "https://api.imgbb.com/1/upload",
-                data={
-                    "key": IMGBB_API_KEY,
-                    "image": file_base64,
-                    "name": file.filename,
-                }
+                data={"key": self.api_key, "name": upload.filename},
+                files={"image": (upload.filename or "image", upload.file, content_type)}
             )
             
             # Check if the request was successful
@@ -5008,10 +7606,67 @@ async def upload_image(
                 "url": image_url,
                 "display_url": result.get("data", {}).get("display_url"),
                 "thumbnail_url": result.get("data", {}).get("thumb", {}).get("url"),
-                "size": len(file_content),
-                "type": content_type
             }
-            
+
+class LocalImageStorage:
+    """Stores uploads on local disk under their content hash and serves them from /uploads"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def write(self, upload: StreamingUpload, name: str) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, name)
+        if os.path.exists(path):
+            return
+        temp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(temp_path, "wb") as output:
+            shutil.copyfileobj(upload.file, output, 1024 * 1024)
+        os.replace(temp_path, path)
+
+    async def save(self, upload: StreamingUpload, content_type: str) -> Dict[str, Any]:
+        name = upload.sha256.hexdigest() + UPLOAD_EXTENSIONS[content_type]
+        await asyncio.to_thread(self.write, upload, name)
+        url = f"{settings.API_URL}/uploads/{name}"
+        return {"url": url, "display_url": url, "thumbnail_url": url}
+
+def get_image_storage():
+    if settings.UPLOAD_BACKEND == "local":
+        return LocalImageStorage(settings.UPLOAD_DIR)
+    return ImgBBStorage(settings.IMGBB_API_KEY)
+
+@app.post("/upload", openapi_extra={
+    "requestBody": {
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "properties": {"file": {"type": "string", "format": "binary"}},
+            "required": ["file"]
+        }}},
+        "required": True
+    }
+})
+@limiter.limit(RateLimits.UPLOAD_LIMIT)
+async def upload_image(
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """Upload an image to the configured storage backend and return the URL"""
+    upload = StreamingUpload("file", settings.MAX_UPLOAD_SIZE)
+    await upload.receive(request)
+    
+    try:
+        # Check file type from its signature rather than the declared type
+        content_type = sniff_image_type(upload.head)
+        if content_type is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Only image files are allowed."
+            )
+        
+        result = await get_image_storage().save(upload, content_type)
+        return {**result, "size": upload.size, "type": content_type}
+    except HTTPException:
+        raise
     except httpx.RequestError as e:
         logger.error(f"Error uploading to ImgBB: {str(e)}")
         raise HTTPException(
@@ -5024,209 +7679,109 @@ async def upload_image(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="An unexpected error occurred during image upload."
         )
+    finally:
+        upload.file.close()
+
+@app.get("/uploads/{name}")
+@limiter.limit(RateLimits.BLOB_LIMIT)
+async def get_uploaded_image(request: Request, name: str):
+    """Serve an image stored by the local upload backend"""
+    stem, _, extension = name.partition(".")
+    path = os.path.join(settings.UPLOAD_DIR, name)
+    if (
+        settings.UPLOAD_BACKEND != "local"
+        or len(stem) != 64
+        or f".{extension}" not in UPLOAD_EXTENSIONS.values()
+        or not os.path.isfile(path)
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Image not found"
+        )
+    
+    # Names are content hashes, so a stored file never changes
+    return FileResponse(path, headers={
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "X-Content-Type-Options": "nosniff"
+    })
 
 # Health check ping with optimized timeout
 
 async def ping_self():
-    async with httpx.AsyncClient(timeout=5.0) as client:
+    async with http_clients.session("self") as client:
         try:
             await client.get(f"{settings.API_URL}/health")
             logger.info("Health check ping successful")
         except Exception as e:
             logger.error(f"Health check ping failed: {str(e)}")
 
-def run_ping():
-    asyncio.run(ping_self())
-
-def start_ping_scheduler():
-    schedule.every(settings.PING_INTERVAL).seconds.do(run_ping)
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
-
-async def start_cleanup_scheduler():
+async def start_ping_scheduler():
     while True:
-        await cleanup_old_view_records()
-        await cleanup_expired_previews()
-        await cleanup_old_analytics()  # Added cleanup for analytics
-        await asyncio.sleep(12 * 60 * 60)  # Run twice daily instead of daily
+        await asyncio.sleep(settings.PING_INTERVAL)
+        await ping_self()
 
-async def periodic_registration_cleanup():
-    while True:
-        try:
-            await cleanup_expired_registrations()
-            await asyncio.sleep(3600)  # Run hourly
-        except Exception as e:
-            logger.error(f"Error in periodic registration cleanup: {str(e)}")
-            await asyncio.sleep(60)  # Retry after a minute if there's an error
-
-async def refresh_expiring_discord_tokens():
-    """Periodically refresh Discord tokens that are about to expire"""
-    while True:
-        try:
-            # Find users with tokens that will expire in the next 24 hours
-            expiry_threshold = datetime.utcnow() + timedelta(hours=24)
-            
-            # Find users with tokens that will expire soon
-            cursor = db.users.find({
-                "discord.expires_at": {
-                    "$gt": datetime.utcnow(),  # Not expired yet
-                    "$lt": expiry_threshold    # But will expire soon
-                }
-            }, projection={
-                "id": 1, 
-                "email": 1,
-                "username": 1,
-                "discord.refresh_token": 1
-            })
-            
-            refresh_count = 0
-            async for user in cursor:
-                try:
-                    # Get refresh token
-                    refresh_token = user.get("discord", {}).get("refresh_token")
-                    if not refresh_token:
-                        continue
-                    
-                    # Refresh the token
-                    token_data = await refresh_discord_token(refresh_token)
-                    
-                    if not token_data:
-                        # If refresh fails, remove the Discord connection
-                        logger.warning(f"Failed to refresh Discord token for user {user['id']}, removing connection")
-                        await db.users.update_one(
-                            {"id": user["id"]},
-                            {"$unset": {"discord": ""}}
-                        )
-                        
-                        # Clear cache
-                        await user_cache.delete(f"user:{user['email']}")
-                        if user.get("username"):
-                            await user_cache.delete(f"username:{user['username']}")
-                        
-                        continue
-                    
-                    # Calculate token expiration
-                    expires_in = token_data.get("expires_in", 604800)  # Default to 7 days
-                    expires_at = datetime.utcnow() + timedelta(seconds=expires_in)
-                    
-                    # Update tokens
-                    await db.users.update_one(
-                        {"id": user["id"]},
-                        {"$set": {
-                            "discord.access_token": token_data.get("access_token"),
-                            "discord.refresh_token": token_data.get("refresh_token"),
-                            "discord.expires_at": expires_at
-                        }}
-                    )
-                    
-                    # Clear cache
-                    await user_cache.delete(f"user:{user['email']}")
-                    if user.get("username"):
-                        await user_cache.delete(f"username:{user['username']}")
-                    
-                    refresh_count += 1
-                    
-                except Exception as e:
-                    logger.error(f"Error refreshing Discord token for user {user['id']}: {str(e)}")
-            
-            if refresh_count > 0:
-                logger.info(f"Refreshed Discord tokens for {refresh_count} users")
-            
-            # Run every 6 hours
-            await asyncio.sleep(6 * 60 * 60)
-            
-        except Exception as e:
-            logger.error(f"Error in Discord token refresh task: {str(e)}")
-            # If there's an error, wait a bit and try again
-            await asyncio.sleep(15 * 60)  # 15 minutes
+def open_database_client() -> AsyncIOMotorClient:
+    return AsyncIOMotorClient(
+        settings.MONGODB_URL,
+        maxPoolSize=settings.MONGODB_MAX_POOL_SIZE,
+        minPoolSize=settings.MONGODB_MIN_POOL_SIZE,
+        serverSelectionTimeoutMS=5000,
+        event_listeners=[MongoCommandMetrics(metrics)] if settings.METRICS_ENABLED else []
+    )
 
 @app.on_event("startup")
 async def startup_event():
-    global db_client, db
+    global db_client, db, geoip_db
     
     # Initialize database connection
     logger.info("Initializing database connection...")
-    db_client = AsyncIOMotorClient(
-        settings.MONGODB_URL,
-        maxPoolSize=settings.MONGODB_MAX_POOL_SIZE,
-        minPoolSize=settings.MONGODB_MIN_POOL_SIZE,
-        serverSelectionTimeoutMS=5000
-    )
-    db = db_client.Versz_db
+    db_client = open_database_client()
+    db = db_client[settings.MONGODB_DATABASE]
     
-    # Create database indexes
-    logger.info("Creating database indexes...")
-    await db.users.create_index("email", unique=True)
+    # Open shared outbound HTTP clients
+    http_clients.start()
     
-    # Check if username index exists and drop it if needed
-    try:
-        # Get all indexes on the users collection
-        indexes = await db.users.index_information()
-        # If username_1 index exists, drop it
-        if "username_1" in indexes:
-            # Only drop and recreate if it's not already sparse
-            if not indexes["username_1"].get("sparse", False):
-                logger.info("Dropping existing username index to recreate it as sparse")
-                await db.users.drop_index("username_1")
-                # Create the new sparse index
-                await db.users.create_index("username", unique=True, sparse=True)
-        else:
-            # Create the index if it doesn't exist
-            await db.users.create_index("username", unique=True, sparse=True)
-    except Exception as e:
-        logger.error(f"Error managing username index: {str(e)}")
-        # Continue with startup even if index management fails
-    
-    # Rest of the indexes
-    await db.pending_users.create_index("email", unique=True)
-    await db.profile_pages.create_index("url", unique=True)
-    await db.profile_pages.create_index("user_id")
-    await db.profile_pages.create_index([("user_id", 1), ("page_id", 1)])
-    await db.views.create_index("url", unique=True)
-    await db.templates.create_index("id", unique=True)
-    await db.templates.create_index("created_by")
-    await db.templates.create_index("use_count")
-    await db.verification.create_index("token", unique=True)
-    await db.verification.create_index("email")
-    await db.verification.create_index("expires_at")
-    await db.view_records.create_index([("url", 1), ("device_hash", 1), ("timestamp", -1)])
-    await db.password_reset.create_index("email")
-    await db.password_reset.create_index("code")
-    await db.password_reset.create_index("expires_at")
-    await db.page_previews.create_index("expires_at")
-    await db.users.create_index("discord.discord_id")
-    
-    # New indexes for analytics, messages, and drawings
-    await db.analytics.create_index("page_id")
-    await db.analytics.create_index("url")
-    await db.analytics.create_index("timestamp")
-    await db.analytics.create_index([("page_id", 1), ("timestamp", -1)])
-    await db.analytics.create_index([("country_code", 1), ("page_id", 1)])
-    
-    await db.messages.create_index("page_id")
-    await db.messages.create_index("url")
-    await db.messages.create_index("user_id")
-    await db.messages.create_index([("page_id", 1), ("approved", 1)])
-    await db.messages.create_index([("user_id", 1), ("approved", 1)])
-    await db.messages.create_index("timestamp")
-    
-    await db.drawings.create_index("page_id")
-    await db.drawings.create_index("url")
-    await db.drawings.create_index("user_id")
-    await db.drawings.create_index([("page_id", 1), ("approved", 1)])
-    await db.drawings.create_index([("user_id", 1), ("approved", 1)])
-    await db.drawings.create_index("timestamp")
-    
-    # Start cleanup tasks
-    asyncio.create_task(start_cleanup_scheduler())
-    asyncio.create_task(periodic_registration_cleanup())
+    # Open the local GeoIP database if one is configured
+    if settings.GEOIP_DATABASE_PATH:
+        try:
+            geoip_db = open_geoip_database(settings.GEOIP_DATABASE_PATH)
+            logger.info(f"Loaded GeoIP database from {settings.GEOIP_DATABASE_PATH}")
+        except Exception as e:
+            logger.error(f"Could not load GeoIP database: {str(e)}")
+    
+    # Create missing indexes, and expire old and short-lived documents through TTL
+    # indexes; a worker that cannot confirm them in time fails to start
+    await ensure_indexes(wait_timeout=settings.INDEX_WAIT_TIMEOUT)
+    asyncio.create_task(run_migration_once("ttl_expires_at_backfill", backfill_expires_at))
+    
+    # Share cache evictions with the other workers
+    await cache_bus.start()
+    
+    # Start write-behind view flushing
+    view_buffer.start()
+    
+    # Start delivering queued email
+    email_outbox.start()
+    
+    # Resume and run queued purges of deleted accounts and pages
+    purge_engine.start()
+    
+    # Start user_number allocation above the existing users before accepting registrations
+    await run_migration_once("user_number_counter", user_numbers.seed_counter)
+    
+    # Roll up analytics written before analytics_daily existed
+    asyncio.create_task(run_migration_once("analytics_daily_backfill", backfill_analytics_rollups))
+    
+    # Move drawings stored as inline data URLs into blob storage
+    asyncio.create_task(run_migration_once("drawing_blobs", migrate_inline_drawings))
+    
+    # Sample how closely the TTL indexes keep up with retention
+    retention_monitor.start()
     
     # Start Discord token refresh task
-    asyncio.create_task(refresh_expiring_discord_tokens())
+    discord_refresher.start()
    
-    ping_thread = threading.Thread(target=start_ping_scheduler, daemon=True)
-    ping_thread.start()
+    asyncio.create_task(start_ping_scheduler())
     
     logger.info("Application startup complete")
     
@@ -5234,12 +7789,45 @@ async def startup_event():
 async def shutdown_event():
     global db_client
     if db_client:
+        logger.info("Flushing queued page views...")
+        await view_buffer.stop()
+        await email_outbox.stop()
+        await purge_engine.stop()
+        await cache_bus.stop()
+        await retention_monitor.stop()
+        await discord_refresher.stop()
         logger.info("Closing database connection...")
         db_client.close()
+    password_hasher.shutdown()
+    await http_clients.close()
+    if geoip_db is not None:
+        geoip_db.close()
     
 
 
 if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "compile-geoip":
+        # python main.py compile-geoip ranges.csv geoip.bin
+        count = GeoIPRangeTable.compile(sys.argv[2], sys.argv[3])
+        print(f"Compiled {count} ranges into {sys.argv[3]}")
+        sys.exit(0)
+    
+    if len(sys.argv) == 2 and sys.argv[1] == "reconcile-indexes":
+        # python main.py reconcile-indexes, run as a deploy step before the workers start
+        async def reconcile_indexes_command() -> bool:
+            global db_client, db
+            db_client = open_database_client()
+            db = db_client[settings.MONGODB_DATABASE]
+            try:
+                return await ensure_indexes(force=True, wait_timeout=settings.INDEX_WAIT_TIMEOUT)
+            except Exception as e:
+                logger.error(f"Index reconciliation failed: {str(e)}")
+                return False
+            finally:
+                db_client.close()
+        
+        sys.exit(0 if asyncio.run(reconcile_indexes_command()) else 1)
+    
     import uvicorn
     uvicorn.run(
         "main:app",
@@ -0,0 +1,71 @@
+from datetime import datetime
+
+import httpx
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import main
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """An empty in-memory database in place of MongoDB"""
+    client = AsyncMongoMockClient()
+    monkeypatch.setattr(main, "db_client", client)
+    monkeypatch.setattr(main, "db", client.Versz_db)
+    # Caches outlive a test, so start every one from the empty database
+    main.cache_bus.reset_all()
+    main.user_cache.clear()
+    main.verified_tokens.clear()
+    return client.Versz_db
+
+
+@pytest.fixture
+async def client(db, monkeypatch):
+    """The app without rate limits; startup work (indexes, workers, GeoIP) does not run"""
+    monkeypatch.setattr(main.limiter, "enabled", False)
+    async with httpx.AsyncClient(app=main.app, base_url="http://testserver") as client:
+        yield client
+
+
+@pytest.fixture
+def fail_writes(monkeypatch):
+    """Make a write method raise for one collection; call the returned function to let writes through again"""
+    def install(collection_name, method):
+        # mongomock_motor hands out a new wrapper on every attribute access, so patch the class
+        collection_class = type(main.db[collection_name])
+        original = getattr(collection_class, method)
+        state = {"failing": True}
+
+        async def failing(self, *args, **kwargs):
+            if state["failing"] and self.name == collection_name:
+                raise main.OperationFailure("simulated write failure")
+            return await original(self, *args, **kwargs)
+
+        monkeypatch.setattr(collection_class, method, failing)
+        return lambda: state.update(failing=False)
+    return install
+
+
+@pytest.fixture
+async def user(db):
+    """A verified account with the password Passw0rd!"""
+    document = {
+        "id": "u1",
+        "user_number": 1,
+        "email": "alice@example.com",
+        "username": "alice",
+        "name": "Alice",
+        "hashed_password": main.pwd_context.hash("Passw0rd!"),
+        "is_verified": True,
+        "joined_at": datetime.utcnow(),
+        "tags": [],
+        "display_preferences": main.DisplayPreferences().dict()
+    }
+    await db.users.insert_one(dict(document))
+    return document
@@ -0,0 +1,49 @@
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+async def login(client, password="Passw0rd!"):
+    response = await client.post("/token", data={"username": "alice@example.com", "password": password})
+    assert response.status_code == 200
+    return response.json()["access_token"]
+
+
+def bearer(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def test_token_carries_the_token_version(client, user):
+    token = await login(client)
+
+    assert main.verify_token(token)["ver"] == 0
+    assert (await client.get("/me", headers=bearer(token))).status_code == 200
+
+
+async def test_password_change_revokes_earlier_tokens(client, user):
+    old_token = await login(client)
+    # Served once so the verified claims and principal are cached
+    assert (await client.get("/me", headers=bearer(old_token))).status_code == 200
+
+    response = await client.post(
+        "/change-password",
+        json={"current_password": "Passw0rd!", "new_password": "N3wPassword"},
+        headers=bearer(old_token)
+    )
+    assert response.status_code == 200
+    new_token = response.json()["access_token"]
+
+    assert (await client.get("/me", headers=bearer(old_token))).status_code == 401
+    assert (await client.get("/me", headers=bearer(new_token))).status_code == 200
+    assert main.verify_token(await login(client, "N3wPassword"))["ver"] == 1
+
+
+async def test_token_of_deleted_account_is_rejected(client, user, db):
+    token = await login(client)
+
+    await db.users.update_one({"id": user["id"]}, {"$set": {"deleted_at": main.datetime.utcnow()}})
+    await main.invalidate_user_cache(user["email"], user["username"])
+
+    assert (await client.get("/me", headers=bearer(token))).status_code == 401
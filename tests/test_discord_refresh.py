@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeDiscord:
+    """Local stand-in for Discord's token endpoint that replays scripted responses per refresh token"""
+
+    def __init__(self, script):
+        self.script = script
+        self.calls = []
+        self.app = FastAPI()
+        self.app.post("/api/v10/oauth2/token")(self.token)
+
+    async def token(self, request: Request):
+        form = await request.form()
+        refresh_token = form["refresh_token"]
+        self.calls.append(refresh_token)
+        status_code, body, headers = self.script[refresh_token].pop(0)
+        return JSONResponse(body, status_code=status_code, headers=headers)
+
+
+@pytest.fixture
+def discord(monkeypatch, db):
+    def install(script):
+        fake = FakeDiscord(script)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake.app))
+        monkeypatch.setitem(main.http_clients.clients, "discord", client)
+        monkeypatch.setattr(main.settings, "DISCORD_API_ENDPOINT", "http://discord.test/api/v10")
+        return fake
+    return install
+
+
+async def seed_connection(db, user_id, refresh_token):
+    await db.users.insert_one({
+        "id": user_id,
+        "email": f"{user_id}@example.com",
+        "username": user_id,
+        "discord": {
+            "access_token": "old-access",
+            "refresh_token": refresh_token,
+            "expires_at": datetime.utcnow() + timedelta(hours=1)
+        }
+    })
+
+
+def granted(token):
+    return 200, {"access_token": f"{token}-access", "refresh_token": f"{token}-next", "expires_in": 3600}, {}
+
+
+async def test_refresh_applies_granted_and_revoked_tokens(db, discord):
+    fake = discord({"ok": [granted("ok")], "revoked": [(400, {"error": "invalid_grant"}, {})]})
+    await seed_connection(db, "u1", "ok")
+    await seed_connection(db, "u2", "revoked")
+    refresher = main.DiscordTokenRefresher()
+
+    assert await refresher.step() == refresher.interval
+
+    assert sorted(fake.calls) == ["ok", "revoked"]
+    assert (await db.users.find_one({"id": "u1"}))["discord"]["refresh_token"] == "ok-next"
+    assert "discord" not in await db.users.find_one({"id": "u2"})
+    assert refresher.refreshed == 1
+    assert refresher.disconnected == 1
+
+
+async def test_rate_limit_is_retried_after_retry_after(db, discord):
+    fake = discord({"slow": [(429, {"retry_after": 0.05}, {}), granted("slow")]})
+    await seed_connection(db, "u1", "slow")
+    refresher = main.DiscordTokenRefresher()
+
+    await refresher.step()
+
+    assert fake.calls == ["slow", "slow"]
+    assert refresher.rate_limited == 1
+    assert (await db.users.find_one({"id": "u1"}))["discord"]["refresh_token"] == "slow-next"
+
+
+async def test_exhausted_bucket_pauses_further_requests(db, discord):
+    headers = {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "30"}
+    discord({"last": [(200, granted("last")[1], headers)]})
+    await seed_connection(db, "u1", "last")
+    refresher = main.DiscordTokenRefresher()
+
+    await refresher.step()
+
+    assert refresher.resume_at - main.time.monotonic() > 25
+
+
+async def test_lease_held_elsewhere_skips_the_pass(db, discord):
+    fake = discord({"ok": [granted("ok")]})
+    await seed_connection(db, "u1", "ok")
+    await db.schema_migrations.insert_one({
+        "_id": f"{main.DiscordTokenRefresher.LEASE}:lock",
+        "owner": "another-worker",
+        "locked_until": datetime.utcnow() + timedelta(minutes=5)
+    })
+    refresher = main.DiscordTokenRefresher()
+
+    assert await refresher.step() is None
+    assert fake.calls == []
+
+
+async def test_lapsed_lease_stops_requests(db, discord):
+    fake = discord({"ok": [granted("ok")]})
+    await seed_connection(db, "u1", "ok")
+    refresher = main.DiscordTokenRefresher()
+    refresher.lease_until = 0.0
+
+    with pytest.raises(RuntimeError, match="Lost the Discord refresh lease"):
+        await refresher.refresh_expiring()
+    assert fake.calls == []
+    assert (await db.users.find_one({"id": "u1"}))["discord"]["refresh_token"] == "ok"
+
+
+async def test_stop_releases_the_lease(db, discord):
+    discord({})
+    refresher = main.DiscordTokenRefresher()
+    await refresher.step()
+    assert await db.schema_migrations.find_one({"_id": f"{refresher.LEASE}:lock"})
+
+    await refresher.stop()
+
+    assert await db.schema_migrations.find_one({"_id": f"{refresher.LEASE}:lock"}) is None
@@ -0,0 +1,53 @@
+from pathlib import Path
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+SOURCE = Path(__file__).parent / "data" / "geoip.csv"
+
+
+@pytest.fixture
+def table(tmp_path):
+    path = tmp_path / "geoip.bin"
+    assert main.GeoIPRangeTable.compile(str(SOURCE), str(path)) == 4
+    table = main.open_geoip_database(str(path))
+    yield table
+    table.close()
+
+
+@pytest.mark.parametrize("ip_address, country_code", [
+    ("1.0.0.0", "AU"),
+    ("8.8.8.8", "US"),
+    ("81.2.69.255", "GB"),
+    ("2001:4860::8888", "US"),
+])
+def test_lookup_finds_the_enclosing_range(table, ip_address, country_code):
+    assert table.lookup(ip_address)["country_code"] == country_code
+
+
+@pytest.mark.parametrize("ip_address", ["0.255.255.255", "8.8.9.0", "255.255.255.255", "2001:4861::"])
+def test_lookup_outside_every_range_is_none(table, ip_address):
+    assert table.lookup(ip_address) is None
+
+
+def test_uncompiled_file_is_rejected(tmp_path):
+    path = tmp_path / "geoip.bin"
+    path.write_bytes(b"not a range table" * 4)
+    with pytest.raises(ValueError):
+        main.GeoIPRangeTable(str(path))
+
+
+async def test_country_info_uses_the_local_table_without_http(table, monkeypatch):
+    async def no_http(ip_address):
+        raise AssertionError("HTTP fallback should not be called")
+
+    monkeypatch.setattr(main, "geoip_db", table)
+    monkeypatch.setattr(main, "lookup_country_http", no_http)
+    monkeypatch.setattr(main.settings, "GEOIP_HTTP_FALLBACK", False)
+
+    assert await main.get_country_info("81.2.69.160") == {"country_code": "GB", "country_name": "United Kingdom"}
+    assert (await main.get_country_info("9.9.9.9"))["country_code"] == "Unknown"
+    assert (await main.get_country_info("10.0.0.1"))["country_code"] == "Unknown"
@@ -0,0 +1,53 @@
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def ttl_indexes(monkeypatch, db):
+    """Stands in for reconcile_ttl_indexes, which needs collMod; counts the reconciliations"""
+    calls = []
+
+    async def reconcile_ttl_indexes():
+        calls.append(True)
+        return True
+
+    monkeypatch.setattr(main, "reconcile_ttl_indexes", reconcile_ttl_indexes)
+    return calls
+
+
+async def test_matching_hash_skips_reconciliation(db, ttl_indexes):
+    assert await main.ensure_indexes()
+    assert await main.ensure_indexes()
+    assert len(ttl_indexes) == 1
+    assert "email_1" in await db.users.index_information()
+
+
+async def test_failed_reconciliation_is_not_retried_by_every_worker(db, ttl_indexes, monkeypatch):
+    async def failing():
+        ttl_indexes.append(False)
+        return False
+
+    monkeypatch.setattr(main, "reconcile_ttl_indexes", failing)
+    assert not await main.ensure_indexes()
+    assert not await main.ensure_indexes()
+
+    assert len(ttl_indexes) == 1
+    state = await db.schema_migrations.find_one({"_id": "indexes"})
+    assert state["failed_hash"] == main.index_schema_hash()
+    assert await db.schema_migrations.find_one({"_id": "indexes:lock"}) is None
+
+
+async def test_changed_options_are_only_rebuilt_by_the_command(db, ttl_indexes):
+    await db.users.create_index("email")
+
+    assert not await main.ensure_indexes()
+    assert not (await db.users.index_information())["email_1"].get("unique")
+
+    assert await main.ensure_indexes(force=True)
+    assert (await db.users.index_information())["email_1"]["unique"]
+    state = await db.schema_migrations.find_one({"_id": "indexes"})
+    assert state["hash"] == main.index_schema_hash()
+    assert "failed_hash" not in state
@@ -0,0 +1,97 @@
+import smtplib
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def outbox(db):
+    """An outbox whose SMTP session is replaced by a list of sent messages"""
+    outbox = main.EmailOutbox(batch_size=10)
+    outbox.delivered = []
+    outbox._send = lambda message: outbox.delivered.append(message["to"])
+    yield outbox
+    outbox.executor.shutdown(wait=False)
+
+
+async def test_claim_leases_due_messages_to_this_worker(db, outbox):
+    await outbox.enqueue("a@example.com", "Hi", "<p>Hi</p>")
+
+    [message] = await outbox.claim_batch()
+
+    assert message["status"] == "sending"
+    assert message["owner"] == main.WORKER_ID
+    assert message["lease_until"] > datetime.utcnow()
+    assert await outbox.claim_batch() == []
+
+
+async def test_expired_lease_of_a_crashed_worker_is_reclaimed(db, outbox):
+    await db.email_outbox.insert_many([
+        {"to": "stale@example.com", "subject": "s", "html": "h", "status": "sending", "owner": "crashed",
+         "lease_until": datetime.utcnow() - timedelta(seconds=1), "next_attempt_at": datetime.utcnow(), "attempts": 0},
+        {"to": "live@example.com", "subject": "s", "html": "h", "status": "sending", "owner": "busy",
+         "lease_until": datetime.utcnow() + timedelta(minutes=1), "next_attempt_at": datetime.utcnow(), "attempts": 0}
+    ])
+
+    assert await outbox.process() == 1
+    assert outbox.delivered == ["stale@example.com"]
+    assert (await db.email_outbox.find_one({"to": "stale@example.com"}))["status"] == "sent"
+    assert (await db.email_outbox.find_one({"to": "live@example.com"}))["owner"] == "busy"
+
+
+async def test_message_taken_over_mid_batch_is_not_sent_twice(db, outbox, monkeypatch):
+    for address in ("first@example.com", "second@example.com"):
+        await outbox.enqueue(address, "Hi", "<p>Hi</p>")
+    claim_batch = outbox.claim_batch
+
+    async def claim_then_lose_second():
+        batch = await claim_batch()
+        if len(batch) == 2:
+            # The lease on the second message ran out while the first was sent
+            await db.email_outbox.update_one({"_id": batch[1]["_id"]}, {"$set": {"owner": "other-worker"}})
+        return batch
+
+    monkeypatch.setattr(outbox, "claim_batch", claim_then_lose_second)
+
+    assert await outbox.process() == 1
+    assert outbox.delivered == ["first@example.com"]
+    second = await db.email_outbox.find_one({"to": "second@example.com"})
+    assert second["status"] == "sending"
+    assert second["owner"] == "other-worker"
+
+
+async def test_result_of_a_taken_over_message_does_not_overwrite_the_new_owner(db, outbox):
+    await outbox.enqueue("a@example.com", "Hi", "<p>Hi</p>")
+    [message] = await outbox.claim_batch()
+    await db.email_outbox.update_one({"_id": message["_id"]}, {"$set": {"owner": "other-worker"}})
+
+    await outbox.deliver(message)
+
+    assert (await db.email_outbox.find_one({"_id": message["_id"]}))["status"] == "sending"
+
+
+async def test_transient_failures_are_retried_and_permanent_ones_expire(db, outbox):
+    def refuse(message):
+        if message["to"] == "busy@example.com":
+            raise smtplib.SMTPResponseException(451, b"try again later")
+        raise smtplib.SMTPResponseException(550, b"no such user")
+
+    outbox._send = refuse
+    await outbox.enqueue("busy@example.com", "Hi", "<p>Hi</p>")
+    await outbox.enqueue("gone@example.com", "Hi", "<p>Hi</p>")
+
+    await outbox.process()
+
+    retried = await db.email_outbox.find_one({"to": "busy@example.com"})
+    assert retried["status"] == "pending"
+    assert retried["attempts"] == 1
+    assert retried["next_attempt_at"] > datetime.utcnow()
+    assert "owner" not in retried
+    failed = await db.email_outbox.find_one({"to": "gone@example.com"})
+    assert failed["status"] == "failed"
+    # failed_at drives the TTL that expires undeliverable mail
+    assert isinstance(failed["failed_at"], datetime)
@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+SORT = [("timestamp", -1), ("id", -1)]
+
+
+def test_cursor_round_trips_dates():
+    values = [datetime(2024, 5, 1, 12, 30), "m42"]
+
+    assert main.decode_cursor(main.encode_cursor(values), 2) == values
+
+
+@pytest.mark.parametrize("token", ["not-a-cursor", main.encode_cursor(["only one value"])])
+def test_malformed_cursor_is_a_bad_request(token):
+    with pytest.raises(HTTPException) as error:
+        main.decode_cursor(token, 2)
+    assert error.value.status_code == 400
+
+
+async def test_keyset_pages_cover_every_row_once_despite_tied_timestamps(db):
+    start = datetime(2024, 1, 1)
+    # Three rows share every timestamp, so only the id breaks the tie
+    await db.messages.insert_many([
+        {"id": f"m{i:02d}", "user_id": "u1", "timestamp": start + timedelta(minutes=i // 3)}
+        for i in range(10)
+    ])
+
+    seen, cursor = [], None
+    while True:
+        query = {"user_id": "u1"}
+        if cursor:
+            query.update(main.keyset_filter(SORT, main.decode_cursor(cursor, len(SORT))))
+        rows = await db.messages.find(query).sort(SORT).limit(4).to_list(4)
+        seen.extend(row["id"] for row in rows)
+        cursor = main.next_cursor(rows, SORT, 4)
+        if cursor is None:
+            break
+
+    assert seen == [f"m{i:02d}" for i in reversed(range(10))]
+
+
+async def test_user_messages_endpoint_pages_with_next_cursor(client, user, db):
+    token = main.create_user_token(user)
+    start = datetime(2024, 1, 1)
+    await db.messages.insert_many([
+        {"id": f"m{i}", "user_id": user["id"], "page_id": "p1", "content": str(i),
+         "timestamp": start + timedelta(minutes=i), "approved": True}
+        for i in range(5)
+    ])
+
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = await client.get("/user/messages", params=params, headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        body = response.json()
+        pages.append([message["id"] for message in body["messages"]])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            break
+
+    assert pages == [["m4", "m3"], ["m2", "m1"], ["m0"]]
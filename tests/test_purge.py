@@ -0,0 +1,94 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def page_data(db):
+    await db.messages.insert_many([{"page_id": "p1"} for _ in range(5)] + [{"page_id": "p2"}])
+    await db.analytics.insert_many([{"page_id": "p1"} for _ in range(3)] + [{"page_id": "p2"}])
+
+
+def engine():
+    return main.PurgeEngine(batch_size=2, batch_delay=0)
+
+
+async def test_job_interrupted_mid_step_resumes_from_its_checkpoint(db, page_data, monkeypatch):
+    first = engine()
+    job_id = await first.enqueue("page", "u1", [("messages", "page_id", ["p1"]), ("analytics", "page_id", ["p1"])])
+    job = await first.claim()
+
+    # The first worker dies during its second batch
+    delete_batch = first.delete_batch
+    batches = []
+
+    async def dying_delete_batch(collection, query):
+        if len(batches) == 1:
+            raise asyncio.CancelledError()
+        batches.append(collection)
+        return await delete_batch(collection, query)
+
+    monkeypatch.setattr(first, "delete_batch", dying_delete_batch)
+    with pytest.raises(asyncio.CancelledError):
+        await first.run_job(job)
+
+    checkpoint = await db.purge_jobs.find_one({"_id": job["_id"]})
+    assert checkpoint["step"] == 0
+    assert checkpoint["deleted"] == {"messages": 2}
+
+    # Its lease runs out and another worker picks the job up where it stopped
+    await db.purge_jobs.update_one({"_id": job["_id"]}, {"$set": {"lease_until": datetime.utcnow() - timedelta(seconds=1)}})
+    monkeypatch.setattr(main, "WORKER_ID", "second-worker")
+    second = engine()
+    resumed = await second.claim()
+    assert str(resumed["_id"]) == job_id
+    await second.process_job(resumed)
+
+    finished = await db.purge_jobs.find_one({"_id": job["_id"]})
+    assert finished["status"] == "done"
+    assert finished["deleted"] == {"messages": 5, "analytics": 3}
+    assert "owner" not in finished
+    assert await db.messages.count_documents({}) == 1
+    assert await db.analytics.count_documents({}) == 1
+
+
+async def test_running_job_with_a_live_lease_is_not_claimed(db, page_data):
+    await engine().enqueue("page", "u1", [("messages", "page_id", ["p1"])])
+    assert await engine().claim() is not None
+
+    assert await engine().claim() is None
+
+
+async def test_worker_that_lost_its_lease_leaves_the_job_to_the_new_owner(db, page_data):
+    purge = engine()
+    await purge.enqueue("page", "u1", [("messages", "page_id", ["p1"])])
+    job = await purge.claim()
+    await db.purge_jobs.update_one({"_id": job["_id"]}, {"$set": {"owner": "other-worker"}})
+
+    await purge.process_job(job)
+
+    taken_over = await db.purge_jobs.find_one({"_id": job["_id"]})
+    assert taken_over["status"] == "running"
+    assert taken_over["owner"] == "other-worker"
+    assert purge.completed == 0
+
+
+async def test_url_steps_only_purge_records_written_before_the_job(db):
+    queued_at = datetime.utcnow()
+    await db.view_records.insert_many([
+        {"url": "alice", "timestamp": queued_at - timedelta(minutes=1)},
+        # Someone claimed the URL again after the page was dropped
+        {"url": "alice", "timestamp": queued_at + timedelta(minutes=1)}
+    ])
+    purge = engine()
+    await purge.enqueue("page", "u1", [("view_records", "url", ["alice"], ("timestamp", queued_at))])
+
+    await purge.process_job(await purge.claim())
+
+    remaining = await db.view_records.find({}).to_list(None)
+    assert [record["timestamp"] > queued_at for record in remaining] == [True]
@@ -0,0 +1,122 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def buffer(db, monkeypatch):
+    buffer = main.ViewWriteBuffer(flush_interval_ms=0, max_backlog=3)
+    monkeypatch.setattr(main, "view_buffer", buffer)
+    return buffer
+
+
+def record_view(buffer, url="alice", page_id="p1"):
+    now = datetime.utcnow()
+    buffer.record(
+        url,
+        {"url": url, "device_hash": "d", "timestamp": now},
+        {"page_id": page_id, "url": url, "timestamp": now, "country_code": "GB", "country_name": "United Kingdom"}
+    )
+
+
+async def test_flush_writes_counters_records_and_rollups(db, buffer):
+    record_view(buffer)
+    record_view(buffer)
+
+    await buffer.flush()
+
+    assert (await db.views.find_one({"url": "alice"}))["views"] == 2
+    assert await db.view_records.count_documents({}) == 2
+    assert await db.analytics.count_documents({"rolled_up": True}) == 2
+    assert (await db.analytics_daily.find_one({"page_id": "p1"}))["total"] == 2
+    assert buffer.stats()["pending_views"] == 0
+
+
+async def test_failed_counter_write_is_kept_for_the_next_flush(db, buffer, fail_writes):
+    heal = fail_writes("views", "bulk_write")
+    record_view(buffer)
+    await buffer.flush()
+    assert buffer.pending_views("alice") == 1
+
+    heal()
+    record_view(buffer)
+    await buffer.flush()
+
+    assert (await db.views.find_one({"url": "alice"}))["views"] == 2
+
+
+async def test_failed_rollup_is_retried_without_counting_twice(db, buffer, fail_writes):
+    heal = fail_writes("analytics_daily", "bulk_write")
+    record_view(buffer)
+    await buffer.flush()
+
+    # The raw entry is stored, but not yet marked as rolled up
+    assert await db.analytics.count_documents({"rolled_up": {"$exists": False}}) == 1
+    assert buffer.stats()["pending_rollups"] == 1
+
+    heal()
+    record_view(buffer)
+    await buffer.flush()
+
+    assert (await db.analytics_daily.find_one({"page_id": "p1"}))["total"] == 2
+    assert await db.analytics.count_documents({"rolled_up": True}) == 2
+    assert buffer.stats()["pending_rollups"] == 0
+
+
+async def test_failed_inserts_are_requeued(db, buffer, fail_writes):
+    heal = fail_writes("analytics", "insert_many")
+    record_view(buffer)
+    await buffer.flush()
+    assert buffer.stats()["pending_analytics"] == 1
+
+    heal()
+    await buffer.flush()
+
+    assert await db.analytics.count_documents({}) == 1
+    assert buffer.stats()["pending_analytics"] == 0
+
+
+async def test_requeued_backlog_drops_the_oldest_beyond_its_cap(db, buffer, fail_writes):
+    fail_writes("view_records", "insert_many")
+    for _ in range(5):
+        record_view(buffer)
+
+    await buffer.flush()
+
+    stats = buffer.stats()
+    assert stats["pending_view_records"] == 3
+    assert stats["dropped"]["view_records"] == 2
+
+
+async def test_rename_moves_queued_views_and_folds_stragglers(db, buffer):
+    record_view(buffer, url="old")
+    record_view(buffer, url="old")
+    # update_page moves the counter itself before announcing the rename
+    await db.views.insert_one({"url": "new", "views": 10})
+    # A worker that flushed before hearing of the rename wrote under the old URL
+    await db.views.insert_one({"url": "old", "views": 3})
+
+    await main.rename_page_views("old", "new")
+    assert buffer.pending_views("old") == 0
+    assert buffer.pending_views("new") == 2
+
+    await buffer.flush()
+    # The straggler is folded in once every worker has flushed twice
+    await asyncio.sleep(buffer.flush_interval * 2 + 1.1)
+
+    assert await db.views.find_one({"url": "old"}) is None
+    assert (await db.views.find_one({"url": "new"}))["views"] == 15
+
+
+async def test_dropped_page_discards_its_queued_views(db, buffer):
+    record_view(buffer, url="gone")
+
+    await main.discard_page_views("gone")
+    await buffer.flush()
+
+    assert await db.views.find_one({"url": "gone"}) is None